@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+""" Benchmarks the play engine on fake machines.
+
+    Generates scenarios of increasing sizes whose tasks are spread over a few
+    fake machines, plays them and reports for each size: the time taken to
+    compile and to load the plan, the lateness of the tasks compared to their
+    timing, the throughput of the run and its peak memory. Every size runs in
+    a process of its own so that peak memories do not add up.
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/..'))
+
+def write_scenario(path, args):
+    machines = ['m{}'.format(i) for i in range(args.machines)]
+    tasks = ['t{}'.format(i) for i in range(args.size)]
+    with open(path, 'w') as f:
+        f.write('[Cluster]\nmachines = {}\n\n'.format(', '.join(machines)))
+        for machine in machines:
+            f.write('[{}]\ntransport = fake\nfake_latency = {}\n\n'.format(
+                machine, args.latency))
+        f.write('[Scenario]\ntasks = {}\n\n'.format(', '.join(tasks)))
+        for i, task in enumerate(tasks):
+            f.write('[{}]\ntarget = {}\ntiming = {}\n'.format(task,
+                machines[i % len(machines)],
+                i * args.spread // args.size))
+            if args.actions:
+                f.write('actions = {}\n'.format(args.actions))
+            f.write('\n')
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def bench(args):
+    """Plays one scenario and returns its measures."""
+    from lib import plan
+    from lib.run import Run
+    from lib.scheduler import Scheduler
+    from lib.task import Task
+
+    directory = tempfile.mkdtemp(prefix='moirai-bench-')
+    args.config = os.path.join(directory, 'moirai.ini')
+    write_scenario(args.config, args)
+
+    start = time.monotonic()
+    plan.compile(args)
+    compiled = time.monotonic() - start
+    start = time.monotonic()
+    config = plan.load(args)
+    loaded = time.monotonic() - start
+
+    started = []
+    run = Run(config, os.path.join(directory, 'logs'))
+    run.timeline.listeners.append(lambda record: record['event'] == 'task_started'
+            and started.append((record['time'], record['timing'])))
+    scheduler = Scheduler(run, Task.run_task, args.workers)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.monotonic()
+        scheduler.play()
+        duration = time.monotonic() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        run.close()
+        shutil.rmtree(directory)
+
+    offset = scheduler.start - run.timeline.start
+    lateness = sorted(t - offset - timing for t, timing in started)
+    return {'size': args.size,
+            'compile': compiled,
+            'load': loaded,
+            'p50': percentile(lateness, 0.5),
+            'p99': percentile(lateness, 0.99),
+            'max': lateness[-1] if lateness else 0,
+            'throughput': args.size / duration,
+            'memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the play engine')
+    parser.add_argument('--sizes', default='10,100,1000,10000,100000',
+            help='comma separated numbers of tasks')
+    parser.add_argument('--machines', type=int, default=4)
+    parser.add_argument('--spread', type=int, default=10,
+            help='seconds over which the tasks are scheduled')
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0,
+            help='seconds per round trip to the fake machines')
+    parser.add_argument('--actions', default='',
+            help='actions run by every task')
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.size is not None:
+        print(json.dumps(bench(args)))
+        return
+
+    print('{:>8} {:>9} {:>8} {:>9} {:>9} {:>9} {:>11} {:>9}'.format('tasks',
+        'compile', 'load', 'late p50', 'late p99', 'late max', 'tasks/s',
+        'peak MB'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        command = [sys.executable, __file__, '--size', str(size)]
+        for option in ('machines', 'spread', 'workers', 'latency', 'actions'):
+            command += ['--' + option, str(getattr(args, option))]
+        output = subprocess.run(command, stdout=subprocess.PIPE, check=True)
+        r = json.loads(output.stdout.decode('utf-8').splitlines()[-1])
+        print('{size:>8} {compile:>8.3f}s {load:>7.3f}s {p50:>8.4f}s '
+                '{p99:>8.4f}s {max:>8.4f}s {throughput:>11.1f} {memory:>9.1f}'
+                .format(**r))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+""" Benchmarks the file transfers of the SSH and WinRM transports.
+
+    The guests are replaced by the local stand-ins of standins.py, so the
+    numbers measure the protocols and the code of moirai rather than the
+    network of VirtualBox. For each file size, reports the throughput of
+    every way of moving a file: SFTP both ways, download from the file
+    server, push to the file server, and base64 chunks through powershell
+    for each chunk size. Then reports the time taken to send many small files
+    over one and several SFTP channels, and the latency of one command.
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/..'))
+
+def make_config(ssh_port, winrm_port, shell):
+    from lib.configuration import Configuration
+
+    config = Configuration()
+    config.add_option('linux', 'guest', 'linux')
+    config.add_option('windows', 'guest', 'windows')
+    config.add_option('windows', 'winrm_shell', shell)
+    config.forwards = {'linux': {22: ssh_port}, 'windows': {5985: winrm_port}}
+    return config
+
+def measure(function, repeat):
+    """Returns the median duration of repeat calls to function."""
+    durations = []
+    for i in range(repeat):
+        start = time.monotonic()
+        function()
+        durations.append(time.monotonic() - start)
+    return statistics.median(durations)
+
+def push_chunks(task, source, destination, chunk):
+    """Sends a file through send_script, chunk bytes per round trip."""
+    import base64
+
+    task.run_ps(task.del_script.format(location=destination))
+    with open(source, 'rb') as f:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                return
+            task.run_ps(task.send_script.format(location=destination,
+                b64_content=base64.b64encode(data).decode('ascii')))
+
+def pull_chunks(task, source, destination, chunk):
+    """Retrieves a file through recv_script with a fixed chunk size."""
+    task.chunk = task.max_chunk = task.min_chunk = chunk
+    task.pull_artifact(source, destination)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the transports')
+    parser.add_argument('--sizes', default='65536,1048576,16777216',
+            help='comma separated file sizes, in bytes')
+    parser.add_argument('--chunks', default='400,65536,1048576',
+            help='comma separated chunk sizes of the base64 transfers')
+    parser.add_argument('--max-round-trips', type=int, default=2000,
+            help='skips the chunked transfers needing more round trips')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='transfers measured per size, the median is reported')
+    parser.add_argument('--small-files', type=int, default=200,
+            help='number of 4KiB files sent over SFTP')
+    parser.add_argument('--channels', type=int, default=8,
+            help='SFTP channels used to send the small files')
+    parser.add_argument('--latency', type=float, default=0.002,
+            help='seconds taken by the SFTP stand-in to open or stat a file')
+    parser.add_argument('--calls', type=int, default=20,
+            help='commands run to measure the latency')
+    parser.add_argument('--shell', default='task',
+            choices=['none', 'task', 'machine'],
+            help='winrm_shell of the windows stand-in')
+    args = parser.parse_args()
+
+    from lib.output import Collector
+    from lib.run import Run
+    from lib.sshtask import SshTask
+    from lib.winrmtask import WinrmTask
+    from standins import SshStandin, WinrmStandin
+
+    directory = tempfile.mkdtemp(prefix='moirai-bench-')
+    host = os.path.join(directory, 'host')
+    guest = os.path.join(directory, 'guest')
+    os.makedirs(host)
+    os.makedirs(guest)
+    ssh = SshStandin(guest, args.latency)
+    win = WinrmStandin(guest)
+    # Every measure sends the same files again
+    run = Run(make_config(ssh.port, win.port, args.shell),
+            os.path.join(directory, 'logs'), force_send=True)
+    try:
+        print('{:>10} {:<24} {:>10} {:>10}'.format('size', 'transfer',
+            'seconds', 'MB/s'))
+        for size in [int(s) for s in args.sizes.split(',')]:
+            source = os.path.join(host, 'file.bin')
+            received = os.path.join(host, 'received.bin')
+            with open(source, 'wb') as f:
+                f.write(os.urandom(size))
+            linux = SshTask('bench', 0, 'linux', '', [(source, 'file.bin')],
+                    [('file.bin', received)], run)
+            windows = WinrmTask('bench', 0, 'windows', '',
+                    [(source, 'C:\\file.bin')], [], run)
+            results = [('sftp send', measure(linux.send_files, args.repeat)),
+                    ('sftp recv', measure(linux.recv_artifacts, args.repeat)),
+                    ('winrm http send', measure(windows.send_files,
+                        args.repeat)),
+                    ('winrm push', measure(lambda: windows.push_artifact(
+                        'C:\\file.bin', received), args.repeat))]
+            for chunk in [int(c) for c in args.chunks.split(',')]:
+                if size / chunk > args.max_round_trips:
+                    continue
+                results.append(('winrm base64 send {}'.format(chunk),
+                    measure(lambda: push_chunks(windows, source,
+                        'C:\\chunks.bin', chunk), 1)))
+                results.append(('winrm base64 recv {}'.format(chunk),
+                    measure(lambda: pull_chunks(windows, 'C:\\file.bin',
+                        received, chunk), 1)))
+            windows.close()
+            for name, duration in results:
+                print('{:>10} {:<24} {:>10.3f} {:>10.2f}'.format(size, name,
+                    duration, size / duration / 1024 / 1024))
+
+        files = []
+        for i in range(args.small_files):
+            source = os.path.join(host, 'small{}'.format(i))
+            with open(source, 'wb') as f:
+                f.write(os.urandom(4096))
+            files.append((source, 'small{}'.format(i)))
+        print()
+        print('{:>10} {:<24} {:>10}'.format('files', 'transfer', 'seconds'))
+        for channels in sorted({1, args.channels}):
+            run.config.conf['linux']['sftp_channels'] = channels
+            linux = SshTask('bench', 0, 'linux', '', files, [], run)
+            print('{:>10} {:<24} {:>10.3f}'.format(len(files),
+                'sftp send {} channels'.format(channels),
+                measure(linux.send_files, args.repeat)))
+
+        linux = SshTask('bench', 0, 'linux', '', [], [], run)
+        windows = WinrmTask('bench', 0, 'windows', '', [], [], run)
+        print()
+        print('{:<24} {:>10}'.format('command', 'ms/call'))
+        for name, function in (('ssh exec',
+                    lambda: linux.exec_action('echo moirai', Collector())),
+                ('winrm ({})'.format(args.shell),
+                    lambda: windows.run_ps('echo moirai'))):
+            print('{:<24} {:>10.1f}'.format(name,
+                measure(function, args.calls) * 1000))
+        windows.close()
+    finally:
+        run.close()
+        ssh.close()
+        win.close()
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
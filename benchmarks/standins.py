@@ -0,0 +1,573 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+""" Local stand-ins for the guests, to measure the transports without VMs.
+
+    SshStandin is an SSH server accepting any password. It runs exec requests
+    with the local shell and serves SFTP, both inside a local directory. Only
+    relative paths mean the same file to both. Like sshd, it can refuse more
+    than max_sessions channels per connection.
+
+    WinrmStandin implements the WS-Management shell operations used by
+    pywinrm. Instead of running powershell, it interprets the scripts that
+    WinrmTask sends (recv_script, upload_script, send_script, http_script
+    and del_script) against a local directory, both when they are run one
+    per shell and when they are fed to a runspace.
+"""
+
+import base64
+import hashlib
+import http.client
+import http.server
+import os
+import re
+import shutil
+import socket
+import subprocess
+import threading
+import time
+import urllib.request
+import uuid
+import xml.etree.ElementTree as ET
+from collections import deque
+
+import paramiko
+from lib import bundle
+
+class SshStandinInterface(paramiko.ServerInterface):
+    def __init__(self, root, transport, max_sessions=0):
+        self.root = root
+        self.transport = transport
+        self.max_sessions = max_sessions
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind != 'session':
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        # Like the MaxSessions of sshd, counting the channels still open
+        if (self.max_sessions and len(self.transport._channels.values())
+                >= self.max_sessions):
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        # Only tells whether the destination accepts connections, which is
+        # all the readiness conditions need
+        try:
+            socket.create_connection(destination, 1).close()
+        except OSError:
+            return paramiko.OPEN_FAILED_CONNECT_FAILED
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.execute,
+                args=(channel, command.decode('utf-8')))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    @staticmethod
+    def pump(source, send):
+        while True:
+            data = source.read1(32768)
+            if not data:
+                return
+            send(data)
+
+    @staticmethod
+    def feed(channel, process):
+        try:
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                process.stdin.write(data)
+            process.stdin.close()
+        except OSError:
+            pass
+
+    def execute(self, channel, command):
+        # Like sshd, the shell leads a session of its own
+        process = subprocess.Popen(command, shell=True, cwd=self.root,
+                start_new_session=True,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        thread = threading.Thread(target=self.feed, args=(channel, process))
+        thread.daemon = True
+        thread.start()
+        thread = threading.Thread(target=self.pump,
+                args=(process.stderr, channel.sendall_stderr))
+        thread.daemon = True
+        thread.start()
+        try:
+            self.pump(process.stdout, channel.sendall)
+            thread.join()
+            status = process.wait()
+            if status < 0:
+                # Killed by a signal, reported like a shell does
+                status = 128 - status
+            channel.send_exit_status(status)
+            channel.close()
+        except (EOFError, OSError):
+            # The client closed its connection before reading everything
+            process.wait()
+
+
+class StandinHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                    os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class StandinSftp(paramiko.SFTPServerInterface):
+    """SFTP server whose root is a local directory.
+
+    Opening and looking up files takes latency seconds, like a round trip
+    to a remote guest would.
+    """
+
+    def __init__(self, server, root, latency):
+        super().__init__(server)
+        self.root = root
+        self.latency = latency
+
+    def local(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def open(self, path, flags, attr):
+        time.sleep(self.latency)
+        path = self.local(path)
+        try:
+            fd = os.open(path, flags, getattr(attr, 'st_mode', None) or 0o666)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        f = os.fdopen(fd, mode)
+        handle = StandinHandle(flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def stat(self, path):
+        time.sleep(self.latency)
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        path = self.local(path)
+        try:
+            ret = []
+            for name in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(
+                        os.stat(os.path.join(path, name)))
+                attr.filename = name
+                ret.append(attr)
+            return ret
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path):
+        try:
+            os.remove(self.local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self.local(oldpath), self.local(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self.local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.local(path), attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class SshStandin:
+    """SSH and SFTP server on localhost standing in for a linux guest."""
+
+    def __init__(self, root, latency=0, max_sessions=0):
+        self.root = root
+        self.latency = latency
+        self.max_sessions = max_sessions
+        self.key = paramiko.RSAKey.generate(2048)
+        self.transports = []
+        self.socket = socket.socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('localhost', 0))
+        self.socket.listen(16)
+        self.port = self.socket.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                    StandinSftp, self.root, self.latency)
+            transport.start_server(server=SshStandinInterface(self.root,
+                transport, self.max_sessions))
+            self.transports.append(transport)
+
+    def close(self):
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class StandinCommand:
+    """A command running in a shell of the WinRM stand-in."""
+
+    def __init__(self, standin, command):
+        self.standin = standin
+        self.condition = threading.Condition()
+        self.output = deque()
+        self.done = False
+        self.code = 0
+        self.stdin = b''
+        self.status = 0
+        match = re.search(r'-encodedcommand (\S+)', command, re.I)
+        if match:
+            script = base64.b64decode(match.group(1)).decode('utf-16-le')
+            thread = threading.Thread(target=self.run_script, args=(script,))
+            thread.daemon = True
+            thread.start()
+
+    def write(self, stream, data):
+        with self.condition:
+            if data:
+                self.output.append((stream, data))
+            self.condition.notify_all()
+
+    def finish(self, code):
+        with self.condition:
+            self.done = True
+            self.code = code
+            self.condition.notify_all()
+
+    def run_script(self, script):
+        out, err, code = self.standin.interpret(script)
+        self.write('stdout', out)
+        if err:
+            # Like powershell -encodedcommand, errors are serialized
+            err = ('#< CLIXML\r\n<Objs Version="1.1.0.1" xmlns="http://'
+                    'schemas.microsoft.com/powershell/2004/04"><S S="Error">'
+                    '{}_x000D__x000A_</S></Objs>').format(
+                            err.decode('utf-8')).encode('utf-8')
+        self.write('stderr', err)
+        self.finish(code)
+
+    def send(self, data, end):
+        """Feeds the standard input of a runspace, one line at a time."""
+        self.stdin += data
+        lines = self.stdin.split(b'\n')
+        self.stdin = lines[-1]
+        for line in lines[:-1]:
+            self.run_line(line.decode('utf-8').strip())
+        if end:
+            self.finish(0)
+
+    def run_line(self, line):
+        wrapped = re.match(r'Invoke-Expression \(\[Text\.Encoding\]::Unicode'
+                r'\.GetString\(\[Convert\]::FromBase64String\("([^"]*)"\)\)\)$',
+                line)
+        marker = re.match(r'\[Console\]::(Out|Error)\.WriteLine\("`n([\w-]+)',
+                line)
+        if line == '' or line.startswith('$global:LASTEXITCODE') \
+                or '$global:moiraiHome' in line \
+                or line.startswith('$moiraiStatus'):
+            return
+        if marker and marker.group(1) == 'Out':
+            self.write('stdout', '\r\n{} {}\r\n'.format(marker.group(2),
+                self.status).encode('ascii'))
+        elif marker:
+            self.write('stderr', '\r\n{}\r\n'.format(marker.group(2))
+                    .encode('ascii'))
+        else:
+            if wrapped:
+                line = base64.b64decode(wrapped.group(1)).decode('utf-16-le')
+            out, err, self.status = self.standin.interpret(line)
+            self.write('stdout', out)
+            self.write('stderr', err)
+
+    def receive(self, timeout):
+        with self.condition:
+            if not self.output and not self.done:
+                self.condition.wait(timeout)
+            output = list(self.output)
+            self.output.clear()
+            return output, self.done, self.code
+
+
+class WinrmHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    envelope = ('<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" '
+            'xmlns:a="http://schemas.xmlsoap.org/ws/2004/08/addressing" '
+            'xmlns:w="http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd" '
+            'xmlns:rsp="http://schemas.microsoft.com/wbem/wsman/1/windows/shell">'
+            '<s:Header><a:RelatesTo>{message_id}</a:RelatesTo></s:Header>'
+            '<s:Body>{body}</s:Body></s:Envelope>')
+    state = 'http://schemas.microsoft.com/wbem/wsman/1/windows/shell/CommandState/'
+
+    def log_message(self, format, *args):
+        pass
+
+    @staticmethod
+    def find(root, suffix):
+        for node in root.iter():
+            if node.tag.endswith(suffix):
+                return node
+        return None
+
+    def do_POST(self):
+        standin = self.server.standin
+        request = ET.fromstring(self.rfile.read(int(self.headers['Content-Length'])))
+        action = self.find(request, 'Action').text.rsplit('/', 1)[-1]
+        message_id = self.find(request, 'MessageID').text
+        shell_id = None
+        for node in request.iter():
+            if node.get('Name') == 'ShellId':
+                shell_id = node.text
+        command_id = None
+        for node in request.iter():
+            if node.get('CommandId'):
+                command_id = node.get('CommandId')
+
+        body = ''
+        if action == 'Create':
+            shell_id = str(uuid.uuid4()).upper()
+            standin.shells[shell_id] = {}
+            body = ('<w:Selector Name="ShellId">{}</w:Selector>'
+                    .format(shell_id))
+        elif action == 'Command':
+            command_id = str(uuid.uuid4()).upper()
+            standin.shells[shell_id][command_id] = StandinCommand(standin,
+                    self.find(request, 'Command').text)
+            body = ('<rsp:CommandResponse><rsp:CommandId>{}</rsp:CommandId>'
+                    '</rsp:CommandResponse>'.format(command_id))
+        elif action == 'Send':
+            stream = self.find(request, 'Stream')
+            standin.shells[shell_id][command_id].send(
+                    base64.b64decode(stream.text or ''),
+                    stream.get('End') == 'true')
+            body = '<rsp:SendResponse/>'
+        elif action == 'Receive':
+            command = standin.shells[shell_id][command_id]
+            output, done, code = command.receive(standin.receive_timeout)
+            body = '<rsp:ReceiveResponse>'
+            for stream, data in output:
+                body += ('<rsp:Stream Name="{}" CommandId="{}">{}</rsp:Stream>'
+                        .format(stream, command_id,
+                            base64.b64encode(data).decode('ascii')))
+            if done:
+                body += ('<rsp:CommandState CommandId="{}" State="{}Done">'
+                        '<rsp:ExitCode>{}</rsp:ExitCode></rsp:CommandState>'
+                        .format(command_id, self.state, code))
+            else:
+                body += ('<rsp:CommandState CommandId="{}" State="{}Running"/>'
+                        .format(command_id, self.state))
+            body += '</rsp:ReceiveResponse>'
+        elif action == 'Signal':
+            standin.shells[shell_id].pop(command_id, None)
+            body = '<rsp:SignalResponse/>'
+        elif action == 'Delete':
+            standin.shells.pop(shell_id, None)
+
+        data = self.envelope.format(message_id=message_id, body=body)
+        data = data.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/soap+xml;charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class WinrmStandin:
+    """WinRM server on localhost standing in for a windows guest."""
+    receive_timeout = 1
+
+    def __init__(self, root):
+        self.root = root
+        self.shells = {}
+        self.httpd = http.server.ThreadingHTTPServer(('localhost', 0),
+                WinrmHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.standin = self
+        self.port = self.httpd.server_address[1]
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def local(self, path):
+        """Maps a windows path of the guest to the local directory."""
+        path = re.sub(r'^[A-Za-z]:', '', path).replace('\\', '/')
+        return os.path.join(self.root, path.lstrip('/'))
+
+    @staticmethod
+    def names(script):
+        """Returns the quoted paths of the array at the start of a script."""
+        names = re.search(r'@\((.*)\)', script).group(1)
+        return [n.replace("''", "'") for n in
+                re.findall(r"'((?:[^']|'')*)'", names)]
+
+    def interpret(self, script):
+        """Emulates a script of WinrmTask, returns (stdout, stderr, code)."""
+        location = re.search(r'\$filePath = "(.*)"', script)
+        if location:
+            location = self.local(location.group(1))
+        try:
+            if 'ToBase64String' in script:
+                chunk = int(re.search(r'New-Object byte\[\] (\d+)', script).group(1))
+                offset = int(re.search(r'\$reader\.Position = (\d+)', script).group(1))
+                with open(location, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(chunk)
+                return base64.b64encode(data) + b'\r\n', b'', 0
+            if 'Test-Path -LiteralPath ($root' in script:
+                probe = re.search(r"\(\$root \+ '(.*)'\)", script).group(1)
+                for root in self.names(script):
+                    if os.path.exists(self.local(root + probe)):
+                        return root.encode('utf-8') + b'\r\n', b'', 0
+                return b'', b'', 0
+            if 'Copy-Item' in script:
+                for source, destination in re.findall(r"Copy-Item -LiteralPath "
+                        r"'((?:[^']|'')*)' -Destination '((?:[^']|'')*)'", script):
+                    shutil.copyfile(self.local(source.replace("''", "'")),
+                            self.local(destination.replace("''", "'")))
+                return b'', b'', 0
+            if 'SHA256]::Create()' in script:
+                out = b''
+                for name in self.names(script):
+                    if os.path.isfile(self.local(name)):
+                        with open(self.local(name), 'rb') as f:
+                            out += '{} {}\r\n'.format(hashlib.sha256(
+                                f.read()).hexdigest(), name).encode('utf-8')
+                return out, b'', 0
+            if 'Net.Sockets.TcpClient' in script:
+                host, port = re.search(r"Connect\('(.*)', (\d+)\)",
+                        script).groups()
+                try:
+                    socket.create_connection((host, int(port)), 1).close()
+                    return b'True\r\n', b'', 0
+                except OSError:
+                    return b'False\r\n', b'', 0
+            if script.strip().startswith('Test-Path -LiteralPath '):
+                path = self.names('@(' + script.strip()[23:] + ')')[0]
+                return str(os.path.exists(self.local(path))).encode('utf-8') \
+                        + b'\r\n', b'', 0
+            if 'CompressionMode]::Decompress' in script:
+                url = re.search(r'DownloadFile\("(.*?)"', script).group(1)
+                with urllib.request.urlopen(url) as f:
+                    bundle.unpack(f, self.local)
+                return b'', b'', 0
+            if 'CompressionMode]::Compress' in script:
+                names = self.names(script)
+                name = 'moirai-{}.bundle'.format(uuid.uuid4().hex)
+                with open(self.local(name), 'wb') as f:
+                    bundle.pack(f, [(self.local(n), n) for n in names])
+                return 'C:\\{}\r\n'.format(name).encode('utf-8'), b'', 0
+            if 'WebRequest]::Create' in script:
+                url = re.search(r'WebRequest\]::Create\("(.*)"\)', script).group(1)
+                host, path = url[len('http://'):].split('/', 1)
+                offset = int(re.search(r'\$reader\.Position = (\d+)',
+                    script).group(1))
+                with open(location, 'rb') as f:
+                    f.seek(offset)
+                    conn = http.client.HTTPConnection(host)
+                    conn.request('PUT', '/' + path, body=f, headers={
+                        'Content-Length': str(os.fstat(f.fileno()).st_size
+                            - offset)})
+                    status = conn.getresponse().status
+                    conn.close()
+                return b'', b'', 0 if status == 200 else 1
+            if 'DownloadFile' in script:
+                for url, destination in re.findall(
+                        r'DownloadFile\("(.*?)", "(.*?)"\)', script):
+                    urllib.request.urlretrieve(url, self.local(destination))
+                return b'', b'', 0
+            if 'FromBase64String($s)' in script:
+                content = re.search(r'@"\n(.*)\n"@', script, re.S).group(1)
+                with open(location, 'ab') as f:
+                    f.write(base64.b64decode(content))
+                return b'', b'', 0
+            if 'Remove-Item $filePath' in script:
+                if os.path.exists(location):
+                    os.remove(location)
+                return b'', b'', 0
+            words = script.strip().split(' ', 1)
+            if words[0].lower() in ('echo', 'write-output'):
+                return (words[1:] or [''])[0].encode('utf-8') + b'\r\n', b'', 0
+            if words[0].lower() == 'write-error':
+                return b'', (words[1:] or [''])[0].encode('utf-8'), 1
+        except (OSError, AttributeError, EOFError, ValueError) as err:
+            return b'', str(err).encode('utf-8'), 1
+        return b'', 'Not emulated: {}'.format(script).encode('utf-8'), 1
@@ -0,0 +1,156 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+""" Bundles move the files or the artifacts of a task as one compressed stream.
+
+    Linux guests unpack and pack them with tar, so their bundles are gzipped
+    tar archives whose members are named after their destination. Windows
+    guests have no tar but have GZipStream: their bundles are gzipped records
+    that powershell reads and writes with BinaryReader and BinaryWriter. The
+    stream starts with the number of files as a little-endian int32, then
+    for each file: the length of its name as an int32, its UTF-8 name, its
+    size as an int64 and its content.
+"""
+
+import gzip
+import os
+import struct
+import tarfile
+
+compress_level = 6
+buffer_size = 64 * 1024
+
+class Counter:
+    """Wraps a file object, counting the bytes that go through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.fileobj.write(data)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.count += len(data)
+        return data
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def copy(source, destination, size):
+    """Copies exactly size bytes from source to destination."""
+    while size > 0:
+        data = source.read(min(buffer_size, size))
+        if not data:
+            raise EOFError('Truncated bundle')
+        destination.write(data)
+        size -= len(data)
+
+def read_exactly(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise EOFError('Truncated bundle')
+    return data
+
+def pack(fileobj, files):
+    """Writes files, a list of (local path, name), as a bundle to fileobj.
+
+    Returns the total size of the files.
+    """
+    total = 0
+    with gzip.GzipFile(fileobj=fileobj, mode='wb',
+            compresslevel=compress_level) as gz:
+        gz.write(struct.pack('<i', len(files)))
+        for path, name in files:
+            name = name.encode('utf-8')
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                gz.write(struct.pack('<i', len(name)) + name
+                        + struct.pack('<q', size))
+                copy(f, gz, size)
+            total += size
+    fileobj.flush()
+    return total
+
+def unpack(fileobj, destination):
+    """Extracts a bundle from fileobj.
+
+    destination maps the name of every file to the local path it is written
+    to. Returns the list of the (name, size) extracted.
+    """
+    ret = []
+    with gzip.GzipFile(fileobj=fileobj, mode='rb') as gz:
+        count, = struct.unpack('<i', read_exactly(gz, 4))
+        for i in range(count):
+            length, = struct.unpack('<i', read_exactly(gz, 4))
+            name = read_exactly(gz, length).decode('utf-8')
+            size, = struct.unpack('<q', read_exactly(gz, 8))
+            path = destination(name)
+            if path is None:
+                raise ValueError('Unexpected file in bundle: ' + name)
+            with open(path, 'wb') as f:
+                copy(gz, f, size)
+            ret.append((name, size))
+    return ret
+
+def tar(fileobj, files):
+    """Writes files, a list of (local path, destination), as a tar.gz archive.
+
+    Members keep their absolute destination, to be extracted with tar -P.
+    Returns the total size of the files.
+    """
+    total = 0
+    gz = gzip.GzipFile(fileobj=fileobj, mode='wb',
+            compresslevel=compress_level)
+    with tarfile.open(fileobj=gz, mode='w|',
+            format=tarfile.GNU_FORMAT) as archive:
+        for path, destination in files:
+            info = archive.gettarinfo(path)
+            info.name = destination
+            info.uid = info.gid = 0
+            info.uname = info.gname = ''
+            with open(path, 'rb') as f:
+                archive.addfile(info, f)
+            total += info.size
+    gz.close()
+    fileobj.flush()
+    return total
+
+def untar(fileobj, destinations):
+    """Extracts the files of a tar.gz archive read from fileobj.
+
+    destinations maps the paths that were archived to the local paths they
+    are written to, other members are ignored. Returns the list of the
+    (path, size) extracted.
+    """
+    paths = {os.path.normpath(k): k for k in destinations}
+    ret = []
+    with tarfile.open(fileobj=fileobj, mode='r|gz') as archive:
+        for info in archive:
+            path = paths.get(os.path.normpath(info.name))
+            if not info.isfile() or path is None:
+                continue
+            with open(destinations[path], 'wb') as f:
+                copy(archive.extractfile(info), f, info.size)
+            ret.append((path, info.size))
+    return ret
@@ -18,6 +18,7 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import sys
 from collections import OrderedDict
 from . import utils
 
@@ -28,10 +29,40 @@ class Configuration:
         self.forwards = {}
         self.next_port = 2000
         self.tasks = OrderedDict()
+        self.transfers = OrderedDict()
+        self.warmup = 0
+        self.grace = 30
+
+    # Machine options taking one of a few values
+    choices = {'winrm_shell': ('none', 'task', 'machine'),
+            'transport': ('ssh', 'winrm', 'fake'),
+            'synced_folder': ('auto', 'off')}
+    # Numeric machine options: type, minimum and maximum
+    numbers = {'max_concurrent_tasks': (int, 1, None),
+            'sftp_channels': (int, 1, None),
+            'fake_latency': (float, 0, None),
+            'fake_bandwidth': (float, 0, None),
+            'fake_failure_rate': (float, 0, 1)}
 
     def add_option(self, machine, option, value):
         if not machine in self.conf:
             self.conf[machine] = {}
+        if option in self.choices and not value in self.choices[option]:
+            print('Invalid {} "{}" for machine {}'.format(option, value, machine))
+            print('Expected one of:', ', '.join(self.choices[option]))
+            sys.exit(1)
+        if option in self.numbers:
+            kind, minimum, maximum = self.numbers[option]
+            try:
+                value = kind(value)
+                if value < minimum:
+                    raise ValueError('must be at least {}'.format(minimum))
+                if maximum is not None and value > maximum:
+                    raise ValueError('must be at most {}'.format(maximum))
+            except ValueError as err:
+                print('Invalid {} for machine {}'.format(option, machine))
+                print(err)
+                sys.exit(1)
         self.conf[machine][option] = value
 
     def add_forwards(self):
@@ -50,23 +81,133 @@ class Configuration:
             # TODO: parse additional redirects
 
     def add_task(self, task, conf, timing):
+        if not conf.get('target') in self.conf:
+            print('Task', task, 'does not target a machine of the cluster')
+            sys.exit(1)
+        try:
+            after = utils.parse_after(conf.get('after', ''))
+        except Exception as err:
+            print('Could not parse the prerequisites of task', task)
+            print('A prerequisite is a task, optionally followed by a delay: task +10s')
+            print(err)
+            sys.exit(1)
+        # A task started by its prerequisites has no timing of its own
+        # unless given one, and does not move the timing of the next tasks
+        previous = timing
+        if after and not 'timing' in conf:
+            timing = 0
+        else:
+            try:
+                timing = utils.parse_timing(conf.get('timing', '+0s'), timing)
+            except Exception as err:
+                print('Could not parse the timing for task', task)
+                print(err)
         try:
-            timing = utils.parse_timing(conf.get('timing', '+0s'), timing)
+            self.transfers[task] = {
+                    'files': utils.parse_transfers(conf.get('files', '')),
+                    'artifacts': utils.parse_transfers(conf.get('artifacts', ''))}
         except Exception as err:
-            print('Could not parse the timing for task', task)
+            print('Could not parse the files or artifacts of task', task)
+            print('A file is either a path or in this form: source -> destination')
+            print(err)
+            sys.exit(1)
+        try:
+            self.transfers[task]['bundle'] = conf.getboolean('bundle', False)
+        except ValueError as err:
+            print('Invalid bundle for task', task)
             print(err)
+            sys.exit(1)
+        wait_for, wait_timeout = self.parse_conditions(task, conf)
 
         self.tasks[task] = {'target': conf['target'],
                 'actions': conf.get('actions', ''),
                 'timing': timing,
+                'after': after,
+                'wait_for': wait_for,
+                'wait_timeout': wait_timeout,
                 'files': conf.get('files', ''),
                 'artifacts': conf.get('artifacts', '')}
+        if after and not 'timing' in conf:
+            return previous
         return timing
 
+    def parse_conditions(self, task, conf):
+        """Returns the readiness conditions of a task and their timeout."""
+        try:
+            conditions = utils.parse_conditions(conf.get('wait_for', ''))
+            timeout = utils.parse_timing(conf.get('wait_timeout', '5m'), 0)
+        except Exception as err:
+            print('Could not parse the readiness conditions of task', task)
+            print('A condition is either "port N", "port N on machine" or "file path"')
+            print(err)
+            sys.exit(1)
+        target = conf['target']
+        for kind, value, machine in conditions:
+            if machine is None or machine == target:
+                continue
+            if not machine in self.conf:
+                print('Task', task, 'waits for', machine,
+                        'which is not a machine of the cluster')
+                sys.exit(1)
+            if (self.transport(target) != 'fake'
+                    and self.conf[machine].get('ip', 'dhcp') == 'dhcp'):
+                print('Task', task, 'waits for a port of', machine,
+                        'which has no fixed ip')
+                sys.exit(1)
+        return conditions, timeout
+
+    def check_dependencies(self):
+        """Checks that the prerequisites of each task exist, without cycles."""
+        for task, items in self.tasks.items():
+            for name, _ in items['after']:
+                if not name in self.tasks:
+                    print('Task', task, 'runs after', name,
+                            'which is not a task of the scenario')
+                    sys.exit(1)
+        # Depth first search, a task met again on the current path is a cycle
+        done = set()
+        for task in self.tasks:
+            path = []
+            stack = [(task, iter(self.tasks[task]['after']))]
+            while stack:
+                current, prerequisites = stack[-1]
+                if not path or path[-1] != current:
+                    path.append(current)
+                for name, _ in prerequisites:
+                    if name in path:
+                        print('Tasks wait for each other:',
+                                ' -> '.join(path[path.index(name):] + [name]))
+                        sys.exit(1)
+                    if not name in done:
+                        stack.append((name, iter(self.tasks[name]['after'])))
+                        break
+                else:
+                    stack.pop()
+                    path.pop()
+                    done.add(current)
+
     def reorder_tasks(self):
         self.tasks = OrderedDict(sorted(self.tasks.items(),
             key=lambda x: x[1]['timing']))
 
+    def transport(self, machine):
+        """Returns the name of the transport used to reach machine."""
+        if 'transport' in self.conf[machine]:
+            return self.conf[machine]['transport']
+        if self.conf[machine].get('guest', 'linux') == 'windows':
+            return 'winrm'
+        return 'ssh'
+
+    def vagrant_machines(self):
+        """Returns the machines managed by vagrant, that is the real ones."""
+        return [machine for machine in self.conf
+                if self.transport(machine) != 'fake']
+
+    def transports(self):
+        """Returns the transports used by the tasks of the scenario."""
+        return sorted(set(self.transport(items['target'])
+            for items in self.tasks.values()))
+
     def add_duration(self, duration):
         try:
             self.duration = utils.parse_timing(duration, 0)
@@ -74,6 +215,22 @@ class Configuration:
             print('Could not parse the duration of the scenario')
             print(err)
 
+    def add_warmup(self, warmup):
+        try:
+            self.warmup = utils.parse_timing(warmup, 0)
+        except Exception as err:
+            print('Could not parse the warmup of the scenario')
+            print(err)
+            sys.exit(1)
+
+    def add_grace(self, grace):
+        try:
+            self.grace = utils.parse_timing(grace, 0)
+        except Exception as err:
+            print('Could not parse the grace period of the scenario')
+            print(err)
+            sys.exit(1)
+
     def forward_default(self, machine, is_windows):
         ret = ''
         if is_windows:
@@ -105,7 +262,7 @@ class Configuration:
             f.write('# -*- mode: ruby -*-\n')
             f.write('# vi: set ft=ruby :\n\n')
             f.write('Vagrant.configure("2") do |config|\n\n')
-            for machine in self.conf:
+            for machine in self.vagrant_machines():
                 winrm = False
                 conf = self.conf[machine]
                 f.write('  config.vm.define "%s" do |%s|\n'
@@ -0,0 +1,252 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import traceback
+
+# The options of play that the daemon honours
+play_options = ('repeat', 'reset', 'snapshot', 'parallelism', 'boot_timeout',
+        'workers', 'log_dir', 'force_send', 'profile')
+
+def socket_path(config_path):
+    return os.path.join(os.path.dirname(os.path.abspath(config_path)),
+            '.moirai', 'moirai.sock')
+
+def request(config_path, message):
+    """Sends message to the daemon serving config_path and returns its answer.
+
+    Returns None if no daemon is serving it. A play request is answered once
+    the scenario is played.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            s.connect(socket_path(config_path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        s.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        with s.makefile('rb') as f:
+            line = f.readline()
+    finally:
+        s.close()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+def play_request(args):
+    message = {'command': 'play', 'config': os.path.abspath(args.config)}
+    for option in play_options:
+        message[option] = getattr(args, option)
+    message['log_dir'] = os.path.abspath(args.log_dir)
+    return message
+
+def print_status(status):
+    print('Config:', status['config'])
+    print('Connected to:', ', '.join(status['connected']) or 'no machine')
+    if status['state'] != 'playing':
+        print('Idle')
+        return
+    print('Playing for {:.1f}s, logs in {}'.format(status['elapsed'],
+        status['log_dir']))
+    print('{} of {} tasks finished'.format(status['finished'],
+        status['tasks']))
+    print('Running:', ', '.join(status['running']) or 'no task')
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            response = {'error': 'Invalid request'}
+        else:
+            response = self.server.daemon.handle(message)
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class Daemon:
+    """Plays the scenario on request, keeping a run between the requests.
+
+    The connections to the machines and the file server of the run are set
+    up once, when the daemon starts, and reused by every play request. They
+    are only set up again when the sections of the machines change. Requests come as
+    JSON lines over a Unix socket next to the configuration file.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.path = socket_path(args.config)
+        self.lock = threading.Lock()
+        self.config = None
+        self.run = None
+        self.key = None
+        self.playing = None
+        self.server = None
+        self.thread = None
+
+    def listen(self):
+        """Warms up the run and listens to requests."""
+        from . import vagrant
+
+        self.config, self.key = self.load(self.args)
+        self.run = self.new_run(self.config, self.args)
+        machines = self.config.vagrant_machines()
+        vagrant.for_each_machine(self.run.pool.connect, machines, 8)
+        self.run.file_server()
+        self.run.finish()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = socketserver.ThreadingUnixStreamServer(self.path,
+                RequestHandler)
+        self.server.daemon_threads = True
+        self.server.daemon = self
+        return self
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        """Serves the requests in a thread of its own."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def close(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread = None
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if self.run is not None:
+            self.run.cancel()
+            self.run.close()
+
+    @staticmethod
+    def load(args):
+        from . import plan
+
+        return plan.load(args), plan.digest(args.config)
+
+    @staticmethod
+    def new_run(config, args):
+        from .run import Run
+
+        return Run(config, args.log_dir,
+                manifest_dir=os.path.join(os.path.dirname(
+                    os.path.abspath(args.config)), '.moirai', 'manifests'),
+                share_dir=args.target)
+
+    @staticmethod
+    def machines(config):
+        """Returns what the connections to the machines depend on."""
+        return [(machine, config.conf[machine], config.forwards.get(machine))
+                for machine in config.vagrant_machines()]
+
+    def handle(self, message):
+        command = message.get('command')
+        if command == 'play':
+            return self.play(message)
+        if command == 'status':
+            return self.status()
+        if command == 'stop':
+            return self.stop()
+        return {'error': 'Unknown command: {}'.format(command)}
+
+    def play(self, message):
+        from . import parser
+
+        if message.get('config') != os.path.abspath(self.args.config):
+            return {'error': 'The daemon serves {}'.format(
+                os.path.abspath(self.args.config))}
+        with self.lock:
+            if self.playing is not None:
+                return {'error': 'The scenario is already playing'}
+            self.playing = {'started': time.monotonic(),
+                    'log_dir': message['log_dir']}
+            self.run.reset()
+        try:
+            args = argparse.Namespace(**vars(self.args))
+            for option in play_options:
+                setattr(args, option, message[option])
+            config, key = self.load(args)
+            if key != self.key:
+                if self.machines(config) == self.machines(self.config):
+                    # Only the scenario changed, the connections still hold
+                    self.run.config = self.run.pool.config = config
+                else:
+                    print('The machines changed, connecting again')
+                    stopped = self.run.cancelled
+                    self.run.close()
+                    self.run = self.new_run(config, args)
+                    self.run.finish()
+                    if stopped:
+                        self.run.cancel()
+                self.config, self.key = config, key
+            self.run, status = parser.replay(self.config, args, self.run)
+            return {'status': status, 'log_dir': args.log_dir}
+        except SystemExit:
+            return {'error': 'Invalid configuration'}
+        except Exception as err:
+            traceback.print_exc()
+            return {'error': str(err)}
+        finally:
+            with self.lock:
+                self.playing = None
+
+    def status(self):
+        run = self.run
+        with run.pool.lock:
+            connected = sorted(set(machine for machine, transports
+                    in run.pool.transports.items() if transports)
+                    | set(run.pool.sessions))
+        ret = {'state': 'idle',
+                'config': os.path.abspath(self.args.config),
+                'connected': connected}
+        with self.lock:
+            playing = self.playing
+        if playing is None:
+            return ret
+        scheduler = run.scheduler
+        with run.lock:
+            running = sorted(task.task for task in run.tasks)
+        ret.update({'state': 'playing',
+            'elapsed': time.monotonic() - playing['started'],
+            'log_dir': playing['log_dir'],
+            'running': running,
+            'finished': scheduler.finished if scheduler else 0,
+            'tasks': len(self.config.tasks)})
+        return ret
+
+    def stop(self):
+        with self.lock:
+            playing = self.playing
+        if playing is None:
+            return {'status': 'Nothing to stop'}
+        self.run.cancel()
+        return {'status': 'Stopping'}
@@ -0,0 +1,108 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import random
+import time
+from .task import Task
+
+class FakeError(Exception):
+    pass
+
+
+class FakeTask(Task):
+    """Task on a machine that does not exist, for tests and benchmarks.
+
+    Every round trip to the machine takes fake_latency seconds, files and
+    artifacts move at fake_bandwidth bytes per second (0 meaning no limit)
+    and every round trip fails with a probability of fake_failure_rate.
+    Actions of the form "sleep N" last N seconds, the others are echoed.
+    Every port is open and the only files are those sent to the machine.
+    """
+    protocol = 'Fake'
+
+    def __init__(self, task, number, target, actions, files, artifacts, run,
+            bundle=False):
+        super().__init__(task, number, target, actions, files, artifacts, run,
+                bundle)
+        conf = run.config.conf[target]
+        self.latency = conf.get('fake_latency', 0)
+        self.bandwidth = conf.get('fake_bandwidth', 0)
+        self.failure_rate = conf.get('fake_failure_rate', 0)
+        self.random = random.Random(task)
+
+    def round_trip(self, size=0):
+        delay = self.latency
+        if self.bandwidth:
+            delay += size / self.bandwidth
+        if delay:
+            self.run.stopped.wait(delay)
+        if self.random.random() < self.failure_rate:
+            raise FakeError('Injected failure')
+
+    def send_files(self):
+        try:
+            for filename, destination in self.pending_files():
+                start = time.monotonic()
+                self.round_trip(os.path.getsize(filename))
+                self.file_sent(filename, destination,
+                        duration=time.monotonic() - start)
+        except:
+            print('[{}] Fake error while sending files'.format(self.task))
+            raise
+
+    def remote_hashes(self, destinations):
+        # Files are never altered on a fake machine
+        self.round_trip()
+        return {destination: self.run.manifests.recorded(self.target,
+            destination) for destination in destinations}
+
+    def port_open(self, host, port):
+        # Every service of a fake machine is up
+        self.round_trip()
+        return True
+
+    def file_exists(self, path):
+        # The only files of a fake machine are those it was sent
+        self.round_trip()
+        return self.run.manifests.recorded(self.target, path) is not None
+
+    def recv_artifacts(self):
+        try:
+            for filename, destination in self.artifacts:
+                start = time.monotonic()
+                self.round_trip()
+                self.emit('artifact_received', artifact=filename,
+                        destination=destination,
+                        bytes=0,
+                        duration=time.monotonic() - start,
+                        method='fake')
+        except:
+            print('[{}] Fake error while retrieving artifacts'.format(self.task))
+            raise
+
+    def exec_action(self, line, output):
+        self.round_trip()
+        words = line.split()
+        if len(words) == 2 and words[0] == 'sleep':
+            self.run.stopped.wait(float(words[1]))
+        else:
+            output.write('stdout', line.encode('utf-8') + b'\n')
+        return 0
@@ -0,0 +1,237 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import http.server
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+
+class Upload:
+    """An artifact that a guest is expected to push to the host.
+
+    The guest sends what follows offset, which replaces what destination
+    holds after offset.
+    """
+
+    def __init__(self, destination, offset=0):
+        self.destination = destination
+        self.offset = offset
+        self.size = 0
+        self.duration = 0
+        # Whether the guest reached the server at all
+        self.reached = False
+        self.complete = False
+
+
+class FileServer:
+    """HTTP server on the host that the guests exchange files with.
+
+    Guests download the files declared in the scenario from it and push
+    their artifacts to it. Every shared file and every expected upload gets
+    its own unguessable URL, so that a guest can only read and write what
+    the scenario declares.
+    """
+    buffer_size = 64 * 1024
+
+    def __init__(self, port=0):
+        self.ip = socket.gethostbyname(socket.gethostname())
+        self.lock = threading.Lock()
+        self.uploads = {}
+        self.shared = {}
+        self.tokens = {}
+        # Machines whose uploads never reached the server
+        self.unreachable = set()
+        try:
+            self.httpd = http.server.ThreadingHTTPServer((self.ip, port),
+                    FileRequestHandler)
+        except OSError:
+            if port == 0:
+                raise
+            self.httpd = http.server.ThreadingHTTPServer((self.ip, 0),
+                    FileRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.file_server = self
+        self.port = self.httpd.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def close(self):
+        if self.thread is not None:
+            self.httpd.shutdown()
+            self.thread = None
+        self.httpd.server_close()
+
+    def url(self, path):
+        return 'http://{ip}:{port}/{path}'.format(ip=self.ip,
+                port=self.port,
+                path=path)
+
+    def share(self, path):
+        """Makes the local file path downloadable and returns its URL."""
+        path = os.path.abspath(path)
+        with self.lock:
+            if not path in self.tokens:
+                token = uuid.uuid4().hex
+                self.tokens[path] = token
+                self.shared[token] = path
+            token = self.tokens[path]
+        return self.url('files/{}/{}'.format(token, os.path.basename(path)))
+
+    def unshare(self, path):
+        """Stops serving the local file path."""
+        path = os.path.abspath(path)
+        with self.lock:
+            token = self.tokens.pop(path, None)
+            self.shared.pop(token, None)
+
+    def expect(self, destination, offset=0):
+        """Returns the URL to push destination to and its upload record."""
+        token = uuid.uuid4().hex
+        upload = Upload(destination, offset)
+        with self.lock:
+            self.uploads[token] = upload
+        return self.url('upload/' + token), upload
+
+    def forget(self, url):
+        with self.lock:
+            self.uploads.pop(url.rsplit('/', 1)[-1], None)
+
+    def reachable_from(self, machine):
+        """Returns False once an upload of machine did not reach the server."""
+        with self.lock:
+            return not machine in self.unreachable
+
+    def unreachable_from(self, machine):
+        with self.lock:
+            self.unreachable.add(machine)
+
+
+class FileRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    byte_range = re.compile(r'bytes=(\d*)-(\d*)$')
+
+    def log_message(self, format, *args):
+        pass
+
+    def shared_file(self):
+        """Returns the local path requested, None if it is not shared."""
+        server = self.server.file_server
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'files':
+            return None
+        with server.lock:
+            return server.shared.get(parts[1])
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        path = self.shared_file()
+        try:
+            f = open(path, 'rb')
+        except (TypeError, OSError):
+            self.send_error(404)
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            start, end = 0, size - 1
+            match = None
+            if 'Range' in self.headers:
+                match = self.byte_range.match(self.headers['Range'].strip())
+            if match and match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(end, int(match.group(2)))
+            elif match and match.group(2):
+                start = max(0, size - int(match.group(2)))
+            if match and (start > end or start >= size):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if match:
+                self.send_response(206)
+                self.send_header('Content-Range',
+                        'bytes {}-{}/{}'.format(start, end, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            if head:
+                return
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(self.server.file_server.buffer_size,
+                    remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+    def do_PUT(self):
+        server = self.server.file_server
+        parts = self.path.strip('/').split('/')
+        with server.lock:
+            upload = None
+            if len(parts) == 2 and parts[0] == 'upload':
+                upload = server.uploads.get(parts[1])
+        if upload is None:
+            self.send_error(404)
+            return
+        upload.reached = True
+        try:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+        start = time.monotonic()
+        received = 0
+        with open(upload.destination, 'r+b' if upload.offset else 'wb') as f:
+            f.seek(upload.offset)
+            f.truncate()
+            while received < length:
+                data = self.rfile.read(min(server.buffer_size,
+                    length - received))
+                if not data:
+                    break
+                f.write(data)
+                received += len(data)
+        upload.size = received
+        upload.duration = time.monotonic() - start
+        upload.complete = (received == length)
+        if not upload.complete:
+            self.close_connection = True
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
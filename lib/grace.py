@@ -0,0 +1,143 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from .run import Cancelled
+from .task import Task
+
+class Grace:
+    """Retrieves the artifacts of the tasks cut short by the end of the
+    scenario, within budget seconds.
+
+    It listens to the timeline of the run to know which artifacts were
+    already received. When the duration of the scenario elapses, the running
+    tasks are cancelled and, once they ended, their other artifacts are
+    retrieved with one thread per machine. Retrievals still going on when
+    the budget is spent are cancelled too, and kept for a later attempt.
+    """
+
+    def __init__(self, run, budget):
+        self.run = run
+        self.budget = budget
+        self.received = set()
+        self.over = threading.Event()
+        self.collected = []
+        self.missed = []
+
+    def __call__(self, record):
+        if record['event'] == 'artifact_received':
+            self.received.add((record['task'], record['artifact']))
+
+    def shutdown(self, scheduler):
+        """Cancels the running tasks and retrieves their artifacts."""
+        run = self.run
+        start = time.monotonic()
+        with run.lock:
+            tasks = sorted(run.tasks, key=lambda task: task.number)
+        print('The scenario is over, retrieving the artifacts of {} running '
+                'tasks within {}s'.format(len(tasks), self.budget))
+        run.timeline.emit('grace_started', tasks=[task.task for task in tasks],
+                budget=self.budget)
+        run.expire()
+        # Tasks that did not stop are left to the caller, as if it was stopped
+        if scheduler.wait_idle(run.cancel_timeout) and run.proceed():
+            self.collect(tasks, time.monotonic() + self.budget)
+        for task in tasks:
+            for filename, destination in task.artifacts:
+                if (task.task, filename) in self.received:
+                    self.collected.append((task.task, filename))
+                    continue
+                self.missed.append((task.task, filename))
+                run.timeline.emit('artifact_missed', task=task.task,
+                        machine=task.target,
+                        artifact=filename,
+                        destination=destination)
+        run.timeline.emit('grace_finished', collected=len(self.collected),
+                missed=len(self.missed), duration=time.monotonic() - start)
+
+    def collect(self, tasks, deadline):
+        """Retrieves the missing artifacts of tasks until deadline."""
+        machines = OrderedDict()
+        for task in tasks:
+            artifacts = [(filename, destination)
+                    for filename, destination in task.artifacts
+                    if not (task.task, filename) in self.received]
+            if artifacts:
+                machines.setdefault(task.target, []).append((task, artifacts))
+        collectors = []
+        threads = []
+        for machine, items in machines.items():
+            thread = threading.Thread(target=self.collect_machine,
+                    args=(machine, items, collectors),
+                    name='moirai-grace-' + machine)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        self.over.set()
+        if any(thread.is_alive() for thread in threads):
+            print('The grace period is over, some artifacts were not '
+                    'retrieved')
+            for collector in list(collectors):
+                collector.cancel()
+
+    def collect_machine(self, machine, items, collectors):
+        """Retrieves the artifacts of the tasks of machine one by one.
+
+        Each artifact is retrieved on its own, so that a missing one does
+        not prevent the others from being retrieved.
+        """
+        run = self.run
+        taskClass = Task.task_class(run.config.transport(machine))
+        for task, artifacts in items:
+            collector = taskClass(task.task, task.number, machine, '', [], [],
+                    run)
+            collectors.append(collector)
+            run.task_started(collector)
+            try:
+                for artifact in artifacts:
+                    if self.over.is_set():
+                        return
+                    collector.artifacts = [artifact]
+                    try:
+                        collector.recv_artifacts()
+                    except Cancelled:
+                        return
+                    except Exception as err:
+                        if run.stopped.is_set():
+                            return
+                        print('[{}] Could not retrieve {}: {}'.format(
+                            task.task, artifact[0], err))
+            finally:
+                run.task_ended(collector)
+                collector.close()
+
+    def print_summary(self):
+        """Prints which artifacts of the cut short tasks were retrieved."""
+        total = len(self.collected) + len(self.missed)
+        if not total:
+            return
+        print('Retrieved {}/{} artifacts of the tasks cut short'.format(
+            len(self.collected), total))
+        for task, filename in self.missed:
+            print('[{}] Missed {}'.format(task, filename))
@@ -0,0 +1,102 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+class Manifests:
+    """Remembers the content of the files placed on each machine.
+
+    For every machine, the manifest maps the destination of each file sent
+    to the sha256 of its content. It is kept in directory between runs, one
+    JSON file per machine, so that a file is only sent again when it changed.
+    """
+    buffer_size = 64 * 1024
+
+    def __init__(self, directory=None, force=False):
+        self.directory = directory
+        self.force = force
+        self.lock = threading.Lock()
+        self.machines = {}
+        self.hashes = {}
+        self.dirty = set()
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+
+    def path(self, machine):
+        return os.path.join(self.directory, machine + '.json')
+
+    def manifest(self, machine):
+        """Returns the manifest of machine, loading it on first use."""
+        if not machine in self.machines:
+            self.machines[machine] = {}
+            if self.directory is not None:
+                try:
+                    with open(self.path(machine)) as f:
+                        self.machines[machine] = json.load(f)
+                except (OSError, ValueError):
+                    pass
+        return self.machines[machine]
+
+    def local_hash(self, path):
+        """Returns the sha256 of a local file, hashing it once per version."""
+        stat = os.stat(path)
+        version = (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if path in self.hashes and self.hashes[path][0] == version:
+                return self.hashes[path][1]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(self.buffer_size), b''):
+                h.update(data)
+        with self.lock:
+            self.hashes[path] = (version, h.hexdigest())
+        return h.hexdigest()
+
+    def recorded(self, machine, destination):
+        """Returns the sha256 that destination on machine is believed to have."""
+        with self.lock:
+            return self.manifest(machine).get(destination)
+
+    def record(self, machine, destination, digest):
+        with self.lock:
+            self.manifest(machine)[destination] = digest
+            self.dirty.add(machine)
+
+    def skipped(self, size):
+        with self.lock:
+            self.skipped_files += 1
+            self.skipped_bytes += size
+
+    def save(self):
+        """Writes the manifests that changed."""
+        if self.directory is None:
+            return
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            for machine in self.dirty:
+                path = self.path(machine)
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(self.machines[machine], f, indent=1,
+                            sort_keys=True)
+                os.replace(path + '.tmp', path)
+            self.dirty.clear()
@@ -0,0 +1,137 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+import os
+from collections import OrderedDict
+
+class Histogram:
+    """Values observed for one metric and one set of labels."""
+    # Upper bounds of the buckets, in seconds
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+            60, 120, 300)
+
+    def __init__(self):
+        self.values = []
+
+    def observe(self, value):
+        self.values.append(value)
+
+    def quantile(self, q):
+        """Returns the nearest rank quantile q of the values."""
+        values = sorted(self.values)
+        return values[max(0, math.ceil(q * len(values)) - 1)]
+
+    def cumulative_counts(self):
+        return [(bound, sum(1 for value in self.values if value <= bound))
+                for bound in self.buckets]
+
+
+class Metrics:
+    """Collects the scheduling lateness and the phase durations of a run.
+
+    It listens to the timeline of the run. The lateness of a task is the
+    time between its timing and its first action. The phases are connect,
+    for every new connection, then send, exec and receive for every task.
+    Both are kept per machine and transport.
+    """
+    lateness_name = 'moirai_task_lateness_seconds'
+    lateness_help = 'Delay between the timing of a task and its first action'
+    phase_name = 'moirai_phase_duration_seconds'
+    phase_help = 'Duration of the phases of the tasks'
+
+    def __init__(self, config):
+        self.config = config
+        self.start = None
+        self.timings = {}
+        # (machine, transport) -> Histogram
+        self.lateness = OrderedDict()
+        # (phase, machine, transport) -> Histogram
+        self.phases = OrderedDict()
+
+    def __call__(self, record):
+        event = record['event']
+        if event == 'scenario_started':
+            self.start = record['time']
+        elif event == 'task_started':
+            self.timings[record['task']] = record['timing']
+        elif event == 'action_started' and record['task'] in self.timings:
+            timing = self.timings.pop(record['task'])
+            if self.start is not None:
+                self.observe(self.lateness, (record['machine'],
+                    self.config.transport(record['machine'])),
+                    record['time'] - self.start - timing)
+        elif event == 'connection_established':
+            self.observe(self.phases, ('connect', record['machine'],
+                record['transport']), record['duration'])
+        elif event == 'phase_finished':
+            self.observe(self.phases, (record['phase'], record['machine'],
+                self.config.transport(record['machine'])), record['duration'])
+
+    @staticmethod
+    def observe(histograms, key, value):
+        if not key in histograms:
+            histograms[key] = Histogram()
+        histograms[key].observe(value)
+
+    def print_summary(self):
+        rows = [('lateness',) + key + (histogram,)
+                for key, histogram in self.lateness.items()]
+        rows += [key + (histogram,) for key, histogram in self.phases.items()]
+        if not rows:
+            return
+        print('{:<10} {:<16} {:<10} {:>6} {:>9} {:>9} {:>9}'.format('metric',
+            'machine', 'transport', 'count', 'p50', 'p95', 'max'))
+        for metric, machine, transport, histogram in rows:
+            print('{:<10} {:<16} {:<10} {:>6} {:>8.3f}s {:>8.3f}s {:>8.3f}s'
+                    .format(metric, machine, transport, len(histogram.values),
+                        histogram.quantile(0.5), histogram.quantile(0.95),
+                        max(histogram.values)))
+
+    def write(self, path):
+        """Writes the histograms to path in the Prometheus text format."""
+        lines = []
+        for name, description, histograms, labels in (
+                (self.lateness_name, self.lateness_help, self.lateness,
+                    ('machine', 'transport')),
+                (self.phase_name, self.phase_help, self.phases,
+                    ('phase', 'machine', 'transport'))):
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} histogram'.format(name))
+            for key, histogram in histograms.items():
+                label = ','.join('{}="{}"'.format(k, escape(v))
+                        for k, v in zip(labels, key))
+                for bound, count in histogram.cumulative_counts():
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name,
+                        label, bound, count))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, label,
+                    len(histogram.values)))
+                lines.append('{}_sum{{{}}} {}'.format(name, label,
+                    sum(histogram.values)))
+                lines.append('{}_count{{{}}} {}'.format(name, label,
+                    len(histogram.values)))
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+def escape(value):
+    """Escapes a label value of the Prometheus text format."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
@@ -0,0 +1,158 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import html
+import os
+import re
+from collections import deque
+from . import utils
+
+class Tail:
+    """Keeps the last lines written to it, each truncated to a maximum size."""
+
+    def __init__(self, lines, line_size):
+        self.lines = deque(maxlen=lines)
+        self.line_size = line_size
+        self.partial = b''
+        self.dropped = False
+
+    def write(self, data):
+        lines = data.split(b'\n')
+        for line in lines[:-1]:
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped = True
+            self.lines.append((self.partial + line)[:self.line_size])
+            self.partial = b''
+        self.partial = (self.partial + lines[-1])[:self.line_size]
+
+    def get(self):
+        lines = list(self.lines)
+        if self.partial != b'':
+            lines.append(self.partial)
+        return b'\n'.join(lines).rstrip(b'\r\n').decode('utf-8', 'replace')
+
+
+class Clixml:
+    """Turns the CLIXML that powershell writes on stderr into text as it comes.
+
+    Only the strings of the records are kept, as pywinrm does for run_ps.
+    Other records, such as progress, are dropped. Only an unfinished record
+    is held back, so memory does not grow with the output. Output that does
+    not start as CLIXML goes through as is.
+    """
+    header = b'#< CLIXML'
+    record = re.compile(b'<S S="[^"]*">(.*?)</S>', re.S)
+    escape = re.compile('_x([0-9A-Fa-f]{4})_')
+
+    def __init__(self):
+        self.buffer = b''
+        self.clixml = None
+
+    def decode(self, data):
+        if self.clixml is None:
+            self.buffer += data
+            if len(self.buffer) < len(self.header) \
+                    and self.header.startswith(self.buffer):
+                return b''
+            self.clixml = self.buffer.startswith(self.header)
+            data, self.buffer = self.buffer, b''
+        if not self.clixml:
+            return data
+        self.buffer += data
+        text = []
+        end = 0
+        for match in self.record.finditer(self.buffer):
+            text.append(self.unescape(match.group(1)))
+            end = match.end()
+        rest = self.buffer[end:]
+        start = rest.rfind(b'<S ')
+        if start == -1:
+            # Only what could be the beginning of a record is kept
+            start = max(0, len(rest) - len(b'<S S'))
+        self.buffer = rest[start:]
+        return b''.join(text)
+
+    @staticmethod
+    def unescape(string):
+        string = html.unescape(string.decode('utf-8', 'replace'))
+        string = string.replace('_x000D__x000A_', '\n')
+        return Clixml.escape.sub(lambda m: chr(int(m.group(1), 16)),
+                string).encode('utf-8')
+
+
+class Collector:
+    """Keeps the whole output of a command in memory."""
+
+    def __init__(self):
+        self.data = {'stdout': [], 'stderr': []}
+
+    def write(self, stream, data):
+        self.data[stream].append(data)
+
+    def get(self, stream):
+        return b''.join(self.data[stream])
+
+
+class ActionOutput:
+    """Streams the output of an action to its log files.
+
+    Only the byte counts and the last lines of each stream are kept in
+    memory, whatever the size of the output.
+    """
+    tail_lines = 10
+    line_size = 512
+
+    def __init__(self, directory, task, index):
+        directory = os.path.join(directory, task)
+        os.makedirs(directory, exist_ok=True)
+        self.paths = {}
+        self.files = {}
+        self.sizes = {}
+        self.tails = {}
+        for stream in ('stdout', 'stderr'):
+            self.paths[stream] = os.path.join(directory,
+                    '{:03d}.{}'.format(index, stream))
+            self.files[stream] = open(self.paths[stream], 'wb')
+            self.sizes[stream] = 0
+            self.tails[stream] = Tail(self.tail_lines, self.line_size)
+
+    def write(self, stream, data):
+        if not data:
+            return
+        self.files[stream].write(data)
+        self.sizes[stream] += len(data)
+        self.tails[stream].write(data)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+    def print_result(self, task, line, exit_code):
+        print('[{}/{}]'.format(task, line))
+        print(' ├ RETURN:', exit_code)
+        for stream in ('stdout', 'stderr'):
+            print(' ├ {}: {} bytes in {}'.format(stream.upper(),
+                self.sizes[stream],
+                self.paths[stream]))
+            if self.tails[stream].dropped:
+                print(' │ [...]')
+            utils.pretty_print(self.tails[stream].get())
+        print(' └───')
+        print()
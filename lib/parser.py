@@ -18,7 +18,7 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from . import utils
+import sys
 
 def spin(args):
     """Handles the 'spin' command."""
@@ -32,16 +32,31 @@ def cut(args):
 
 def create(args):
     """Handles the 'create' command."""
-    from lib.configuration import Configuration
+    from lib import plan
 
-    config = utils.parse_config(args, Configuration())
+    config = plan.load(args)
     config.write_vagrantfile(args.target)
 
+def compile(args):
+    """Handles the 'compile' command."""
+    from lib import plan
+
+    config, path = plan.compile(args)
+    print('Plan of {} tasks on {} machines using {} written to {}'.format(
+        len(config.tasks),
+        len(config.conf),
+        ', '.join(config.transports()) or 'no transport',
+        path))
+
 def up(args):
     """Handles the 'up' command."""
-    import subprocess
+    from lib import plan
+    from lib import vagrant
 
-    subprocess.run(['vagrant', 'up'])
+    config = plan.load(args)
+    if not vagrant.up(config, args.parallelism, args.boot_timeout):
+        print('Some machines are not ready')
+        sys.exit(1)
 
 def halt(args):
     """Handles the 'halt' command."""
@@ -49,41 +64,279 @@ def halt(args):
 
     subprocess.run(['vagrant', 'halt'])
 
+def snapshot(args):
+    """Handles the 'snapshot' command."""
+    from lib import plan
+    from lib import vagrant
+
+    config = plan.load(args)
+    if not vagrant.snapshot(config, args.snapshot, args.parallelism):
+        sys.exit(1)
+
+def reset(args):
+    """Handles the 'reset' command."""
+    from lib import plan
+    from lib import vagrant
+
+    config = plan.load(args)
+    if not vagrant.reset(config, args.snapshot, args.parallelism,
+            args.boot_timeout):
+        print('Some machines are not ready')
+        sys.exit(1)
+
 def play(args):
     """Handles the 'play' command."""
-    from threading import Timer
-    from lib.configuration import Configuration
+    from lib import daemon
+    from lib import plan
+
+    if args.log_dir is None:
+        args.log_dir = new_log_dir('moirai-logs')
+    if not args.no_daemon:
+        response = daemon.request(args.config, daemon.play_request(args))
+        if response is not None:
+            print('Played by the moirai serve daemon:',
+                    response.get('status', response.get('error')))
+            if response.get('status') != 'finished':
+                sys.exit(1)
+            return
+
+    config = plan.load(args)
+    run, status = replay(config, args)
+    if run is not None:
+        run.close()
+    if status == 'failed':
+        sys.exit(1)
+
+def new_log_dir(base):
+    """Returns a directory of base for a new play, named after its start."""
+    import os
+    import time
+
+    name = time.strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(base, name)
+    suffix = 1
+    while os.path.exists(path):
+        suffix += 1
+        path = os.path.join(base, '{}-{}'.format(name, suffix))
+    return path
+
+def replay(config, args, run=None):
+    """Plays the scenario args.repeat times, reusing the connections of run.
+
+    Returns the run, whose connections are still open, and the status of
+    the replays: finished, stopped or failed.
+    """
+    import os
+    from lib import vagrant
+    from lib.run import Run
+
+    for iteration in range(1, args.repeat + 1):
+        if run is not None and run.stopped.is_set():
+            return run, 'stopped'
+        if args.repeat > 1:
+            print('Replay {}/{}'.format(iteration, args.repeat))
+        if args.reset:
+            if not vagrant.reset(config, args.snapshot, args.parallelism,
+                    args.boot_timeout):
+                print('Some machines are not ready')
+                return run, 'failed'
+            if run is not None:
+                if run.stopped.is_set():
+                    return run, 'stopped'
+                # The connections were to the machines before the restore
+                run.pool.close()
+        log_dir = args.log_dir
+        if args.repeat > 1:
+            log_dir = os.path.join(log_dir, str(iteration))
+        if run is None:
+            run = Run(config, log_dir,
+                    manifest_dir=os.path.join(os.path.dirname(
+                        os.path.abspath(args.config)), '.moirai', 'manifests'),
+                    share_dir=args.target)
+        else:
+            run.restart(log_dir)
+        run.manifests.force = args.force_send
+        play_scenario(run, args)
+        if run.stopped.is_set():
+            return run, 'stopped'
+    return run, 'finished'
+
+def play_scenario(run, args):
+    """Plays the scenario once."""
+    import os
+    from lib.grace import Grace
+    from lib.metrics import Metrics
+    from lib.scheduler import Scheduler
+    from lib.task import Task
+
+    for transport in run.config.transports():
+        Task.task_class(transport)
+    metrics = Metrics(run.config)
+    run.timeline.listeners.append(metrics)
+    grace = Grace(run, run.config.grace)
+    run.timeline.listeners.append(grace)
+    runner = Task.run_task
+    profiler = None
+    if args.profile:
+        from lib.profiling import Profiler
+
+        profiler = Profiler(os.path.join(run.log_dir, 'profile'),
+                Scheduler.worker_name)
+        runner = profiler.runner(runner)
+        profiler.start()
+    scheduler = Scheduler(run, runner, args.workers)
+    try:
+        if profiler is None:
+            over = scheduler.play(run.config.duration)
+        else:
+            over = profiler.profile('scheduler', scheduler.play,
+                    run.config.duration)
+        if not over and not run.stopped.is_set():
+            grace.shutdown(scheduler)
+        if run.stopped.is_set() and not scheduler.wait_idle(run.cancel_timeout):
+            print('Some tasks did not stop in time')
+    finally:
+        run.finish()
+        if profiler is not None:
+            profiler.stop()
+    scheduler.print_waits()
+    grace.print_summary()
+    metrics.print_summary()
+    metrics.write(os.path.join(run.log_dir, 'metrics.prom'))
+    if run.manifests.skipped_files:
+        print('Skipped {} files already on the machines: {} bytes'.format(
+            run.manifests.skipped_files, run.manifests.skipped_bytes))
+
+def collect(args):
+    """Handles the 'collect' command."""
+    import os
+    import traceback
+    from lib import plan
+    from lib.run import Run
     from lib.task import Task
 
-    config = utils.parse_config(args, Configuration())
-
-    tasks = []
-    for task, items in config.tasks.items():
-        t = Timer(items['timing'], Task.run_task,
-                args=(task, len(tasks) + 1, items, config))
-        t.daemon = True
-        t.start()
-        tasks.append(t)
-
-    duration = config.duration
-    if duration == 0:
-        for t in tasks:
-            t.join()
-    else:
-        start = time.time()
-        while time.time() < start + duration:
-            finished = True
-            for t in tasks:
-                if not t.finished.is_set():
-                    finished = False
-                    break
-            if finished:
-                break
-            time.sleep(1)
+    config = plan.load(args)
+    for task in args.tasks:
+        if not task in config.tasks:
+            print('Task', task, 'is not in the scenario')
+            sys.exit(1)
+    run = Run(config, new_log_dir(os.path.join(args.log_dir, 'collect')),
+            share_dir=args.target)
+    collected = 0
+    failed = False
+    try:
+        for number, (task, items) in enumerate(config.tasks.items(), 1):
+            if args.tasks and not task in args.tasks:
+                continue
+            try:
+                collected += Task.collect_artifacts(task, number, items, run)
+            except Exception:
+                print('[{}] Could not collect the artifacts'.format(task))
+                traceback.print_exc()
+                failed = True
+    finally:
+        run.close()
+    print('Collected {} artifacts'.format(collected))
+    if failed:
+        sys.exit(1)
+
+def serve(args):
+    """Handles the 'serve' command."""
+    from lib import daemon
+
+    if daemon.request(args.config, {'command': 'status'}) is not None:
+        print('A moirai serve daemon is already running')
+        sys.exit(1)
+    server = daemon.Daemon(args).listen()
+    print('Serving on', daemon.socket_path(args.config))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+def status(args):
+    """Handles the 'status' command."""
+    from lib import daemon
+
+    response = daemon.request(args.config, {'command': 'status'})
+    if response is None:
+        print('No moirai serve daemon is running')
+        sys.exit(1)
+    daemon.print_status(response)
 
 def stop(args):
     """Handles the 'stop' command."""
-    pass
+    from lib import daemon
+
+    response = daemon.request(args.config, {'command': 'stop'})
+    if response is None:
+        print('No moirai serve daemon is running')
+        return
+    print(response['status'])
+
+def at_least_one(value):
+    """Parses a count that must be at least 1."""
+    import argparse
+
+    count = int(value)
+    if count < 1:
+        raise argparse.ArgumentTypeError('{} is not at least 1'.format(value))
+    return count
+
+def add_up_arguments(parser):
+    """Adds the arguments shared by the commands booting the machines."""
+    parser.add_argument('-p', '--parallelism',
+            help='number of machines booted at the same time',
+            type=at_least_one,
+            default=4,
+            dest='parallelism')
+    parser.add_argument('--boot-timeout',
+            help='seconds to wait for a machine to answer after booting it',
+            type=int,
+            default=600,
+            dest='boot_timeout')
+
+def add_snapshot_arguments(parser):
+    """Adds the arguments shared by the commands using snapshots."""
+    parser.add_argument('-s', '--snapshot',
+            help='name of the baseline snapshot',
+            default='moirai-baseline',
+            dest='snapshot')
+
+def add_play_arguments(parser):
+    """Adds the arguments shared by the commands playing the scenario."""
+    parser.add_argument('-r', '--reset',
+            help='restore the baseline snapshot before each replay',
+            action='store_true',
+            dest='reset')
+    parser.add_argument('-n', '--repeat',
+            help='number of times the scenario is played',
+            type=at_least_one,
+            default=1,
+            dest='repeat')
+    parser.add_argument('-w', '--workers',
+            help='maximum number of tasks running at the same time',
+            type=at_least_one,
+            default=32,
+            dest='workers')
+    parser.add_argument('--force-send',
+            help='send the files even if they are already on the machines',
+            action='store_true',
+            dest='force_send')
+    parser.add_argument('--profile',
+            help='profile the scheduler and every task, in the log directory',
+            action='store_true',
+            dest='profile')
+    parser.add_argument('--no-daemon',
+            help='play here even if a moirai serve daemon is running',
+            action='store_true',
+            dest='no_daemon')
+    parser.add_argument('-l', '--log-dir',
+            help='directory where the output of every action is written, '
+            'by default a new one in moirai-logs',
+            dest='log_dir')
 
 def create_parser():
     import argparse
@@ -103,6 +356,9 @@ def create_parser():
     # Parser for the "spin" command
     parser_spin = subparsers.add_parser('spin',
             help='creates the VMs if necessary and plays the scenario')
+    add_up_arguments(parser_spin)
+    add_snapshot_arguments(parser_spin)
+    add_play_arguments(parser_spin)
     parser_spin.set_defaults(func=spin)
 
     # Parser for the "cut" command
@@ -115,9 +371,15 @@ def create_parser():
             help='create the vagrant configuration file')
     parser_create.set_defaults(func=create)
 
+    # Parser for the "compile" command
+    parser_compile = subparsers.add_parser('compile',
+            help='validates the configuration and caches its parsed plan')
+    parser_compile.set_defaults(func=compile)
+
     # Parser for the "up" command
     parser_up = subparsers.add_parser('up',
             help='launches all the VMs using vagrant')
+    add_up_arguments(parser_up)
     parser_up.set_defaults(func=up)
 
     # Parser for the "halt" command
@@ -128,8 +390,53 @@ def create_parser():
     # Parser for the "play" command
     parser_play = subparsers.add_parser('play',
             help='plays the scenario')
+    add_up_arguments(parser_play)
+    add_snapshot_arguments(parser_play)
+    add_play_arguments(parser_play)
     parser_play.set_defaults(func=play)
 
+    # Parser for the "collect" command
+    parser_collect = subparsers.add_parser('collect',
+            help='retrieves the artifacts that are missing or incomplete')
+    parser_collect.add_argument('tasks',
+            help='tasks whose artifacts are retrieved, all by default',
+            nargs='*')
+    parser_collect.add_argument('-l', '--log-dir',
+            help='directory where each collection is logged, in a new '
+            'directory of collect/',
+            default='moirai-logs',
+            dest='log_dir')
+    parser_collect.set_defaults(func=collect)
+
+    # Parser for the "snapshot" command
+    parser_snapshot = subparsers.add_parser('snapshot',
+            help='saves a baseline snapshot of the VMs')
+    add_up_arguments(parser_snapshot)
+    add_snapshot_arguments(parser_snapshot)
+    parser_snapshot.set_defaults(func=snapshot)
+
+    # Parser for the "reset" command
+    parser_reset = subparsers.add_parser('reset',
+            help='restores the baseline snapshot of the VMs')
+    add_up_arguments(parser_reset)
+    add_snapshot_arguments(parser_reset)
+    parser_reset.set_defaults(func=reset)
+
+    # Parser for the "serve" command
+    parser_serve = subparsers.add_parser('serve',
+            help='keeps the connections to the VMs open and plays the '
+            'scenario on request')
+    parser_serve.add_argument('-l', '--log-dir',
+            help='directory where the warm-up is logged',
+            default='moirai-logs',
+            dest='log_dir')
+    parser_serve.set_defaults(func=serve)
+
+    # Parser for the "status" command
+    parser_status = subparsers.add_parser('status',
+            help='shows what the moirai serve daemon is playing')
+    parser_status.set_defaults(func=status)
+
     # Parser for the "stop" command
     parser_stop = subparsers.add_parser('stop',
             help='stops the scenario')
@@ -0,0 +1,73 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import os
+import pickle
+from . import utils
+
+# The plan depends on the code parsing the configuration as much as on the
+# configuration file itself
+sources = ('configuration.py', 'utils.py')
+
+def digest(config_path):
+    """Returns the key of the plan of a configuration file."""
+    h = hashlib.sha256()
+    with open(config_path, 'rb') as f:
+        h.update(f.read())
+    for source in sources:
+        with open(os.path.join(os.path.dirname(__file__), source), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def plan_path(config_path, key):
+    return os.path.join(os.path.dirname(os.path.abspath(config_path)),
+            '.moirai', 'plans', key + '.plan')
+
+def compile(args):
+    """Parses and validates the configuration file, then saves its plan.
+
+    The plan holds the parsed configuration: absolute timings, forwards,
+    files and artifacts of each task and the transports they use.
+    """
+    from .configuration import Configuration
+
+    key = digest(args.config)
+    config = utils.parse_config(args, Configuration())
+    path = plan_path(args.config, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(config, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+    return config, path
+
+def load(args):
+    """Returns the configuration, from its plan if it is up to date."""
+    try:
+        key = digest(args.config)
+    except OSError:
+        # Let the parser report the problem
+        return compile(args)[0]
+    try:
+        with open(plan_path(args.config, key), 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError):
+        return compile(args)[0]
@@ -0,0 +1,349 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import base64
+import re
+import socket
+import threading
+import time
+import uuid
+from .output import Collector
+
+def receive(protocol, shell_id, command_id):
+    """Returns the output that a WinRM command produced since the last call.
+
+    This is a Receive round trip, repeated while the command is silent for
+    longer than the operation timeout: (stdout, stderr, exit code, done).
+    """
+    from winrm.exceptions import WinRMOperationTimeoutError
+
+    if hasattr(protocol, 'get_command_output_raw'):
+        raw = protocol.get_command_output_raw
+    else:
+        raw = protocol._raw_get_command_output
+    while True:
+        try:
+            return raw(shell_id, command_id)
+        except WinRMOperationTimeoutError:
+            pass
+
+
+class ConnectionPool:
+    """Keeps authenticated connections to the machines for a whole play run.
+
+    Every task targeting a machine multiplexes its SFTP and exec channels over
+    the same transport instead of doing its own handshake. Another transport
+    is only opened when the server refuses more channels on the existing
+    ones. Windows machines
+    share their WinRM session and, if asked to, a powershell runspace.
+    """
+    keepalive = 30
+    # Transports per machine opened when the server refuses more channels
+    max_connections = 8
+
+    def __init__(self, config, timeline):
+        self.config = config
+        self.timeline = timeline
+        self.lock = threading.Lock()
+        self.machine_locks = {}
+        self.transports = {}
+        self.sessions = {}
+        self.runspaces = {}
+
+    def machine_lock(self, machine):
+        with self.lock:
+            if not machine in self.machine_locks:
+                self.machine_locks[machine] = threading.Lock()
+            return self.machine_locks[machine]
+
+    def ssh_transport(self, machine):
+        """Returns an authenticated transport to machine, connecting if needed."""
+        with self.machine_lock(machine):
+            transports = self.transports.setdefault(machine, [])
+            for transport in list(transports):
+                if transport.is_authenticated():
+                    return transport
+                transports.remove(transport)
+                transport.close()
+            return self.connect_ssh(machine)
+
+    def extra_transport(self, machine, refused):
+        """Returns a transport to machine that is not in refused.
+
+        Connects again if every transport was refused a channel, up to
+        max_connections transports. Returns None past them.
+        """
+        with self.machine_lock(machine):
+            transports = self.transports.get(machine, [])
+            for transport in transports:
+                if not transport in refused and transport.is_authenticated():
+                    return transport
+            if len(transports) >= self.max_connections:
+                return None
+            return self.connect_ssh(machine)
+
+    def connect_ssh(self, machine):
+        """Adds a transport to machine, called with the lock of machine."""
+        import paramiko
+
+        conf = self.config.conf[machine]
+        start = time.monotonic()
+        sock = socket.create_connection(('localhost',
+            self.config.forwards[machine][22]))
+        # Actions are short exchanges that Nagle's algorithm would delay
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(sock)
+        try:
+            transport.connect(None,
+                    conf.get('username', 'vagrant'),
+                    conf.get('password', 'vagrant'))
+        except:
+            transport.close()
+            raise
+        transport.set_keepalive(self.keepalive)
+        self.transports.setdefault(machine, []).append(transport)
+        self.timeline.emit('connection_established',
+                machine=machine,
+                transport='ssh',
+                duration=time.monotonic() - start)
+        return transport
+
+    def connect(self, machine):
+        """Connects to machine ahead of its tasks."""
+        transport = self.config.transport(machine)
+        if transport == 'ssh':
+            self.ssh_transport(machine)
+        elif transport == 'winrm':
+            self.winrm_session(machine)
+            if self.config.conf[machine].get('winrm_shell') == 'machine':
+                self.runspace(machine)
+
+    def drop(self, machine, transport):
+        """Forgets a broken transport so that the next user reconnects."""
+        with self.machine_lock(machine):
+            transports = self.transports.get(machine, [])
+            if transport in transports:
+                transports.remove(transport)
+        transport.close()
+
+    def open_channel(self, machine, opener):
+        """Opens a channel using opener, reconnecting once on failure.
+
+        When the server refuses the channel, e.g. because of its MaxSessions,
+        the transport still carries the channels of other tasks: the channel
+        is opened over another transport to machine instead, connecting one
+        if all of them were refused.
+        """
+        import paramiko
+
+        transport = self.ssh_transport(machine)
+        refused = []
+        while True:
+            try:
+                return opener(transport)
+            except paramiko.ChannelException as err:
+                if err.code != paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED:
+                    raise
+            except paramiko.SSHException:
+                # Paramiko may tell a thread that its channel was refused this
+                # way when another one opens a channel at the same time
+                if not transport.is_active():
+                    self.drop(machine, transport)
+                    return opener(self.ssh_transport(machine))
+            except (EOFError, OSError):
+                self.drop(machine, transport)
+                return opener(self.ssh_transport(machine))
+            refused.append(transport)
+            transport = self.extra_transport(machine, refused)
+            if transport is None:
+                raise paramiko.ChannelException(
+                        paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED,
+                        'Every connection to {} refused the channel'.format(
+                            machine))
+
+    def open_sftp(self, machine):
+        return self.open_channel(machine, lambda t: t.open_sftp_client())
+
+    def open_session(self, machine):
+        return self.open_channel(machine, lambda t: t.open_session())
+
+    def winrm_session(self, machine):
+        """Returns the WinRM session of machine."""
+        import winrm
+
+        with self.machine_lock(machine):
+            if not machine in self.sessions:
+                conf = self.config.conf[machine]
+                self.sessions[machine] = winrm.Session(
+                        'localhost:' + str(self.config.forwards[machine][5985]),
+                        auth=(conf.get('username', 'vagrant'),
+                            conf.get('password', 'vagrant')))
+            return self.sessions[machine]
+
+    def runspace(self, machine):
+        """Returns the runspace shared by all the tasks of machine."""
+        session = self.winrm_session(machine)
+        with self.machine_lock(machine):
+            runspace = self.runspaces.get(machine)
+            if runspace is None or not runspace.alive:
+                runspace = self.open_runspace(machine, session)
+                self.runspaces[machine] = runspace
+            return runspace
+
+    def open_runspace(self, machine, session):
+        start = time.monotonic()
+        runspace = PowershellRunspace(session)
+        self.timeline.emit('connection_established',
+                machine=machine,
+                transport='winrm',
+                duration=time.monotonic() - start)
+        return runspace
+
+    def close(self):
+        with self.lock:
+            transports = [transport for machine in self.transports.values()
+                    for transport in machine]
+            self.transports.clear()
+            runspaces = list(self.runspaces.values())
+            self.runspaces.clear()
+        for transport in transports:
+            transport.close()
+        for runspace in runspaces:
+            runspace.close()
+
+
+class PowershellRunspace:
+    """A single powershell process kept open in a WinRM shell.
+
+    Scripts are written to its standard input one after the other, each
+    followed by a marker carrying its exit code, so that only the first one
+    pays for creating the shell and starting powershell.
+    """
+    arguments = ['-NoLogo', '-NoProfile', '-NonInteractive', '-Command', '-']
+    # Every script starts where the first one did, for both powershell and
+    # .NET, whatever the previous scripts changed
+    prologue = """
+$global:LASTEXITCODE = 0
+if ($global:moiraiHome -eq $null) { $global:moiraiHome = (Get-Location).Path }
+Set-Location -LiteralPath $global:moiraiHome
+[Environment]::CurrentDirectory = $global:moiraiHome
+"""
+    epilogue = """
+$moiraiStatus = if ($?) {{ 0 }} elseif ($LASTEXITCODE) {{ $LASTEXITCODE }} else {{ 1 }}
+[Console]::Out.WriteLine("`n{marker} $moiraiStatus")
+[Console]::Error.WriteLine("`n{marker}")
+"""
+
+    def __init__(self, session):
+        self.protocol = session.protocol
+        self.lock = threading.Lock()
+        self.shell_id = self.protocol.open_shell()
+        self.command_id = self.protocol.run_command(self.shell_id,
+                'powershell', self.arguments)
+        self.alive = True
+
+    @staticmethod
+    def single_line(script):
+        """Turns a script into a line that the runspace reads in one go."""
+        script = script.strip()
+        if not '\n' in script:
+            return script
+        encoded = base64.b64encode(script.encode('utf-16-le')).decode('ascii')
+        return ('Invoke-Expression ([Text.Encoding]::Unicode.GetString('
+                '[Convert]::FromBase64String("{}")))'.format(encoded))
+
+    def run(self, script, output=None):
+        """Runs script, streaming its output to output.
+
+        Returns the exit code of the script, or (stdout, stderr, exit code)
+        when no output is given.
+        """
+        import winrm
+
+        collector = None
+        if output is None:
+            output = collector = Collector()
+        marker = 'moirai-' + uuid.uuid4().hex
+        ends = {'stdout': re.compile(b'\r?\n' + marker.encode('ascii')
+                    + b' (-?\\d+)\r?\n'),
+                'stderr': re.compile(b'\r?\n' + marker.encode('ascii')
+                    + b'\r?\n')}
+        # Bytes that could be the beginning of a marker are held back
+        held = {'stdout': b'', 'stderr': b''}
+        hold = len(marker) + 16
+        status = None
+        with self.lock:
+            if not self.alive:
+                raise winrm.exceptions.WinRMError('The runspace is closed')
+            self.protocol.send_command_input(self.shell_id, self.command_id,
+                    self.prologue.lstrip().replace('\n', '\r\n')
+                    + self.single_line(script) + '\r\n'
+                    + self.epilogue.format(marker=marker).replace('\n', '\r\n'))
+            while held['stdout'] is not None or held['stderr'] is not None:
+                try:
+                    out, err, code, done = receive(self.protocol,
+                            self.shell_id, self.command_id)
+                except:
+                    self.alive = False
+                    raise
+                for stream, data in (('stdout', out), ('stderr', err)):
+                    if held[stream] is None:
+                        continue
+                    data = held[stream] + data
+                    match = ends[stream].search(data)
+                    if match:
+                        output.write(stream, data[:match.start()])
+                        held[stream] = None
+                        if stream == 'stdout':
+                            status = int(match.group(1))
+                        continue
+                    output.write(stream, data[:-hold])
+                    held[stream] = data[-hold:]
+                if done:
+                    # The script ended powershell, e.g. by calling exit
+                    self.alive = False
+                    for stream in ('stdout', 'stderr'):
+                        if held[stream] is not None:
+                            output.write(stream, held[stream])
+                    if status is None:
+                        status = code
+                    break
+        if collector is not None:
+            return collector.get('stdout'), collector.get('stderr'), status
+        return status
+
+    def interrupt(self):
+        """Ends powershell from another thread, and the script it runs."""
+        self.alive = False
+        try:
+            self.protocol.cleanup_command(self.shell_id, self.command_id)
+        except:
+            pass
+
+    def close(self):
+        with self.lock:
+            if not self.alive:
+                return
+            self.alive = False
+            try:
+                self.protocol.cleanup_command(self.shell_id, self.command_id)
+                self.protocol.close_shell(self.shell_id)
+            except:
+                pass
@@ -0,0 +1,199 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cProfile
+import marshal
+import os
+import pstats
+import sys
+import threading
+
+class Profiler:
+    """Profiles a play run.
+
+    The loop of the scheduler and every task are profiled on their own, in
+    the thread running them. The threads started while the run plays, such
+    as those reading the SSH transports, moving SFTP channels or serving
+    files, are profiled together. Each profile is written to directory,
+    along with run.prof merging all of them. Nothing is profiled outside of
+    a Profiler.
+
+    From Python 3.12, cProfile can only be active once per interpreter and
+    then covers every thread. The stacks of the threads are sampled every
+    interval seconds instead: times are estimates and call counts are
+    numbers of samples.
+    """
+    sampling = sys.version_info >= (3, 12)
+    interval = 0.005
+
+    def __init__(self, directory, worker_name):
+        self.directory = directory
+        # Prefix of the names of the threads whose tasks are profiled apart
+        self.worker_name = worker_name
+        self.lock = threading.Lock()
+        self.paths = []
+        self.threads = []
+        # Sampling: profile of each thread, samples of each profile
+        self.names = {}
+        self.samples = {}
+        self.ignored = set()
+        self.sampler = None
+        self.stopped = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        if not self.sampling:
+            threading.setprofile(self.thread_started)
+            return
+        # The threads already there are only sampled while profiled
+        self.ignored = set(thread.ident for thread in threading.enumerate())
+        self.sampler = threading.Thread(target=self.sample,
+                name='moirai-profiler')
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def thread_started(self, frame, event, arg):
+        # Only called once per thread, enabling cProfile replaces this hook
+        sys.setprofile(None)
+        if threading.current_thread().name.startswith(self.worker_name):
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        with self.lock:
+            self.threads.append(profiler)
+
+    def sample(self):
+        ignored = self.ignored | set([threading.get_ident()])
+        while not self.stopped.wait(self.interval):
+            workers = set(thread.ident for thread in threading.enumerate()
+                    if thread.name.startswith(self.worker_name))
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, frame in frames.items():
+                    name = self.names.get(ident)
+                    if name is None:
+                        if ident in ignored or ident in workers:
+                            continue
+                        name = 'threads'
+                    self.add(self.samples.setdefault(name, {}), frame)
+
+    def add(self, stats, frame):
+        """Adds a sample of the stack ending with frame to stats."""
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        seen = set()
+        for i, function in enumerate(stack):
+            # [calls, primitive calls, own time, cumulative time, callers]
+            stat = stats.setdefault(function, [0, 0, 0, 0, {}])
+            leaf = i == len(stack) - 1
+            if not function in seen:
+                seen.add(function)
+                stat[0] += 1
+                stat[1] += 1
+                stat[3] += self.interval
+            if leaf:
+                stat[2] += self.interval
+            if i:
+                calls, primitive, own, cumulative = stat[4].get(stack[i - 1],
+                        (0, 0, 0, 0))
+                stat[4][stack[i - 1]] = (calls + 1, primitive + 1,
+                        own + (self.interval if leaf else 0),
+                        cumulative + self.interval)
+
+    def profile(self, name, function, *args):
+        """Calls function(*args), profiled as name."""
+        if self.sampling:
+            ident = threading.get_ident()
+            with self.lock:
+                self.names[ident] = name
+            try:
+                return function(*args)
+            finally:
+                with self.lock:
+                    del self.names[ident]
+                    stats = self.samples.pop(name, {})
+                self.save(name, stats)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return function(*args)
+        finally:
+            profiler.disable()
+            self.save(name, self.merge([profiler]))
+
+    def runner(self, runner):
+        """Returns runner, profiling each task on its own."""
+        def run_task(task, number, items, run):
+            return self.profile('task-' + task, runner, task, number, items,
+                    run)
+        return run_task
+
+    @staticmethod
+    def merge(profilers):
+        """Returns the statistics of profilers, added together."""
+        stats = {}
+        for profiler in profilers:
+            # Takes the statistics without disabling profilers of other threads
+            profiler.snapshot_stats()
+            for function, stat in profiler.stats.items():
+                if function in stats:
+                    stat = pstats.add_func_stats(stats[function], stat)
+                stats[function] = stat
+        return stats
+
+    def save(self, name, stats):
+        stats = dict((function, tuple(stat))
+                for function, stat in stats.items())
+        path = os.path.join(self.directory, name.replace(os.sep, '_')
+                + '.prof')
+        with open(path, 'wb') as f:
+            marshal.dump(stats, f)
+        with self.lock:
+            self.paths.append(path)
+        return path
+
+    def stop(self):
+        """Stops profiling new threads and writes the merged profile."""
+        if self.sampler is not None:
+            self.stopped.set()
+            self.sampler.join()
+            with self.lock:
+                stats = self.samples.pop('threads', None)
+            if stats:
+                self.save('threads', stats)
+        else:
+            threading.setprofile(None)
+        with self.lock:
+            threads = list(self.threads)
+        if threads:
+            self.save('threads', self.merge(threads))
+        with self.lock:
+            paths = list(self.paths)
+        if not paths:
+            return None
+        stats = pstats.Stats(*paths)
+        path = os.path.join(self.directory, 'run.prof')
+        stats.dump_stats(path)
+        print('Profiles written to', self.directory)
+        return path
@@ -0,0 +1,145 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import os
+
+class Partial:
+    """An artifact being retrieved, which a later attempt can resume.
+
+    The bytes received so far are kept in destination.part. The sidecar
+    destination.part.json records the artifact, the sha256 of the whole
+    artifact on the guest, how many bytes were received and their sha256. An
+    attempt resumes from there if the artifact did not change on the guest
+    and the bytes kept still match, and starts over otherwise. Once every
+    byte is received, their sha256 must be that of the artifact on the guest.
+    """
+    buffer_size = 64 * 1024
+    # Bytes received between two updates of the sidecar
+    checkpoint = 4 * 1024 * 1024
+
+    def __init__(self, destination, artifact, digest):
+        self.destination = destination
+        self.path = destination + '.part'
+        self.sidecar = self.path + '.json'
+        self.artifact = artifact
+        self.digest = digest
+        self.sha = hashlib.sha256()
+        self.offset = 0
+        self.saved = 0
+        state = self.load()
+        self.file = open(self.path, 'r+b' if state else 'w+b')
+        if state:
+            self.resume(state['offset'], state['received_sha256'])
+        self.save()
+
+    def load(self):
+        """Returns the state of the sidecar if it can be resumed."""
+        try:
+            with open(self.sidecar) as f:
+                state = json.load(f)
+            if (state['artifact'] == self.artifact
+                    and state['sha256'] == self.digest
+                    and os.path.getsize(self.path) >= state['offset']):
+                return state
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def resume(self, offset, digest):
+        """Keeps the first offset bytes if they match digest."""
+        while self.offset < offset:
+            data = self.file.read(min(self.buffer_size, offset - self.offset))
+            if not data:
+                break
+            self.sha.update(data)
+            self.offset += len(data)
+        if self.offset != offset or self.sha.hexdigest() != digest:
+            self.sha = hashlib.sha256()
+            self.offset = 0
+        self.file.seek(self.offset)
+        self.file.truncate()
+        self.saved = self.offset
+
+    def write(self, data):
+        self.file.write(data)
+        self.sha.update(data)
+        self.offset += len(data)
+        if self.offset - self.saved >= self.checkpoint:
+            self.save()
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        """Takes in the bytes appended to destination.part by someone else."""
+        self.file.flush()
+        self.file.seek(self.offset)
+        while True:
+            data = self.file.read(self.buffer_size)
+            if not data:
+                break
+            self.sha.update(data)
+            self.offset += len(data)
+        self.save()
+
+    def restart(self):
+        """Drops the bytes received so far."""
+        self.file.seek(0)
+        self.file.truncate()
+        self.sha = hashlib.sha256()
+        self.offset = 0
+        self.save()
+
+    def save(self):
+        """Records the bytes received so far in the sidecar."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        state = {'artifact': self.artifact,
+                'sha256': self.digest,
+                'offset': self.offset,
+                'received_sha256': self.sha.hexdigest()}
+        with open(self.sidecar + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.sidecar + '.tmp', self.sidecar)
+        self.saved = self.offset
+
+    def close(self):
+        """Keeps what was received for a later attempt."""
+        if not self.file.closed:
+            self.save()
+            self.file.close()
+
+    def finish(self):
+        """Moves the checked artifact to destination, returns its size."""
+        self.file.close()
+        os.remove(self.sidecar)
+        if self.sha.hexdigest() != self.digest:
+            os.remove(self.path)
+            raise ValueError('{} does not match the artifact on the guest: '
+                    'sha256 {} instead of {}'.format(self.destination,
+                        self.sha.hexdigest(), self.digest))
+        os.replace(self.path, self.destination)
+        return self.offset
+
+def pending(destination):
+    """Tells whether a previous retrieval of destination was interrupted."""
+    return os.path.exists(destination + '.part.json')
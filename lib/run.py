@@ -0,0 +1,140 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import threading
+from .fileserver import FileServer
+from .manifest import Manifests
+from .pool import ConnectionPool
+from .share import SyncedFolder
+from .timeline import Timeline
+
+class Cancelled(Exception):
+    """Raised in the tasks of a run that was stopped."""
+
+
+class Run:
+    """Resources shared by all the tasks of a play run.
+
+    The connections, the file server and the manifests outlive a play run:
+    restart starts a new one in another log directory that reuses them.
+    """
+    http_port = 8000
+    # Seconds that the interrupted tasks of a stopped run get to end
+    cancel_timeout = 10
+
+    def __init__(self, config, log_dir, manifest_dir=None, force_send=False,
+            share_dir=None):
+        self.config = config
+        self.lock = threading.Lock()
+        self.server = None
+        self.tasks = set()
+        # Stopping holds across restart, until reset
+        self.stopped = threading.Event()
+        self.cancelled = False
+        self.start(log_dir)
+        self.pool = ConnectionPool(config, self.timeline)
+        self.manifests = Manifests(manifest_dir, force_send)
+        self.synced_folder = None
+        if share_dir is not None:
+            self.synced_folder = SyncedFolder(share_dir)
+
+    def start(self, log_dir):
+        self.log_dir = log_dir
+        os.makedirs(log_dir, exist_ok=True)
+        self.timeline = Timeline(os.path.join(log_dir, 'timeline.jsonl'))
+        self.scheduler = None
+        self.playing = True
+
+    def restart(self, log_dir):
+        """Starts a new play run, keeping the connections of this one."""
+        self.finish()
+        self.start(log_dir)
+        self.pool.timeline = self.timeline
+
+    def reset(self):
+        """Forgets that the run was stopped, before playing it again."""
+        with self.lock:
+            self.cancelled = False
+            self.stopped.clear()
+
+    def finish(self):
+        """Ends the play run."""
+        if not self.playing:
+            return
+        self.playing = False
+        self.manifests.save()
+        self.timeline.close()
+
+    def file_server(self):
+        """Returns the file server of the run, starting it on first use."""
+        with self.lock:
+            if self.server is None:
+                self.server = FileServer(self.http_port).start()
+            return self.server
+
+    def task_started(self, task):
+        with self.lock:
+            self.tasks.add(task)
+
+    def task_ended(self, task):
+        with self.lock:
+            self.tasks.discard(task)
+
+    def check_stopped(self):
+        if self.stopped.is_set():
+            raise Cancelled('The run was stopped')
+
+    def cancel(self):
+        """Stops the run: no task starts and running ones are interrupted."""
+        with self.lock:
+            self.cancelled = True
+        self.expire()
+
+    def expire(self):
+        """Interrupts the running tasks at the end of the scenario.
+
+        Unlike cancel, the run can go on with proceed once they ended.
+        """
+        self.stopped.set()
+        with self.lock:
+            tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        if self.scheduler is not None:
+            self.scheduler.wake()
+
+    def proceed(self):
+        """Lets the run go on after expire, unless it was cancelled."""
+        with self.lock:
+            if not self.cancelled:
+                self.stopped.clear()
+            return not self.cancelled
+
+    def close(self):
+        with self.lock:
+            server = self.server
+            self.server = None
+        if server is not None:
+            server.close()
+        self.pool.close()
+        if self.synced_folder is not None:
+            self.synced_folder.close()
+        self.finish()
@@ -0,0 +1,241 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import heapq
+import queue
+import threading
+import time
+import traceback
+from collections import deque, OrderedDict
+from .run import Cancelled
+
+class Scheduler:
+    """Starts the tasks of a scenario at their timing on a pool of workers.
+
+    A single loop keeps the tasks that are not due yet in a heap ordered by
+    timing. It sleeps until the next deadline or until a task finishes,
+    whichever comes first. Due tasks targeting a machine that already runs
+    max_concurrent_tasks tasks wait in a queue of their own, in timing order.
+
+    Tasks with prerequisites only enter the heap once the last of them
+    finishes, due after its delay or at their own timing, whichever is later.
+    They are skipped if a prerequisite fails.
+
+    Tasks are released the warmup of the scenario ahead of their timing, so
+    that they connect and send their files in advance, then wait for their
+    timing to run their actions.
+
+    When the duration of the scenario elapses or the run is stopped, the tasks
+    that are not running yet are dropped and the workers end once their task
+    is over.
+    """
+
+    # Prefix of the names of the threads running the tasks
+    worker_name = 'moirai-worker'
+
+    def __init__(self, run, runner, workers):
+        self.run = run
+        self.runner = runner
+        self.workers = workers
+        self.condition = threading.Condition()
+        self.pending = []
+        self.ready = queue.Queue()
+        self.finished = 0
+        self.start = None
+        self.running = {}
+        self.queues = {}
+        self.waits = OrderedDict()
+        self.blocked = {}
+        self.dependents = {}
+        self.threads = []
+        run.scheduler = self
+
+    def play(self, duration=0):
+        """Plays the scenario.
+
+        Returns True once every task is finished, False if duration (in
+        seconds, 0 meaning no limit) elapsed first.
+        """
+        for number, (task, items) in enumerate(self.run.config.tasks.items(), 1):
+            if items['after']:
+                self.blocked[task] = [items['timing'], number, items,
+                        set(name for name, _ in items['after'])]
+                for name, offset in items['after']:
+                    self.dependents.setdefault(name, []).append((task, offset))
+            else:
+                heapq.heappush(self.pending, (self.due(items['timing']),
+                    number, task, items))
+            self.run.timeline.emit('task_scheduled', task=task,
+                    machine=items['target'],
+                    timing=items['timing'],
+                    after=[name for name, _ in items['after']])
+        total = len(self.pending) + len(self.blocked)
+        for i in range(min(self.workers, total)):
+            thread = threading.Thread(target=self.work,
+                    name='{}-{}'.format(self.worker_name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        start = self.start = time.monotonic()
+        self.run.timeline.emit('scenario_started')
+        end = None
+        if duration != 0:
+            end = start + duration
+        with self.condition:
+            while self.finished < total:
+                now = time.monotonic()
+                if end is not None and now >= end:
+                    self.drain()
+                    return False
+                if self.run.stopped.is_set():
+                    self.drain()
+                    return False
+                while self.pending and start + self.pending[0][0] <= now:
+                    self.release(*heapq.heappop(self.pending))
+                timeout = None
+                if self.pending:
+                    timeout = start + self.pending[0][0] - now
+                if end is not None and (timeout is None or end - now < timeout):
+                    timeout = end - now
+                self.condition.wait(timeout)
+        for thread in self.threads:
+            self.ready.put(None)
+        return True
+
+    def drain(self):
+        """Drops the tasks that are not running yet and ends the workers.
+
+        Called with the condition held.
+        """
+        while True:
+            try:
+                job = self.ready.get_nowait()
+            except queue.Empty:
+                break
+            self.running[job[2]['target']] -= 1
+        self.pending = []
+        self.queues.clear()
+        self.blocked.clear()
+        for thread in self.threads:
+            self.ready.put(None)
+
+    def due(self, timing):
+        """Returns when a task of that timing is released."""
+        return max(0, timing - self.run.config.warmup)
+
+    def wake(self):
+        """Makes the loop check whether the run was stopped."""
+        with self.condition:
+            self.condition.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """Waits until no task is running, returns False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(
+                    lambda: not any(self.running.values()), timeout)
+
+    def limit(self, machine):
+        return self.run.config.conf.get(machine, {}).get('max_concurrent_tasks', 0)
+
+    def release(self, due, number, task, items):
+        """Dispatches a due task, or queues it if its machine is busy."""
+        machine = items['target']
+        limit = self.limit(machine)
+        if limit and self.running.get(machine, 0) >= limit:
+            if not machine in self.queues:
+                self.queues[machine] = deque()
+            self.queues[machine].append((due, number, task, items))
+            return
+        self.dispatch(due, number, task, items, False)
+
+    def dispatch(self, due, number, task, items, queued):
+        machine = items['target']
+        self.running[machine] = self.running.get(machine, 0) + 1
+        wait = 0
+        if queued:
+            wait = time.monotonic() - self.start - due
+            self.waits[task] = (machine, wait)
+            print('[{}] waited {:.2f}s for a slot on {}'.format(task, wait,
+                machine))
+        self.run.timeline.emit('task_dispatched', task=task, machine=machine,
+                queue_wait=wait)
+        self.ready.put((number, task, items))
+
+    def work(self):
+        while True:
+            job = self.ready.get()
+            if job is None:
+                return
+            number, task, items = job
+            success = False
+            try:
+                if not self.run.stopped.is_set():
+                    self.runner(task, number, items, self.run)
+                    success = True
+            except Cancelled:
+                print('[{}] Task cancelled'.format(task))
+            except:
+                print('[{}] Task failed'.format(task))
+                traceback.print_exc()
+            with self.condition:
+                self.finished += 1
+                machine = items['target']
+                self.running[machine] -= 1
+                if self.queues.get(machine):
+                    self.dispatch(*self.queues[machine].popleft(), True)
+                self.unblock(task, success)
+                self.condition.notify_all()
+
+    def unblock(self, task, success):
+        """Schedules the tasks waiting for task once it is finished."""
+        now = time.monotonic() - self.start
+        for dependent, offset in self.dependents.get(task, []):
+            if not dependent in self.blocked:
+                # Already skipped because of another prerequisite
+                continue
+            entry = self.blocked[dependent]
+            if not success:
+                del self.blocked[dependent]
+                print('[{}] Skipped, {} did not finish'.format(dependent, task))
+                self.run.timeline.emit('task_skipped', task=dependent,
+                        machine=entry[2]['target'],
+                        prerequisite=task)
+                self.finished += 1
+                self.unblock(dependent, False)
+                continue
+            entry[0] = max(entry[0], now + offset)
+            entry[3].discard(task)
+            if not entry[3]:
+                del self.blocked[dependent]
+                timing, number, items, _ = entry
+                heapq.heappush(self.pending, (self.due(timing), number,
+                    dependent, dict(items, timing=timing)))
+
+    def print_waits(self):
+        """Prints how long tasks were queued behind busy machines."""
+        machines = OrderedDict()
+        for machine, wait in self.waits.values():
+            if not machine in machines:
+                machines[machine] = []
+            machines[machine].append(wait)
+        for machine, waits in machines.items():
+            print('{}: {} queued tasks, {:.2f}s total wait, {:.2f}s max wait'
+                    .format(machine, len(waits), sum(waits), max(waits)))
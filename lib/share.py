@@ -0,0 +1,87 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import threading
+import uuid
+
+class SyncedFolder:
+    """The vagrant project directory, that the guests see as a synced folder.
+
+    Files are staged in a directory of the run under .moirai/stage, for the
+    guest to copy them locally, and artifacts are copied there by the guest.
+    Whether a guest sees the folder is probed once per machine, with a file
+    that only this run creates.
+    """
+    # The drive that the Vagrantfile maps for windows guests, and the path it
+    # maps, which logon sessions without the mapping still see
+    windows_roots = ('Z:\\', '\\\\VBOXSVR\\vagrant\\')
+
+    def __init__(self, directory):
+        self.relative = os.path.join('.moirai', 'stage', uuid.uuid4().hex)
+        self.directory = os.path.join(directory, self.relative)
+        self.lock = threading.Lock()
+        self.machine_locks = {}
+        self.roots = {}
+        self.count = 0
+        self.probe = None
+
+    def machine_lock(self, machine):
+        with self.lock:
+            if not machine in self.machine_locks:
+                self.machine_locks[machine] = threading.Lock()
+            return self.machine_locks[machine]
+
+    def create(self):
+        """Creates the stage directory and the probe file, once."""
+        with self.lock:
+            if self.probe is None:
+                os.makedirs(self.directory, exist_ok=True)
+                open(os.path.join(self.directory, 'probe'), 'w').close()
+                self.probe = os.path.join(self.relative, 'probe')
+
+    def stage(self, name):
+        """Returns a new (host path, relative path) of the stage directory."""
+        self.create()
+        with self.lock:
+            self.count += 1
+            name = '{}-{}'.format(self.count, name)
+        return (os.path.join(self.directory, name),
+                os.path.join(self.relative, name))
+
+    @staticmethod
+    def guest_path(root, relative):
+        return root + relative.replace('/', '\\')
+
+    def guest_root(self, machine, prober):
+        """Returns where machine sees the synced folder, None if it does not.
+
+        prober(probe) is called on the first use and returns the first of
+        the guest roots where the relative path probe exists, or None.
+        """
+        with self.machine_lock(machine):
+            if not machine in self.roots:
+                self.create()
+                self.roots[machine] = prober(self.probe)
+            return self.roots[machine]
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
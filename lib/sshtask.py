@@ -0,0 +1,290 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import queue
+import shlex
+import time
+from threading import Thread
+from . import bundle
+from . import utils
+from .task import Task
+
+class SshTask(Task):
+    protocol = 'SSH'
+    buffer_size = 32 * 1024
+
+    def __init__(self, task, number, target, actions, files, artifacts, run,
+            bundle=False):
+        super().__init__(task, number, target, actions, files, artifacts, run,
+                bundle)
+        self.channels = run.config.conf[target].get('sftp_channels', 1)
+
+    def send_files(self):
+        try:
+            self.transfer(self.pending_files(), self.send_file)
+        except:
+            print('[{}] SFTP error while sending files'.format(self.task))
+            raise
+
+    def send_file(self, sftp, filename, destination):
+        start = time.monotonic()
+        sftp.put(filename, destination, confirm=True)
+        self.file_sent(filename, destination,
+                duration=time.monotonic() - start)
+
+    def recv_artifacts(self):
+        if not self.artifacts:
+            return
+        try:
+            digests = self.remote_hashes([filename
+                for filename, _ in self.artifacts])
+            self.transfer(self.artifacts,
+                    lambda sftp, filename, destination: self.recv_artifact(
+                        sftp, filename, destination, digests.get(filename)))
+        except:
+            print('[{}] SFTP error while retrieving artifacts'.format(self.task))
+            raise
+
+    def recv_artifact(self, sftp, filename, destination, digest):
+        if digest is None:
+            raise FileNotFoundError('No such artifact: ' + filename)
+        start = time.monotonic()
+        size = self.fetch_artifact(filename, destination, digest,
+                lambda partial: self.download(sftp, filename, partial))
+        self.emit('artifact_received', artifact=filename,
+                destination=destination,
+                bytes=size,
+                duration=time.monotonic() - start,
+                method='sftp')
+
+    def download(self, sftp, filename, partial):
+        """Reads filename from partial.offset on, prefetching it."""
+        with sftp.open(filename, 'rb') as f:
+            f.seek(partial.offset)
+            f.prefetch()
+            while True:
+                data = f.read(self.buffer_size)
+                if not data:
+                    return
+                partial.write(data)
+
+    def transfer(self, transfers, function):
+        """Calls function(sftp, source, destination) for every transfer.
+
+        The files are spread over up to sftp_channels SFTP channels of the
+        transport of the machine, so that the round trips of small files
+        overlap. Paramiko already pipelines the writes of put and prefetches
+        the reads of get within each channel.
+        """
+        files = queue.Queue()
+        for item in transfers:
+            files.put(item)
+        errors = []
+
+        def work():
+            sftp = self.pool.open_sftp(self.target)
+            try:
+                with self.cancellable(sftp.close):
+                    while not errors:
+                        try:
+                            filename, destination = files.get_nowait()
+                        except queue.Empty:
+                            return
+                        function(sftp, filename, destination)
+            finally:
+                sftp.close()
+
+        def guard():
+            try:
+                work()
+            except Exception as err:
+                errors.append(err)
+
+        threads = [Thread(target=guard)
+                for i in range(min(self.channels, files.qsize()) - 1)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        if not files.empty():
+            guard()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def send_bundle(self):
+        try:
+            files = self.pending_files()
+            if not files:
+                return
+            start = time.monotonic()
+            channel = self.pool.open_session(self.target)
+            try:
+                with self.cancellable(channel.close):
+                    channel.exec_command('tar -xzPf -')
+                    stream = bundle.Counter(channel.makefile('wb'))
+                    size = bundle.tar(stream, files)
+                    channel.shutdown_write()
+                    errors = channel.makefile_stderr('rb').read()
+                    status = channel.recv_exit_status()
+            finally:
+                channel.close()
+            if status != 0:
+                raise Exception('tar exited with status {}: {}'.format(status,
+                    errors.decode('utf-8', 'replace').strip()))
+            duration = time.monotonic() - start
+            for filename, destination in files:
+                self.file_sent(filename, destination,
+                        duration=duration,
+                        batch=len(files))
+            self.emit('bundle_sent', files=len(files), bytes=size,
+                    compressed_bytes=stream.count, duration=duration)
+            print('[{}] Sent bundle of {} files: {}'.format(self.task,
+                len(files), utils.format_transfer(stream.count, duration)))
+        except:
+            print('[{}] SSH error while sending the bundle'.format(self.task))
+            raise
+
+    def remote_hashes(self, destinations):
+        channel = self.pool.open_session(self.target)
+        try:
+            channel.exec_command('sha256sum -- ' + ' '.join(
+                shlex.quote(destination) for destination in destinations))
+            lines = channel.makefile('rb').read().decode('utf-8', 'replace')
+            channel.recv_exit_status()
+        finally:
+            channel.close()
+        ret = {}
+        for line in lines.splitlines():
+            digest, _, destination = line.partition('  ')
+            ret[destination] = digest
+        return ret
+
+    def recv_bundle(self):
+        if not self.artifacts:
+            return
+        try:
+            destinations = dict(self.artifacts)
+            start = time.monotonic()
+            channel = self.pool.open_session(self.target)
+            try:
+                with self.cancellable(channel.close):
+                    channel.exec_command('tar -czPf - -- ' + ' '.join(
+                        shlex.quote(filename)
+                        for filename, _ in self.artifacts))
+                    stream = bundle.Counter(channel.makefile('rb'))
+                    received = bundle.untar(stream, destinations)
+                    errors = channel.makefile_stderr('rb').read()
+                    status = channel.recv_exit_status()
+            finally:
+                channel.close()
+            duration = time.monotonic() - start
+            for filename, size in received:
+                self.emit('artifact_received', artifact=filename,
+                        destination=destinations[filename],
+                        bytes=size,
+                        duration=duration,
+                        method='bundle')
+            self.emit('bundle_received', files=len(received),
+                    bytes=sum(size for _, size in received),
+                    compressed_bytes=stream.count, duration=duration)
+            print('[{}] Retrieved bundle of {} artifacts: {}'.format(self.task,
+                len(received), utils.format_transfer(stream.count, duration)))
+            if status != 0:
+                raise Exception('tar exited with status {}: {}'.format(status,
+                    errors.decode('utf-8', 'replace').strip()))
+        except:
+            print('[{}] SSH error while retrieving the bundle'.format(self.task))
+            raise
+
+    def port_open(self, host, port):
+        import paramiko
+
+        try:
+            channel = self.pool.open_channel(self.target,
+                    lambda t: t.open_channel('direct-tcpip', (host, port),
+                        ('localhost', 0)))
+        except paramiko.ChannelException:
+            return False
+        channel.close()
+        return True
+
+    def file_exists(self, path):
+        channel = self.pool.open_session(self.target)
+        try:
+            channel.exec_command('test -e ' + shlex.quote(path))
+            return channel.recv_exit_status() == 0
+        finally:
+            channel.close()
+
+    def exec_action(self, line, output):
+        channel = self.pool.open_session(self.target)
+        try:
+            with self.cancellable(channel.close):
+                # Without a pty, closing the channel leaves the command
+                # running: the shell prints its pid first so that cancel can
+                # kill its process group
+                channel.exec_command('echo $$; ' + line)
+                pid = self.read_pid(channel, output)
+                with self.cancellable(lambda: self.kill(pid)):
+                    # Both streams are drained as they come so that a full
+                    # stderr window never blocks the command
+                    thread = Thread(target=self.drain,
+                            args=(channel.recv_stderr, output, 'stderr'))
+                    thread.daemon = True
+                    thread.start()
+                    self.drain(channel.recv, output, 'stdout')
+                    thread.join()
+                    return channel.recv_exit_status()
+        finally:
+            channel.close()
+
+    @staticmethod
+    def read_pid(channel, output):
+        """Reads the pid printed by the shell of an action."""
+        data = b''
+        while not b'\n' in data:
+            chunk = channel.recv(SshTask.buffer_size)
+            if not chunk:
+                break
+            data += chunk
+        pid, _, rest = data.partition(b'\n')
+        if rest:
+            output.write('stdout', rest)
+        return int(pid)
+
+    def kill(self, pid):
+        """Terminates the processes of the shell of pid on the target."""
+        channel = self.pool.open_session(self.target)
+        try:
+            # sshd makes the shell of a session leader of its process group
+            channel.exec_command('kill -s TERM -- -{0} 2>/dev/null '
+                    '|| kill -s TERM {0}'.format(pid))
+            channel.recv_exit_status()
+        finally:
+            channel.close()
+
+    @staticmethod
+    def drain(recv, output, stream):
+        while True:
+            data = recv(SshTask.buffer_size)
+            if not data:
+                return
+            output.write(stream, data)
@@ -18,230 +18,324 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import base64
-import paramiko
-import winrm
-from . import utils
+import contextlib
+import importlib
+import os
+import time
+from . import resume
+from .output import ActionOutput
+from .run import Cancelled
 
 class Task:
-    def __init__(self, task, number, actions, files, artifacts):
+    # Modules implementing each transport, only imported when used
+    transports = {'ssh': ('.sshtask', 'SshTask'),
+            'winrm': ('.winrmtask', 'WinrmTask'),
+            'fake': ('.faketask', 'FakeTask')}
+    # Delays between the checks of a readiness condition, in seconds
+    poll_interval = 0.25
+    max_poll_interval = 8
+
+    def __init__(self, task, number, target, actions, files, artifacts, run,
+            bundle=False):
         self.task = task
         self.number = number
+        self.target = target
+        self.run = run
+        self.pool = run.pool
         self.actions = actions
         self.files = files
         self.artifacts = artifacts
+        self.bundle = bundle
+        # Functions interrupting what the task is waiting for
+        self.cancellers = set()
+
+    def emit(self, event, **fields):
+        """Records an event of this task in the timeline of the run."""
+        self.run.timeline.emit(event, task=self.task, machine=self.target,
+                **fields)
+
+    @staticmethod
+    def task_class(transport):
+        """Returns the class of the tasks using transport."""
+        module, name = Task.transports[transport]
+        return getattr(importlib.import_module(module, __package__), name)
 
     @staticmethod
-    def run_task(task, number, items, config):
+    def run_task(task, number, items, run):
         print('launching task', task)
 
-        machine = config.conf[items['target']]
-        winrm = (machine.get('guest') == 'windows')
-        if winrm:
-            taskClass = WinrmTask
-        else:
-            taskClass = SshTask
+        taskClass = Task.task_class(run.config.transport(items['target']))
+        transfers = run.config.transfers[task]
         task = taskClass(task,
                 number,
+                items['target'],
                 items['actions'],
-                items['files'],
-                items['artifacts'],
-                machine.get('username', 'vagrant'),
-                machine.get('password', 'vagrant'),
-                config.forwards[items['target']])
-        task.send_files()
-        task.exec_actions()
-        task.recv_artifacts()
-
-
-class WinrmTask(Task):
-    chunk = 400
-    http_port = 8000
-    del_script = """
-$filePath = "{location}"
-if (Test-Path $filePath) {{
-  Remove-Item $filePath
-}}
-    """
-    send_script = """
-$filePath = "{location}"
-$s = @"
-{b64_content}
-"@
-$data = [System.Convert]::FromBase64String($s)
-add-content -value $data -encoding byte -path $filePath
-    """
-    recv_script = """
-$filePath = "{location}"
-$buffer = New-Object byte[] {chunk}
-$reader = [System.IO.File]::OpenRead($filepath)
-$reader.Position = {offset}
-$bytesRead = $reader.Read($buffer, 0, {chunk});
-[Convert]::ToBase64String($buffer, 0, $bytesRead)
-    """
-    http_script = """
-(New-Object System.Net.WebClient).DownloadFile("{url}", "{location}")
-    """
-
-
-    def __init__(self, task, number, actions, files, artifacts, username, password, forwards):
-        super().__init__(task, number, actions, files, artifacts)
-        self.session = winrm.Session('localhost:' + str(forwards[5985]),
-                auth=(username, password))
-
-    def send_files(self):
-        import socket
-        import http.server
-        import socketserver
-        from threading import Thread
+                transfers['files'],
+                transfers['artifacts'],
+                run,
+                transfers['bundle'])
+        start = time.monotonic()
+        task.emit('task_started', timing=items['timing'])
+        status = 'failed'
+        run.task_started(task)
         try:
-            ip = socket.gethostbyname(socket.gethostname())
-            httpd = socketserver.TCPServer((ip, self.http_port + self.number),
-                    http.server.SimpleHTTPRequestHandler)
-            thread = Thread(target=httpd.serve_forever)
-            thread.daemon = True
-            thread.start()
-            script = ""
-            for filename in self.files.split('\n'):
-                if filename == '':
-                    continue
-                if '->' in filename:
-                    filename, destination = utils.parse_associations(filename)[0]
+            run.check_stopped()
+            if run.config.warmup:
+                task.warm_up()
+            with task.phase('send'):
+                if task.bundle:
+                    task.send_bundle()
                 else:
-                    destination = filename
-                url = 'http://{ip}:{port}/{filename}'.format(
-                        ip=ip,
-                        port=str(self.http_port + self.number),
-                        filename=filename)
-                script += self.http_script.format(
-                        url=url,
-                        location=destination)
-            if script != "":
-                cmd = self.session.run_ps(script)
-            httpd.server_close()
-        except:
-            print('[{}] Winrm error while sending files'.format(self.task))
-            raise
+                    task.send_files()
+            if run.config.warmup:
+                task.wait_timing(items['timing'])
+            task.wait_ready(items['wait_for'], items['wait_timeout'])
+            with task.phase('exec'):
+                task.exec_actions()
+            run.check_stopped()
+            with task.phase('receive'):
+                if task.bundle:
+                    task.recv_bundle()
+                else:
+                    task.recv_artifacts()
+            status = 'finished'
+        except Exception as err:
+            if not run.stopped.is_set():
+                raise
+            status = 'cancelled'
+            raise Cancelled('The run was stopped') from err
+        finally:
+            run.task_ended(task)
+            task.close()
+            task.emit('task_finished', status=status,
+                    duration=time.monotonic() - start)
+
+    @staticmethod
+    def collect_artifacts(task, number, items, run):
+        """Retrieves the artifacts of a task that are missing or incomplete.
+
+        Returns how many artifacts were retrieved.
+        """
+        def missing(destination):
+            return (not os.path.exists(destination)
+                    or resume.pending(destination))
 
-    def recv_artifacts(self):
+        artifacts = [(filename, destination) for filename, destination
+                in run.config.transfers[task]['artifacts']
+                if missing(destination)]
+        if not artifacts:
+            return 0
+        taskClass = Task.task_class(run.config.transport(items['target']))
+        task = taskClass(task, number, items['target'], '', [], artifacts, run)
         try:
-            for filename in self.artifacts.split('\n'):
-                if filename == '':
-                    continue
-                if '->' in filename:
-                    filename, destination = utils.parse_associations(filename)[0]
-                else:
-                    destination = filename
-                with open(destination, 'wb') as f:
-                    offset = 0
-                    while True:
-                        cmd = self.session.run_ps(self.recv_script.format(
-                            location=filename,
-                            chunk=self.chunk,
-                            offset=offset))
-                        if cmd.status_code == 1:
-                            print('[{}] Could not retrieve artifact: {}'
-                                    .format(self.task, filename))
-                            print(cmd.std_err.decode('utf-8'))
-                            break
-                        data = cmd.std_out.decode('utf-8').replace('\r\n','')
-                        if len(data) == 0:
-                            break
-                        f.write(base64.b64decode(data))
-                        offset += self.chunk
-        except:
-            print('[{}] Winrm error retrieving artifacts'.format(self.task))
-            raise
+            task.recv_artifacts()
+        finally:
+            task.close()
+        return len([destination for _, destination in artifacts
+            if not missing(destination)])
+
+    def warm_up(self):
+        """Connects to the target ahead of the actions."""
+        self.pool.connect(self.target)
+
+    def wait_timing(self, timing):
+        """Waits for the timing of the task, once its files are sent."""
+        slack = self.run.scheduler.start + timing - time.monotonic()
+        self.emit('task_warmed', slack=slack)
+        if slack < 0:
+            print('[{}] Warmed up {:.2f}s after its timing'.format(self.task,
+                -slack))
+            return
+        self.run.stopped.wait(slack)
+        self.run.check_stopped()
+
+    def wait_ready(self, conditions, timeout):
+        """Waits until every readiness condition holds.
+
+        Each condition is checked over the connection of the task, then again
+        after a delay doubling from poll_interval up to max_poll_interval.
+        Raises an exception if they do not all hold within timeout seconds.
+        """
+        start = time.monotonic()
+        for kind, value, machine in conditions:
+            description = '{} {}'.format(kind, value)
+            if machine is not None:
+                description += ' on ' + machine
+            delay = self.poll_interval
+            polls = 0
+            since = time.monotonic()
+            while True:
+                polls += 1
+                try:
+                    if kind == 'port':
+                        ready = self.port_open(self.condition_host(machine),
+                                value)
+                    else:
+                        ready = self.file_exists(value)
+                except Cancelled:
+                    raise
+                except Exception:
+                    ready = False
+                if ready:
+                    break
+                remaining = start + timeout - time.monotonic()
+                if remaining <= 0:
+                    self.emit('condition_timeout', condition=description,
+                            polls=polls,
+                            waited=time.monotonic() - since)
+                    print('[{}] Gave up waiting for {} after {}s'.format(
+                        self.task, description, timeout))
+                    raise Exception('{} did not hold within {}s'.format(
+                        description, timeout))
+                self.run.stopped.wait(min(delay, remaining))
+                self.run.check_stopped()
+                delay = min(delay * 2, self.max_poll_interval)
+            waited = time.monotonic() - since
+            self.emit('condition_met', condition=description, polls=polls,
+                    waited=waited)
+            print('[{}] {} after {:.2f}s'.format(self.task, description,
+                waited))
+
+    def condition_host(self, machine):
+        """Returns the address of machine as seen from the target."""
+        if machine is None or machine == self.target:
+            return 'localhost'
+        return self.run.config.conf[machine]['ip']
+
+    def port_open(self, host, port):
+        """Tells whether the target accepts connections to host:port."""
+        return False
+
+    def file_exists(self, path):
+        """Tells whether path exists on the target."""
+        return False
 
     def exec_actions(self):
         try:
+            index = 0
             for line in self.actions.split('\n'):
                 if line == '':
                     continue
+                index += 1
+                self.run.check_stopped()
                 print(' starting {}/{}'.format(self.task, line))
-                cmd = self.session.run_ps(line)
-                print('[{}/{}]'.format(self.task, line))
-                print(' ├ RETURN:', cmd.status_code)
-                print(' ├ STDOUT:')
-                utils.pretty_print(cmd.std_out.decode('utf-8'))
-                print(' ├ STDERR:')
-                utils.pretty_print(cmd.std_err.decode('utf-8'))
-                print(' └───')
-                print()
+                self.emit('action_started', index=index, action=line)
+                start = time.monotonic()
+                output = ActionOutput(self.run.log_dir, self.task, index)
+                try:
+                    exit_code = self.exec_action(line, output)
+                finally:
+                    output.close()
+                self.emit('action_finished', index=index, action=line,
+                        exit_code=exit_code,
+                        stdout_bytes=output.sizes['stdout'],
+                        stderr_bytes=output.sizes['stderr'],
+                        duration=time.monotonic() - start)
+                output.print_result(self.task, line, exit_code)
+        except Cancelled:
+            raise
         except:
-            print('[{}] Winrm error executing actions'.format(self.task))
+            print('[{}] {} error executing actions'.format(self.task,
+                self.protocol))
             raise
 
+    def pending_files(self):
+        """Returns the files to send, leaving out those already on the guest.
 
-class SshTask(Task):
-    def __init__(self, task, number, actions, files, artifacts, username, password, forwards):
-        super().__init__(task, number, actions, files, artifacts)
-        self.port = forwards[22]
-        self.username = username
-        self.password = password
+        A file is left out when the manifest of the machine says that its
+        destination has the same content and the guest confirms it.
+        """
+        manifests = self.run.manifests
+        if manifests.force:
+            return list(self.files)
+        candidates = [destination for filename, destination in self.files
+                if manifests.recorded(self.target, destination)
+                == manifests.local_hash(filename)]
+        if not candidates:
+            return list(self.files)
+        remote = self.remote_hashes(candidates)
+        pending = []
+        for filename, destination in self.files:
+            if remote.get(destination) != manifests.local_hash(filename):
+                pending.append((filename, destination))
+                continue
+            size = os.path.getsize(filename)
+            manifests.skipped(size)
+            self.emit('file_skipped', file=filename,
+                    destination=destination,
+                    bytes=size)
+        if len(pending) < len(self.files):
+            print('[{}] {} files already on {}'.format(self.task,
+                len(self.files) - len(pending), self.target))
+        return pending
 
-    def send_files(self):
-        transport = paramiko.Transport(('localhost', self.port))
-        try:
-            transport.connect(None, self.username, self.password)
-            sftp = transport.open_sftp_client()
-            for filename in self.files.split('\n'):
-                if filename == '':
-                    continue
-                if '->' in filename:
-                    filename, destination = utils.parse_associations(filename)[0]
-                else:
-                    destination = filename
-                sftp.put(filename, destination)
-            transport.close()
-        except:
-            print('[{}] SFTP error while sending files'.format(self.task))
-            raise
+    def remote_hashes(self, destinations):
+        """Returns the sha256 of the files of the guest that exist."""
+        return {}
 
-    def recv_artifacts(self):
-        transport = paramiko.Transport(('localhost', self.port))
+    def fetch_artifact(self, filename, destination, digest, fetch):
+        """Retrieves an artifact with fetch(partial), returns its size.
+
+        digest is the sha256 of the artifact on the guest. fetch writes what
+        follows partial.offset to the partial, which keeps it for a later
+        attempt if fetch fails, and checks the whole artifact against digest.
+        """
+        partial = resume.Partial(destination, filename, digest)
+        if partial.offset:
+            print('[{}] Resuming {} after {} bytes'.format(self.task,
+                filename, partial.offset))
+            self.emit('artifact_resumed', artifact=filename,
+                    destination=destination,
+                    offset=partial.offset)
         try:
-            transport.connect(None, self.username, self.password)
-            sftp = transport.open_sftp_client()
-            for filename in self.artifacts.split('\n'):
-                if filename == '':
-                    continue
-                if '->' in filename:
-                    filename, destination = utils.parse_associations(filename)[0]
-                else:
-                    destination = filename
-                sftp.get(filename, destination)
-            transport.close()
+            fetch(partial)
         except:
-            print('[{}] SFTP error while retrieving artifacts'.format(self.task))
+            partial.close()
             raise
+        return partial.finish()
 
-    def exec_actions(self):
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    def file_sent(self, filename, destination, **fields):
+        """Records that a file was placed on the guest."""
+        self.run.manifests.record(self.target, destination,
+                self.run.manifests.local_hash(filename))
+        self.emit('file_sent', file=filename,
+                destination=destination,
+                bytes=os.path.getsize(filename),
+                **fields)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Records how long a phase of the task lasts, if it succeeds."""
+        start = time.monotonic()
+        yield
+        self.emit('phase_finished', phase=name,
+                duration=time.monotonic() - start)
+
+    @contextlib.contextmanager
+    def cancellable(self, canceller):
+        """Has cancel call canceller while the block runs."""
+        self.cancellers.add(canceller)
         try:
-            client.connect('localhost',
-                    port=self.port,
-                    username=self.username,
-                    password=self.password,
-                    allow_agent=False,
-                    look_for_keys=False)
-            for line in self.actions.split('\n'):
-                if line == '':
-                    continue
-                print(' starting {}/{}'.format(self.task, line))
-                stdin, stdout, stderr = client.exec_command(line)
-                exit_code = stdout.channel.recv_exit_status()
-                print('[{}/{}]'.format(self.task, line))
-                print(' ├ RETURN:', exit_code)
-                print(' ├ STDOUT:')
-                utils.pretty_print(stdout.read().decode('utf-8'))
-                print(' ├ STDERR:')
-                utils.pretty_print(stderr.read().decode('utf-8'))
-                print(' └───')
-                print()
-            client.close()
-        except:
-            print('[{}] SSH error executing actions'.format(self.task))
-            raise
+            self.run.check_stopped()
+            yield
+        finally:
+            self.cancellers.discard(canceller)
+
+    def cancel(self):
+        """Interrupts the task, from another thread."""
+        for canceller in list(self.cancellers):
+            try:
+                canceller()
+            except Exception:
+                pass
+
+    def send_bundle(self):
+        """Sends the files as one compressed bundle, if possible."""
+        self.send_files()
+
+    def recv_bundle(self):
+        """Retrieves the artifacts as one compressed bundle, if possible."""
+        self.recv_artifacts()
 
+    def close(self):
+        pass
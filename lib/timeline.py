@@ -0,0 +1,62 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+class Timeline:
+    """Records the events of a play run as JSON lines.
+
+    Every event carries the number of seconds elapsed since the beginning of
+    the run on a monotonic clock. Durations are in seconds and sizes in
+    bytes. Listeners are called with every event, in the order they happen.
+    """
+
+    def __init__(self, path=None):
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.file = None
+        if path is not None:
+            self.file = open(path, 'w', buffering=1)
+        self.emit('run_started', wall_time=time.time())
+
+    def now(self):
+        return time.monotonic() - self.start
+
+    def emit(self, event, **fields):
+        record = OrderedDict()
+        record['time'] = round(self.now(), 6)
+        record['event'] = event
+        record.update(fields)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(record) + '\n')
+            for listener in self.listeners:
+                listener(record)
+
+    def close(self):
+        self.emit('run_finished')
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -62,8 +62,11 @@ def parse_config(args, configuration):
             print('Task', task, 'is not described')
             sys.exit(1)
         timing = configuration.add_task(task, config[task], timing)
+    configuration.check_dependencies()
     configuration.reorder_tasks()
     configuration.add_duration(config['Scenario'].get('duration', '0'))
+    configuration.add_warmup(config['Scenario'].get('warmup', '0'))
+    configuration.add_grace(config['Scenario'].get('grace', '30s'))
 
     return configuration
 
@@ -87,6 +90,69 @@ def parse_associations(s):
         ret.append((left, right))
     return ret
 
+def parse_transfers(s):
+    """Transforms a list of files, one per line, to a list of tuples.
+
+    Each line is either a path, kept as is, or an association
+    "source -> destination".
+    """
+    ret = []
+    for line in s.split('\n'):
+        if line.strip() == '':
+            continue
+        if '->' in line:
+            ret.extend(parse_associations(line))
+        else:
+            ret.append((line.strip(), line.strip()))
+    return ret
+
+def parse_after(s):
+    """Transforms a list of prerequisites to a list of tuples.
+
+    Each prerequisite is the name of a task, optionally followed by the delay
+    to wait once it is finished: "task_a +10s, task_b".
+    """
+    ret = []
+    for word in parse_wordlist(s):
+        members = word.split()
+        if len(members) > 2:
+            raise Exception("Invalid prerequisite: " + word)
+        offset = 0
+        if len(members) == 2:
+            if not members[1].startswith('+'):
+                raise Exception("The delay of a prerequisite starts with +")
+            offset = parse_timing(members[1], 0)
+        ret.append((members[0], offset))
+    return ret
+
+def parse_conditions(s):
+    """Transforms readiness conditions, one per line, to a list of tuples.
+
+    A condition is either "port N", "port N on machine" or "file path". Each
+    tuple holds the kind of the condition, the port or path, and the machine
+    on which the port is, None meaning the target of the task.
+    """
+    ret = []
+    for line in s.split('\n'):
+        line = line.strip()
+        if line == '':
+            continue
+        kind, _, rest = line.partition(' ')
+        rest = rest.strip()
+        if kind == 'file' and rest != '':
+            ret.append(('file', rest, None))
+            continue
+        if kind != 'port':
+            raise Exception("Unknown condition: " + line)
+        words = rest.split()
+        if len(words) not in (1, 3) or (len(words) == 3 and words[1] != 'on'):
+            raise Exception("Expected port N on machine: " + line)
+        port = int(words[0])
+        if not 0 < port < 65536:
+            raise Exception("Invalid port: " + words[0])
+        ret.append(('port', port, words[2] if len(words) == 3 else None))
+    return ret
+
 def parse_timing(string, timing):
     """Transforms a string representing a timing to its value in seconds."""
     ret = 0
@@ -131,3 +197,10 @@ def pretty_print(data):
     for line in data.split('\n'):
         print(' │', line)
 
+
+def format_transfer(size, duration):
+    """Describes a transfer of size bytes that lasted duration seconds."""
+    if duration <= 0:
+        return '{} bytes'.format(size)
+    return '{} bytes in {:.2f}s ({:.2f} MB/s)'.format(size, duration,
+            size / duration / 1000000)
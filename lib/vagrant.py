@@ -0,0 +1,173 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import queue
+import socket
+import subprocess
+import threading
+import time
+
+def for_each_machine(function, machines, parallelism):
+    """Calls function on every machine, parallelism of them at a time.
+
+    Returns a dictionary of the results, None for the machines whose call
+    raised an exception.
+    """
+    jobs = queue.Queue()
+    for machine in machines:
+        jobs.put(machine)
+    results = {}
+
+    def work():
+        while True:
+            try:
+                machine = jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[machine] = function(machine)
+            except Exception as err:
+                print('[{}] {}'.format(machine, err))
+                results[machine] = None
+
+    threads = []
+    for i in range(min(parallelism, len(machines))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+def vagrant(machine, arguments):
+    """Runs a vagrant command about machine, prefixing its output with its name.
+
+    Returns True if the command succeeded.
+    """
+    process = subprocess.Popen(['vagrant'] + arguments,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+    for line in process.stdout:
+        print('[{}] {}'.format(machine,
+            line.decode('utf-8', 'replace').rstrip()))
+    return process.wait() == 0
+
+def probe_ssh(port, timeout):
+    """Checks that an SSH server answers on port."""
+    with socket.create_connection(('localhost', port), timeout) as s:
+        s.settimeout(timeout)
+        return s.recv(4).startswith(b'SSH-')
+
+def probe_winrm(port, timeout):
+    """Checks that a WinRM listener answers on port."""
+    with socket.create_connection(('localhost', port), timeout) as s:
+        s.settimeout(timeout)
+        s.sendall('POST /wsman HTTP/1.1\r\nHost: localhost:{}\r\n'
+                'Content-Length: 0\r\nConnection: close\r\n\r\n'
+                .format(port).encode('ascii'))
+        status = s.recv(12).split(b' ')
+    # HTTP.sys answers 404 while the listener is not registered yet and 503
+    # while the service is starting
+    return (len(status) > 1 and status[0].startswith(b'HTTP/')
+            and not status[1] in (b'404', b'503'))
+
+def probe(config, machine, timeout=5):
+    """Checks that the communicator of machine answers."""
+    forwards = config.forwards[machine]
+    try:
+        if 5985 in forwards:
+            return probe_winrm(forwards[5985], timeout)
+        return probe_ssh(forwards[22], timeout)
+    except OSError:
+        return False
+
+def wait_ready(config, machine, timeout):
+    """Polls machine with an exponential backoff until it is ready.
+
+    Returns True once it is, False if timeout seconds elapsed first.
+    """
+    end = time.monotonic() + timeout
+    delay = 0.5
+    while not probe(config, machine):
+        if time.monotonic() + delay > end:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+    return True
+
+def up(config, parallelism, timeout):
+    """Boots the machines of the cluster and waits until they are ready.
+
+    Returns True if every machine is ready.
+    """
+    def boot(machine):
+        start = time.monotonic()
+        if not vagrant(machine, ['up', machine]):
+            print('[{}] vagrant up failed'.format(machine))
+            return False
+        booted = time.monotonic() - start
+        if not wait_ready(config, machine, timeout):
+            print('[{}] not ready after {}s'.format(machine, timeout))
+            return False
+        print('[{}] ready in {:.1f}s (vagrant up took {:.1f}s)'.format(machine,
+            time.monotonic() - start, booted))
+        return True
+
+    results = for_each_machine(boot, config.vagrant_machines(), parallelism)
+    return all(results.values())
+
+def snapshot(config, name, parallelism):
+    """Saves a snapshot of every machine of the cluster.
+
+    Returns True if every snapshot was saved.
+    """
+    def save(machine):
+        start = time.monotonic()
+        if not vagrant(machine, ['snapshot', 'save', machine, name]):
+            print('[{}] could not save snapshot {}'.format(machine, name))
+            return False
+        print('[{}] snapshot {} saved in {:.1f}s'.format(machine, name,
+            time.monotonic() - start))
+        return True
+
+    results = for_each_machine(save, config.vagrant_machines(), parallelism)
+    return all(results.values())
+
+def reset(config, name, parallelism, timeout):
+    """Restores a snapshot of every machine and waits until they are ready.
+
+    Returns True if every machine is ready.
+    """
+    def restore(machine):
+        start = time.monotonic()
+        if not vagrant(machine, ['snapshot', 'restore', '--no-provision',
+                machine, name]):
+            print('[{}] could not restore snapshot {}'.format(machine, name))
+            return False
+        if not wait_ready(config, machine, timeout):
+            print('[{}] not ready after {}s'.format(machine, timeout))
+            return False
+        print('[{}] snapshot {} restored in {:.1f}s'.format(machine, name,
+            time.monotonic() - start))
+        return True
+
+    results = for_each_machine(restore, config.vagrant_machines(), parallelism)
+    return all(results.values())
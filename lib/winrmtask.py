@@ -0,0 +1,590 @@
+""" moirai
+    Easily create and replay scenarios
+
+    Copyright (C) 2016 Guillaume Brogi
+    Copyright (C) 2016 Akheros
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import base64
+import os
+import shutil
+import tempfile
+import time
+import winrm
+from . import bundle
+from . import utils
+from .output import Clixml
+from .pool import receive
+from .task import Task
+
+# The guest could not send an artifact in some way
+class NotRetrieved(Exception):
+    pass
+
+
+class WinrmTask(Task):
+    protocol = 'Winrm'
+    chunk = 64 * 1024
+    min_chunk = 400
+    max_chunk = 4 * 1024 * 1024
+    chunk_time = 2
+    del_script = """
+$filePath = "{location}"
+if (Test-Path $filePath) {{
+  Remove-Item $filePath
+}}
+    """
+    send_script = """
+$filePath = "{location}"
+$s = @"
+{b64_content}
+"@
+$data = [System.Convert]::FromBase64String($s)
+add-content -value $data -encoding byte -path $filePath
+    """
+    recv_script = """
+$filePath = "{location}"
+$buffer = New-Object byte[] {chunk}
+$reader = [System.IO.File]::OpenRead($filePath)
+try {{
+  $reader.Position = {offset}
+  $bytesRead = $reader.Read($buffer, 0, {chunk})
+  [Convert]::ToBase64String($buffer, 0, $bytesRead)
+}} finally {{
+  $reader.Close()
+}}
+    """
+    upload_script = """
+$filePath = "{location}"
+$reader = [System.IO.File]::OpenRead($filePath)
+try {{
+  $reader.Position = {offset}
+  $request = [System.Net.WebRequest]::Create("{url}")
+  $request.Method = "PUT"
+  $request.Timeout = 10000
+  $request.AllowWriteStreamBuffering = $false
+  $request.ContentLength = $reader.Length - {offset}
+  $stream = $request.GetRequestStream()
+  $buffer = New-Object byte[] 65536
+  while (($bytesRead = $reader.Read($buffer, 0, $buffer.Length)) -gt 0) {{
+    $stream.Write($buffer, 0, $bytesRead)
+  }}
+  $stream.Close()
+  $request.GetResponse().Close()
+}} finally {{
+  $reader.Close()
+}}
+    """
+    http_script = """
+(New-Object System.Net.WebClient).DownloadFile("{url}", "{location}")
+    """
+    # Bundles are described in bundle.py
+    unbundle_script = """
+$bundle = [System.IO.Path]::GetTempFileName()
+(New-Object System.Net.WebClient).DownloadFile("{url}", $bundle)
+$gzip = New-Object System.IO.Compression.GZipStream([System.IO.File]::OpenRead($bundle), [System.IO.Compression.CompressionMode]::Decompress)
+$reader = New-Object System.IO.BinaryReader($gzip)
+$buffer = New-Object byte[] 65536
+try {{
+  $count = $reader.ReadInt32()
+  for ($i = 0; $i -lt $count; $i++) {{
+    $name = [System.Text.Encoding]::UTF8.GetString($reader.ReadBytes($reader.ReadInt32()))
+    $size = $reader.ReadInt64()
+    $writer = [System.IO.File]::Create($name)
+    try {{
+      while ($size -gt 0) {{
+        $bytesRead = $reader.Read($buffer, 0, [Math]::Min($size, $buffer.Length))
+        if ($bytesRead -eq 0) {{ throw "Truncated bundle" }}
+        $writer.Write($buffer, 0, $bytesRead)
+        $size -= $bytesRead
+      }}
+    }} finally {{
+      $writer.Close()
+    }}
+  }}
+}} finally {{
+  $reader.Close()
+  Remove-Item $bundle
+}}
+    """
+    share_probe_script = """
+foreach ($root in @({roots})) {{
+  if (Test-Path -LiteralPath ($root + {probe})) {{
+    $root
+    break
+  }}
+}}
+    """
+    share_copy_script = """
+Copy-Item -LiteralPath {source} -Destination {destination} -Force -ErrorAction Stop
+    """
+    hash_script = """
+foreach ($name in @({names})) {{
+  if (Test-Path -LiteralPath $name -PathType Leaf) {{
+    $stream = [System.IO.File]::OpenRead($name)
+    try {{
+      $hash = [System.Security.Cryptography.SHA256]::Create().ComputeHash($stream)
+    }} finally {{
+      $stream.Close()
+    }}
+    [System.BitConverter]::ToString($hash).Replace("-", "").ToLower() + " " + $name
+  }}
+}}
+    """
+    port_script = """
+$client = New-Object System.Net.Sockets.TcpClient
+try {{
+  $client.Connect({host}, {port})
+  $client.Connected
+}} catch {{
+  $false
+}} finally {{
+  $client.Close()
+}}
+    """
+    file_script = """
+Test-Path -LiteralPath {path}
+    """
+    bundle_script = """
+$names = @({names})
+$bundle = [System.IO.Path]::GetTempFileName()
+$gzip = New-Object System.IO.Compression.GZipStream([System.IO.File]::Create($bundle), [System.IO.Compression.CompressionMode]::Compress)
+$writer = New-Object System.IO.BinaryWriter($gzip)
+$buffer = New-Object byte[] 65536
+try {{
+  $writer.Write([int]$names.Length)
+  foreach ($name in $names) {{
+    $reader = [System.IO.File]::OpenRead($name)
+    try {{
+      $bytes = [System.Text.Encoding]::UTF8.GetBytes($name)
+      $writer.Write([int]$bytes.Length)
+      $writer.Write($bytes)
+      $writer.Write([long]$reader.Length)
+      while (($bytesRead = $reader.Read($buffer, 0, $buffer.Length)) -gt 0) {{
+        $writer.Write($buffer, 0, $bytesRead)
+      }}
+    }} finally {{
+      $reader.Close()
+    }}
+  }}
+}} finally {{
+  $writer.Close()
+}}
+$bundle
+    """
+
+
+    def __init__(self, task, number, target, actions, files, artifacts, run,
+            bundle=False):
+        super().__init__(task, number, target, actions, files, artifacts, run,
+                bundle)
+        self.session = self.pool.winrm_session(target)
+        self.shell = run.config.conf[target].get('winrm_shell', 'none')
+        self.runspace = None
+
+    def run_ps(self, script):
+        """Runs a powershell script, in the runspace if one is configured."""
+        if self.shell == 'none':
+            return self.session.run_ps(script)
+        return winrm.Response(self.runspace_for_task().run(script))
+
+    def runspace_for_task(self):
+        if self.shell == 'machine':
+            return self.pool.runspace(self.target)
+        if self.runspace is None or not self.runspace.alive:
+            self.runspace = self.pool.open_runspace(self.target, self.session)
+        return self.runspace
+
+    def warm_up(self):
+        super().warm_up()
+        if self.shell != 'none':
+            self.runspace_for_task()
+
+    def close(self):
+        if self.runspace is not None:
+            self.runspace.close()
+
+    def share_root(self):
+        """Returns where the guest sees the synced folder, None if it does not."""
+        folder = self.run.synced_folder
+        if (folder is None or self.run.config.conf[self.target]
+                .get('synced_folder', 'auto') == 'off'):
+            return None
+        return folder.guest_root(self.target, self.probe_share)
+
+    def probe_share(self, probe):
+        cmd = self.run_ps(self.share_probe_script.format(
+            roots=', '.join(self.quote(root)
+                for root in self.run.synced_folder.windows_roots),
+            probe=self.quote(probe.replace('/', '\\'))))
+        root = cmd.std_out.decode('utf-8').strip()
+        if cmd.status_code != 0 or root == '':
+            print('[{}] The synced folder is not available on {}'.format(
+                self.task, self.target))
+            return None
+        return root
+
+    def share_files(self, files):
+        """Sends files through the synced folder, returns False if it cannot."""
+        root = self.share_root()
+        if root is None:
+            return False
+        folder = self.run.synced_folder
+        staged = []
+        try:
+            script = ''
+            for filename, destination in files:
+                path, relative = folder.stage(os.path.basename(filename))
+                try:
+                    os.link(filename, path)
+                except OSError:
+                    shutil.copyfile(filename, path)
+                staged.append(path)
+                script += self.share_copy_script.format(
+                        source=self.quote(folder.guest_path(root, relative)),
+                        destination=self.quote(destination))
+            start = time.monotonic()
+            cmd = self.run_ps(script)
+            if cmd.status_code != 0:
+                print('[{}] Could not copy files from the synced folder'
+                        .format(self.task))
+                print(cmd.std_err.decode('utf-8'))
+                return False
+            duration = time.monotonic() - start
+            for filename, destination in files:
+                self.file_sent(filename, destination,
+                        duration=duration,
+                        batch=len(files),
+                        method='share')
+            return True
+        finally:
+            for path in staged:
+                os.remove(path)
+
+    def share_into(self, filename, partial):
+        """Copies an artifact through the synced folder.
+
+        The copy always starts over, as it does not cross the network.
+        Returns False if the synced folder cannot be used.
+        """
+        root = self.share_root()
+        if root is None:
+            return False
+        folder = self.run.synced_folder
+        path, relative = folder.stage(filename.replace('\\', '/')
+                .split('/')[-1])
+        try:
+            cmd = self.run_ps(self.share_copy_script.format(
+                source=self.quote(filename),
+                destination=self.quote(folder.guest_path(root, relative))))
+            if cmd.status_code != 0 or not os.path.exists(path):
+                return False
+            partial.restart()
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, partial.file)
+            partial.sync()
+            return True
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def send_files(self):
+        try:
+            script = ""
+            sent = self.pending_files()
+            if sent and self.share_files(sent):
+                return
+            for filename, destination in sent:
+                script += self.http_script.format(
+                        url=self.run.file_server().share(filename),
+                        location=destination)
+            if script != "":
+                start = time.monotonic()
+                cmd = self.run_ps(script)
+                if cmd.status_code != 0:
+                    raise Exception('Could not send files: {}'.format(
+                        cmd.std_err.decode('utf-8').strip()))
+                # The files are downloaded by a single script, so they all
+                # share its duration
+                duration = time.monotonic() - start
+                for filename, destination in sent:
+                    self.file_sent(filename, destination,
+                            duration=duration,
+                            batch=len(sent),
+                            method='http')
+        except:
+            print('[{}] Winrm error while sending files'.format(self.task))
+            raise
+
+    def recv_artifacts(self):
+        if not self.artifacts:
+            return
+        try:
+            digests = self.remote_hashes([filename
+                for filename, _ in self.artifacts])
+            for filename, destination in self.artifacts:
+                if not filename in digests:
+                    print('[{}] Could not retrieve artifact: {}'.format(
+                        self.task, filename))
+                    continue
+                start = time.monotonic()
+                methods = []
+                try:
+                    size = self.fetch_artifact(filename, destination,
+                            digests[filename],
+                            lambda partial: methods.append(
+                                self.fetch(filename, partial)))
+                except NotRetrieved:
+                    continue
+                duration = time.monotonic() - start
+                self.emit('artifact_received', artifact=filename,
+                        destination=destination,
+                        bytes=size,
+                        duration=duration,
+                        method=methods[0])
+                print('[{}] Retrieved artifact {}: {}'.format(self.task,
+                    filename,
+                    utils.format_transfer(size, duration)))
+        except:
+            print('[{}] Winrm error retrieving artifacts'.format(self.task))
+            raise
+
+    def fetch(self, filename, partial):
+        """Retrieves an artifact the fastest way possible, returns the way."""
+        if self.share_into(filename, partial):
+            return 'share'
+        if self.push_into(filename, partial):
+            return 'push'
+        if self.pull_into(filename, partial):
+            return 'pull'
+        raise NotRetrieved(filename)
+
+    @staticmethod
+    def quote(s):
+        """Quotes a string for powershell."""
+        return "'" + s.replace("'", "''") + "'"
+
+    def send_bundle(self):
+        files = self.pending_files()
+        if not files:
+            return
+        fd, path = tempfile.mkstemp(prefix='moirai-', suffix='.bundle')
+        server = self.run.file_server()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                size = bundle.pack(f, files)
+                compressed = f.tell()
+            start = time.monotonic()
+            cmd = self.run_ps(self.unbundle_script.format(
+                url=server.share(path)))
+            if cmd.status_code != 0:
+                raise Exception('Could not send the bundle: {}'.format(
+                    cmd.std_err.decode('utf-8').strip()))
+            duration = time.monotonic() - start
+            for filename, destination in files:
+                self.file_sent(filename, destination,
+                        duration=duration,
+                        batch=len(files))
+            self.emit('bundle_sent', files=len(files), bytes=size,
+                    compressed_bytes=compressed, duration=duration)
+            print('[{}] Sent bundle of {} files: {}'.format(self.task,
+                len(files), utils.format_transfer(compressed, duration)))
+        except:
+            print('[{}] Winrm error while sending the bundle'.format(self.task))
+            raise
+        finally:
+            server.unshare(path)
+            os.remove(path)
+
+    def remote_hashes(self, destinations):
+        cmd = self.run_ps(self.hash_script.format(names=', '.join(
+            self.quote(destination) for destination in destinations)))
+        ret = {}
+        if cmd.status_code != 0:
+            return ret
+        for line in cmd.std_out.decode('utf-8').splitlines():
+            digest, _, destination = line.partition(' ')
+            ret[destination] = digest
+        return ret
+
+    def port_open(self, host, port):
+        cmd = self.run_ps(self.port_script.format(host=self.quote(host),
+            port=port))
+        return cmd.std_out.decode('utf-8').strip() == 'True'
+
+    def file_exists(self, path):
+        cmd = self.run_ps(self.file_script.format(path=self.quote(path)))
+        return cmd.std_out.decode('utf-8').strip() == 'True'
+
+    def recv_bundle(self):
+        if not self.artifacts:
+            return
+        destinations = dict(self.artifacts)
+        fd, path = tempfile.mkstemp(prefix='moirai-', suffix='.bundle')
+        os.close(fd)
+        remote = None
+        try:
+            start = time.monotonic()
+            cmd = self.run_ps(self.bundle_script.format(names=', '.join(
+                self.quote(filename) for filename, _ in self.artifacts)))
+            if cmd.status_code != 0:
+                print('[{}] Could not bundle artifacts'.format(self.task))
+                print(cmd.std_err.decode('utf-8'))
+                return
+            remote = cmd.std_out.decode('utf-8').strip()
+            method = 'push'
+            compressed = self.push_artifact(remote, path)
+            if compressed is None:
+                method = 'pull'
+                compressed = self.pull_artifact(remote, path)
+                if compressed is None:
+                    return
+            with open(path, 'rb') as f:
+                received = bundle.unpack(f, destinations.get)
+            duration = time.monotonic() - start
+            for filename, size in received:
+                self.emit('artifact_received', artifact=filename,
+                        destination=destinations[filename],
+                        bytes=size,
+                        duration=duration,
+                        method='bundle')
+            self.emit('bundle_received', files=len(received),
+                    bytes=sum(size for _, size in received),
+                    compressed_bytes=compressed, duration=duration,
+                    method=method)
+            print('[{}] Retrieved bundle of {} artifacts: {}'.format(self.task,
+                len(received), utils.format_transfer(compressed, duration)))
+        except:
+            print('[{}] Winrm error retrieving the bundle'.format(self.task))
+            raise
+        finally:
+            for leftover in (path, path + '.part', path + '.part.json'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            if remote is not None:
+                try:
+                    self.run_ps(self.del_script.format(location=remote))
+                except:
+                    pass
+
+    def push_artifact(self, filename, destination):
+        """Has the guest push an artifact to the host, returns its size."""
+        return self.artifact(filename, destination, self.push_into)
+
+    def pull_artifact(self, filename, destination):
+        """Retrieves an artifact through base64 chunks, returns its size."""
+        return self.artifact(filename, destination, self.pull_into)
+
+    def artifact(self, filename, destination, function):
+        """Retrieves an artifact with function, returns None if it fails."""
+        digest = self.remote_hashes([filename]).get(filename)
+        if digest is None:
+            return None
+        def fetch(partial):
+            if not function(filename, partial):
+                raise NotRetrieved(filename)
+        try:
+            return self.fetch_artifact(filename, destination, digest, fetch)
+        except NotRetrieved:
+            return None
+
+    def push_into(self, filename, partial):
+        """Has the guest push an artifact to the host after partial.offset.
+
+        What the host received is kept even if the upload is interrupted.
+        Returns False if the upload failed. Once the guest could not reach
+        the host, its artifacts are not pushed again.
+        """
+        server = self.run.file_server()
+        if not server.reachable_from(self.target):
+            return False
+        partial.flush()
+        url, upload = server.expect(partial.path, partial.offset)
+        try:
+            cmd = self.run_ps(self.upload_script.format(
+                location=filename,
+                url=url,
+                offset=partial.offset))
+        finally:
+            server.forget(url)
+            partial.sync()
+        if not upload.reached:
+            server.unreachable_from(self.target)
+        return cmd.status_code == 0 and upload.complete
+
+    def pull_into(self, filename, partial):
+        """Retrieves an artifact after partial.offset through base64 chunks.
+
+        The chunk size grows while round trips stay short and shrinks when
+        they fail, for guests that cannot reach the host. Returns False if
+        the guest could not read the artifact.
+        """
+        chunk = self.chunk
+        while True:
+            self.run.check_stopped()
+            start = time.monotonic()
+            try:
+                cmd = self.run_ps(self.recv_script.format(
+                    location=filename,
+                    chunk=chunk,
+                    offset=partial.offset))
+            except (winrm.exceptions.WinRMError,
+                    winrm.exceptions.WinRMTransportError,
+                    winrm.exceptions.WinRMOperationTimeoutError):
+                if chunk == self.min_chunk:
+                    raise
+                chunk = max(self.min_chunk, chunk // 2)
+                continue
+            if cmd.status_code == 1:
+                print('[{}] Could not retrieve artifact: {}'
+                        .format(self.task, filename))
+                print(cmd.std_err.decode('utf-8'))
+                return False
+            data = cmd.std_out.decode('utf-8').replace('\r\n','')
+            if len(data) == 0:
+                return True
+            partial.write(base64.b64decode(data))
+            if (time.monotonic() - start < self.chunk_time
+                    and chunk < self.max_chunk):
+                chunk = min(self.max_chunk, chunk * 2)
+
+    def exec_action(self, line, output):
+        if self.shell != 'none':
+            runspace = self.runspace_for_task()
+            with self.cancellable(runspace.interrupt):
+                return runspace.run(line, output)
+        encoded = base64.b64encode(line.encode('utf_16_le')).decode('ascii')
+        protocol = self.session.protocol
+        shell_id = protocol.open_shell()
+        try:
+            command_id = protocol.run_command(shell_id,
+                    'powershell -encodedcommand {}'.format(encoded))
+            # Errors come as CLIXML, made readable as they are received
+            errors = Clixml()
+            try:
+                with self.cancellable(lambda: protocol.cleanup_command(shell_id,
+                        command_id)):
+                    done = False
+                    while not done:
+                        stdout, stderr, status, done = receive(protocol,
+                                shell_id, command_id)
+                        output.write('stdout', stdout)
+                        output.write('stderr', errors.decode(stderr))
+            finally:
+                protocol.cleanup_command(shell_id, command_id)
+        finally:
+            protocol.close_shell(shell_id)
+        return status
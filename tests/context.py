@@ -5,3 +5,15 @@ sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/..'))
 import lib.utils as utils
 import lib.parser as parser
 import lib.configuration as configuration
+import lib.fileserver as fileserver
+import lib.output as output
+import lib.plan as plan
+import lib.scheduler as scheduler
+import lib.timeline as timeline
+import lib.vagrant as vagrant
+import lib.bundle as bundle
+import lib.manifest as manifest
+import lib.daemon as daemon
+import lib.metrics as metrics
+import lib.profiling as profiling
+import lib.resume as resume
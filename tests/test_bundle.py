@@ -0,0 +1,63 @@
+import io
+import os
+import pytest
+
+from context import bundle
+
+
+class TestBundle:
+    @staticmethod
+    def files(tmpdir):
+        ret = []
+        for name, data in (('a.txt', b'hello\n' * 1000), ('empty', b''),
+                ('b.bin', os.urandom(200000))):
+            tmpdir.join(name).write_binary(data)
+            ret.append((str(tmpdir.join(name)), data))
+        return ret
+
+    def test_pack_unpack(self, tmpdir):
+        files = TestBundle.files(tmpdir)
+        stream = io.BytesIO()
+        size = bundle.pack(stream, [(path, 'C:\\' + os.path.basename(path))
+            for path, _ in files])
+        assert size == sum(len(data) for _, data in files)
+        out = tmpdir.mkdir('out')
+        stream.seek(0)
+        extracted = bundle.unpack(stream,
+                lambda name: str(out.join(name[3:] + '.copy')))
+        assert [name for name, _ in extracted] == ['C:\\a.txt', 'C:\\empty',
+                'C:\\b.bin']
+        for path, data in files:
+            assert out.join(os.path.basename(path) + '.copy') \
+                    .read_binary() == data
+
+    def test_unpack_unexpected(self, tmpdir):
+        files = TestBundle.files(tmpdir)
+        stream = io.BytesIO()
+        bundle.pack(stream, [(files[0][0], 'other')])
+        stream.seek(0)
+        with pytest.raises(ValueError):
+            bundle.unpack(stream, {}.get)
+
+    def test_unpack_truncated(self, tmpdir):
+        files = TestBundle.files(tmpdir)
+        stream = io.BytesIO()
+        bundle.pack(stream, [(path, path) for path, _ in files])
+        stream = io.BytesIO(stream.getvalue()[:-1000])
+        with pytest.raises(EOFError):
+            bundle.unpack(stream, lambda name: name + '.copy')
+
+    def test_tar_untar(self, tmpdir):
+        files = TestBundle.files(tmpdir)
+        stream = io.BytesIO()
+        bundle.tar(stream, [(path, '/guest/' + os.path.basename(path))
+            for path, _ in files])
+        assert len(stream.getvalue()) < 210000
+        out = tmpdir.mkdir('out')
+        stream.seek(0)
+        extracted = bundle.untar(stream,
+                {'/guest/a.txt': str(out.join('a')),
+                    '/guest//b.bin': str(out.join('b'))})
+        assert extracted == [('/guest/a.txt', 6000), ('/guest//b.bin', 200000)]
+        assert out.join('a').read_binary() == files[0][1]
+        assert out.join('b').read_binary() == files[2][1]
@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+import time
+import pytest
+
+from context import daemon
+from context import parser
+
+
+class TestDaemon:
+    conf = """
+[Cluster]
+machines = fake
+
+[fake]
+transport = fake
+
+[Scenario]
+tasks = quick, long
+
+[quick]
+target = fake
+actions = echo hello
+
+[long]
+target = fake
+timing = 0
+actions = sleep 30
+          echo never
+"""
+
+    @staticmethod
+    def start(tmpdir, monkeypatch, conf):
+        monkeypatch.chdir(tmpdir)
+        tmpdir.join('moirai.ini').write(conf)
+        args = parser.create_parser().parse_args(['serve'])
+        return daemon.Daemon(args).listen().start()
+
+    @staticmethod
+    def play(extra=[]):
+        args = parser.create_parser().parse_args(['play', '-l', 'moirai-logs'] + extra)
+        args.func(args)
+
+    def test_no_daemon(self, tmpdir, monkeypatch, capsys):
+        monkeypatch.chdir(tmpdir)
+        assert daemon.request('moirai.ini', {'command': 'status'}) is None
+        args = parser.create_parser().parse_args(['stop'])
+        args.func(args)
+        out, _ = capsys.readouterr()
+        assert 'No moirai serve daemon is running' in out
+
+    def test_play_and_stop(self, tmpdir, monkeypatch, capsys):
+        server = TestDaemon.start(tmpdir, monkeypatch, TestDaemon.conf)
+        try:
+            status = daemon.request('moirai.ini', {'command': 'status'})
+            assert status['state'] == 'idle'
+            pool = server.run.pool
+            errors = []
+            def play():
+                try:
+                    TestDaemon.play()
+                except SystemExit as ex:
+                    errors.append(ex)
+            thread = threading.Thread(target=play)
+            thread.start()
+            for i in range(100):
+                status = daemon.request('moirai.ini', {'command': 'status'})
+                if status.get('running') == ['long']:
+                    break
+                time.sleep(0.05)
+            assert status['state'] == 'playing'
+            assert status['tasks'] == 2
+            start = time.monotonic()
+            assert daemon.request('moirai.ini',
+                    {'command': 'stop'})['status'] == 'Stopping'
+            thread.join(10)
+            assert time.monotonic() - start < 5
+            # The client reports that the scenario did not finish
+            assert [str(ex) for ex in errors] == ['1']
+            with open(str(tmpdir.join('moirai-logs', 'timeline.jsonl'))) as f:
+                events = [json.loads(line) for line in f]
+            statuses = dict((e['task'], e['status']) for e in events
+                    if e['event'] == 'task_finished')
+            assert statuses == {'quick': 'finished', 'long': 'cancelled'}
+
+            # A changed scenario is reloaded over the same connections
+            tmpdir.join('moirai.ini').write(TestDaemon.conf.replace(
+                'sleep 30', 'sleep 0'))
+            TestDaemon.play(['-l', 'second'])
+            assert server.run.pool is pool
+            assert tmpdir.join('second', 'long', '002.stdout').read() == \
+                    'echo never\n'
+        finally:
+            server.close()
+        assert not os.path.exists(server.path)
+        out, _ = capsys.readouterr()
+        assert 'Played by the moirai serve daemon: stopped' in out
+
+    def test_stop_while_loading(self, tmpdir, monkeypatch, capsys):
+        server = TestDaemon.start(tmpdir, monkeypatch, TestDaemon.conf)
+        load = server.load
+
+        def stop_then_load(args):
+            assert server.stop() == {'status': 'Stopping'}
+            return load(args)
+        try:
+            server.load = stop_then_load
+            with pytest.raises(SystemExit):
+                TestDaemon.play()
+            assert not 'task_started' in tmpdir.join('moirai-logs',
+                    'timeline.jsonl').read()
+            # The next play is not stopped
+            server.load = load
+            tmpdir.join('moirai.ini').write(TestDaemon.conf.replace(
+                'sleep 30', 'sleep 0'))
+            TestDaemon.play()
+        finally:
+            server.close()
+        out, _ = capsys.readouterr()
+        assert 'Played by the moirai serve daemon: stopped' in out
+        assert 'Played by the moirai serve daemon: finished' in out
+
+    def test_reuse(self, tmpdir, monkeypatch, capsys):
+        server = TestDaemon.start(tmpdir, monkeypatch,
+                TestDaemon.conf.replace('sleep 30', 'sleep 0'))
+        try:
+            run = server.run
+            TestDaemon.play()
+            TestDaemon.play(['-n', '2'])
+            assert server.run is run
+            assert tmpdir.join('moirai-logs', '2', 'long', '002.stdout') \
+                    .read() == 'echo never\n'
+        finally:
+            server.close()
+        out, _ = capsys.readouterr()
+        assert out.count('Played by the moirai serve daemon: finished') == 2
@@ -0,0 +1,107 @@
+import http.client
+import pytest
+
+from context import fileserver
+
+
+class TestUpload:
+    @staticmethod
+    def put(url, data, headers={}):
+        host, path = url[len('http://'):].split('/', 1)
+        conn = http.client.HTTPConnection(host)
+        conn.request('PUT', '/' + path, body=data, headers=headers)
+        status = conn.getresponse().status
+        conn.close()
+        return status
+
+    def test_upload(self, tmpdir):
+        destination = str(tmpdir.join('artifact'))
+        server = fileserver.FileServer().start()
+        try:
+            url, upload = server.expect(destination)
+            assert TestUpload.put(url, b'x' * 100000) == 200
+        finally:
+            server.close()
+        assert upload.complete
+        assert upload.size == 100000
+        with open(destination, 'rb') as f:
+            assert f.read() == b'x' * 100000
+
+    def test_resumed_upload(self, tmpdir):
+        destination = str(tmpdir.join('artifact'))
+        with open(destination, 'wb') as f:
+            f.write(b'x' * 1000 + b'stale')
+        server = fileserver.FileServer().start()
+        try:
+            url, upload = server.expect(destination, 1000)
+            assert TestUpload.put(url, b'y' * 1000) == 200
+        finally:
+            server.close()
+        assert upload.complete
+        with open(destination, 'rb') as f:
+            assert f.read() == b'x' * 1000 + b'y' * 1000
+
+    def test_unknown_upload(self, tmpdir):
+        server = fileserver.FileServer().start()
+        try:
+            url, upload = server.expect(str(tmpdir.join('artifact')))
+            server.forget(url)
+            assert TestUpload.put(url, b'data') == 404
+        finally:
+            server.close()
+        assert not upload.complete
+
+
+class TestShare:
+    @staticmethod
+    def get(conn, url, headers={}):
+        conn.request('GET', '/' + url.split('/', 3)[3], headers=headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+
+    def test_share(self, tmpdir):
+        tmpfile = tmpdir.join('tool.exe')
+        tmpfile.write_binary(b'0123456789')
+        server = fileserver.FileServer().start()
+        try:
+            url = server.share(str(tmpfile))
+            conn = http.client.HTTPConnection(server.ip, server.port)
+            assert TestShare.get(conn, url) == (200, b'0123456789')
+            # The same connection is kept alive for range requests
+            assert TestShare.get(conn, url, {'Range': 'bytes=2-4'}) == \
+                    (206, b'234')
+            assert TestShare.get(conn, url, {'Range': 'bytes=7-'}) == \
+                    (206, b'789')
+            assert TestShare.get(conn, url, {'Range': 'bytes=-2'}) == \
+                    (206, b'89')
+            assert TestShare.get(conn, url, {'Range': 'bytes=20-'})[0] == 416
+            conn.close()
+        finally:
+            server.close()
+
+    def test_not_shared(self, tmpdir):
+        tmpfile = tmpdir.join('tool.exe')
+        tmpfile.write_binary(b'0123456789')
+        server = fileserver.FileServer().start()
+        try:
+            url = server.share(str(tmpfile))
+            conn = http.client.HTTPConnection(server.ip, server.port)
+            unknown = url.replace(url.split('/')[4], '0' * 32)
+            assert TestShare.get(conn, unknown)[0] == 404
+            conn.close()
+        finally:
+            server.close()
+
+    def test_unshare(self, tmpdir):
+        tmpfile = tmpdir.join('bundle')
+        tmpfile.write_binary(b'0123456789')
+        server = fileserver.FileServer().start()
+        try:
+            url = server.share(str(tmpfile))
+            server.unshare(str(tmpfile))
+            assert server.shared == {} and server.tokens == {}
+            conn = http.client.HTTPConnection(server.ip, server.port)
+            assert TestShare.get(conn, url)[0] == 404
+            conn.close()
+        finally:
+            server.close()
@@ -0,0 +1,31 @@
+import os
+
+from context import manifest
+
+
+class TestManifests:
+    def test_persistence(self, tmpdir):
+        directory = str(tmpdir.join('manifests'))
+        manifests = manifest.Manifests(directory)
+        assert manifests.recorded('machine', '/tmp/tool') is None
+        manifests.record('machine', '/tmp/tool', 'abc')
+        manifests.save()
+        assert os.listdir(directory) == ['machine.json']
+        manifests = manifest.Manifests(directory)
+        assert manifests.recorded('machine', '/tmp/tool') == 'abc'
+        assert manifests.recorded('other', '/tmp/tool') is None
+
+    def test_corrupted(self, tmpdir):
+        tmpdir.join('machine.json').write('{')
+        manifests = manifest.Manifests(str(tmpdir))
+        assert manifests.recorded('machine', '/tmp/tool') is None
+
+    def test_local_hash(self, tmpdir):
+        path = tmpdir.join('file')
+        path.write('hello')
+        manifests = manifest.Manifests()
+        digest = manifests.local_hash(str(path))
+        assert digest == ('2cf24dba5fb0a30e26e83b2ac5b9e29e'
+                '1b161e5c1fa7425e73043362938b9824')
+        path.write('hello world')
+        assert manifests.local_hash(str(path)) != digest
@@ -0,0 +1,68 @@
+import pytest
+
+from context import configuration
+from context import metrics
+
+
+class TestMetrics:
+    @staticmethod
+    def collect():
+        config = configuration.Configuration()
+        config.add_option('web', 'transport', 'fake')
+        config.add_option('win', 'guest', 'windows')
+        m = metrics.Metrics(config)
+        records = [
+                {'time': 1, 'event': 'scenario_started'},
+                {'time': 2, 'event': 'connection_established',
+                    'machine': 'win', 'transport': 'winrm', 'duration': 0.75},
+                {'time': 3, 'event': 'task_started', 'task': 'a',
+                    'machine': 'web', 'timing': 2},
+                {'time': 3.5, 'event': 'action_started', 'task': 'a',
+                    'machine': 'web', 'index': 1},
+                {'time': 4, 'event': 'action_started', 'task': 'a',
+                    'machine': 'web', 'index': 2},
+                {'time': 5, 'event': 'phase_finished', 'task': 'a',
+                    'machine': 'web', 'phase': 'exec', 'duration': 2}]
+        for record in records:
+            m(record)
+        return m
+
+    def test_collect(self):
+        m = TestMetrics.collect()
+        assert list(m.lateness) == [('web', 'fake')]
+        assert m.lateness[('web', 'fake')].values == [0.5]
+        assert list(m.phases) == [('connect', 'win', 'winrm'),
+                ('exec', 'web', 'fake')]
+
+    def test_quantile(self):
+        histogram = metrics.Histogram()
+        for value in range(1, 101):
+            histogram.observe(value / 100)
+        assert histogram.quantile(0.5) == 0.5
+        assert histogram.quantile(0.95) == 0.95
+        assert histogram.cumulative_counts()[4] == (0.1, 10)
+
+    def test_write(self, tmpdir):
+        path = str(tmpdir.join('metrics.prom'))
+        TestMetrics.collect().write(path)
+        lines = open(path).read().splitlines()
+        assert '# TYPE moirai_task_lateness_seconds histogram' in lines
+        assert 'moirai_task_lateness_seconds_bucket{machine="web",' \
+                'transport="fake",le="0.5"} 1' in lines
+        assert 'moirai_task_lateness_seconds_bucket{machine="web",' \
+                'transport="fake",le="0.25"} 0' in lines
+        assert 'moirai_phase_duration_seconds_count{phase="connect",' \
+                'machine="win",transport="winrm"} 1' in lines
+        assert 'moirai_phase_duration_seconds_sum{phase="exec",' \
+                'machine="web",transport="fake"} 2' in lines
+
+    def test_summary(self, capsys):
+        TestMetrics.collect().print_summary()
+        out, _ = capsys.readouterr()
+        assert 'lateness   web              fake            1' in out
+        metrics.Metrics(configuration.Configuration()).print_summary()
+        out, _ = capsys.readouterr()
+        assert out == ''
+
+    def test_escape(self):
+        assert metrics.escape('a"b\\c') == 'a\\"b\\\\c'
@@ -0,0 +1,62 @@
+import os
+import pytest
+
+from context import output
+
+
+class TestClixml:
+    stderr = (b'#< CLIXML\r\n<Objs Version="1.1.0.1" xmlns="http://schemas.'
+            b'microsoft.com/powershell/2004/04"><Obj S="progress" RefId="0">'
+            b'<TN RefId="0"><T>System.Management.Automation.PSCustomObject'
+            b'</T></TN><MS><I64 N="SourceId">1</I64></MS></Obj>'
+            b'<S S="Error">a &lt;b&gt; failed_x000D__x000A_</S>'
+            b'<S S="Error">at line 1_x000D__x000A_</S></Objs>')
+
+    @pytest.mark.parametrize('size', [1, 7, 100000])
+    def test_decode(self, size):
+        clixml = output.Clixml()
+        text = b''.join(clixml.decode(TestClixml.stderr[i:i + size])
+                for i in range(0, len(TestClixml.stderr), size))
+        assert text == b'a <b> failed\nat line 1\n'
+        assert len(clixml.buffer) < 100
+
+    def test_plain(self):
+        clixml = output.Clixml()
+        assert clixml.decode(b'#') == b''
+        assert clixml.decode(b' not clixml') == b'# not clixml'
+        assert clixml.decode(b'<S S="Error">kept</S>') == \
+                b'<S S="Error">kept</S>'
+
+
+class TestTail:
+    def test_tail(self):
+        tail = output.Tail(2, 100)
+        tail.write(b'one\ntw')
+        tail.write(b'o\nthree\nfour')
+        assert tail.get() == 'two\nthree\nfour'
+        assert tail.dropped
+
+    def test_line_size(self):
+        tail = output.Tail(2, 4)
+        tail.write(b'abcdefgh')
+        tail.write(b'ij\nkl')
+        assert tail.get() == 'abcd\nkl'
+        assert not tail.dropped
+
+
+class TestActionOutput:
+    def test_action_output(self, tmpdir, capsys):
+        out = output.ActionOutput(str(tmpdir), 'task', 1)
+        for i in range(1000):
+            out.write('stdout', b'line %d\n' % i)
+        out.write('stderr', b'')
+        out.close()
+        with open(os.path.join(str(tmpdir), 'task', '001.stdout'), 'rb') as f:
+            data = f.read()
+        assert data.count(b'\n') == 1000
+        assert out.sizes == {'stdout': len(data), 'stderr': 0}
+        out.print_result('task', 'ls', 0)
+        printed, _ = capsys.readouterr()
+        assert ' │ line 999\n' in printed
+        assert ' │ line 989\n' not in printed
+        assert ' │ [...]\n' in printed
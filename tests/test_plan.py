@@ -0,0 +1,38 @@
+import os
+import pytest
+
+from context import parser
+from context import plan
+from test_utils import TestParseConfig
+
+
+class TestPlan:
+    @staticmethod
+    def args(tmpdir):
+        tmpfile = TestParseConfig.write_config(tmpdir,
+                TestParseConfig.cluster_block +
+                TestParseConfig.machines_block +
+                TestParseConfig.scenario_block +
+                TestParseConfig.tasks_block)
+        return parser.create_parser().parse_args(['-c', tmpfile, 'compile'])
+
+    def test_compile(self, tmpdir):
+        args = TestPlan.args(tmpdir)
+        config, path = plan.compile(args)
+        assert os.path.dirname(path) == str(tmpdir.join('.moirai', 'plans'))
+        assert os.path.exists(path)
+        loaded = plan.load(args)
+        assert loaded.tasks == TestParseConfig.conf_tasks
+        assert loaded.transfers == TestParseConfig.conf_transfers
+        assert loaded.forwards == TestParseConfig.conf_forwards
+
+    def test_changed_config(self, tmpdir):
+        args = TestPlan.args(tmpdir)
+        plan.compile(args)
+        with open(args.config, 'a') as f:
+            f.write('\n[extra]\ntarget = winxp\n')
+        assert not os.path.exists(plan.plan_path(args.config,
+            plan.digest(args.config)))
+        plan.load(args)
+        assert os.path.exists(plan.plan_path(args.config,
+            plan.digest(args.config)))
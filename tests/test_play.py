@@ -0,0 +1,268 @@
+import json
+import os
+import pytest
+import time
+
+from context import parser
+
+
+class TestPlay:
+    conf = """
+[Cluster]
+machines = fast, slow
+
+[fast]
+transport = fake
+
+[slow]
+transport = fake
+fake_latency = 0.05
+max_concurrent_tasks = 1
+
+[Scenario]
+tasks = first, second, third
+duration = 10s
+
+[first]
+target = fast
+actions = echo hello
+          sleep 0.1
+files = tool.sh -> /tmp/tool.sh
+artifacts = out.txt
+
+[second]
+target = slow
+actions = echo one
+
+[third]
+target = slow
+actions = echo two
+"""
+
+    @staticmethod
+    def play(tmpdir, monkeypatch, conf, extra=[]):
+        monkeypatch.chdir(tmpdir)
+        tmpdir.join('moirai.ini').write(conf)
+        if not tmpdir.join('tool.sh').check():
+            tmpdir.join('tool.sh').write('#!/bin/sh\n')
+        args = parser.create_parser().parse_args(['play', '-l', 'moirai-logs'] + extra)
+        args.func(args)
+        with open(str(tmpdir.join('moirai-logs', 'timeline.jsonl'))) as f:
+            return [json.loads(line) for line in f]
+
+    def test_play(self, tmpdir, monkeypatch, capsys):
+        events = TestPlay.play(tmpdir, monkeypatch, TestPlay.conf)
+        names = [e['event'] for e in events]
+        assert names.count('task_scheduled') == 3
+        assert names.count('task_finished') == 3
+        assert names.count('action_finished') == 4
+        assert all(e['status'] == 'finished' for e in events
+                if e['event'] == 'task_finished')
+        sent = [e for e in events if e['event'] == 'file_sent'][0]
+        assert sent['destination'] == '/tmp/tool.sh'
+        assert sent['bytes'] == 10
+        assert tmpdir.join('moirai-logs', 'first', '001.stdout').read() == \
+                'echo hello\n'
+        out, _ = capsys.readouterr()
+        assert 'slow: 1 queued tasks' in out
+        assert 'lateness   slow' in out
+        phases = [e['phase'] for e in events if e['event'] == 'phase_finished'
+                and e['task'] == 'first']
+        assert phases == ['send', 'exec', 'receive']
+        prom = tmpdir.join('moirai-logs', 'metrics.prom').read()
+        assert 'moirai_task_lateness_seconds_count{machine="fast",' \
+                'transport="fake"} 1' in prom
+        assert 'moirai_phase_duration_seconds_count{phase="exec",' \
+                'machine="slow",transport="fake"} 2' in prom
+
+    @pytest.mark.parametrize('option', ['-w', '-n'])
+    @pytest.mark.parametrize('value', ['0', '-1'])
+    def test_at_least_one(self, option, value, capsys):
+        with pytest.raises(SystemExit):
+            parser.create_parser().parse_args(['play', option, value])
+        _, err = capsys.readouterr()
+        assert 'is not at least 1' in err
+
+    def test_log_dir_per_play(self, tmpdir, monkeypatch, capsys):
+        monkeypatch.chdir(tmpdir)
+        tmpdir.join('moirai.ini').write(TestPlay.conf)
+        tmpdir.join('tool.sh').write('#!/bin/sh\n')
+        for i in range(2):
+            args = parser.create_parser().parse_args(['play'])
+            args.func(args)
+        plays = tmpdir.join('moirai-logs').listdir(sort=True)
+        assert len(plays) == 2
+        for play in plays:
+            assert play.join('timeline.jsonl').check()
+            assert play.join('metrics.prom').check()
+
+    def test_log_dir_per_collect(self, tmpdir, monkeypatch, capsys):
+        monkeypatch.chdir(tmpdir)
+        tmpdir.join('moirai.ini').write(TestPlay.conf)
+        for i in range(2):
+            args = parser.create_parser().parse_args(['collect'])
+            args.func(args)
+        collects = tmpdir.join('moirai-logs', 'collect').listdir(sort=True)
+        assert len(collects) == 2
+        for collect in collects:
+            assert collect.join('timeline.jsonl').check()
+
+    def test_failure(self, tmpdir, monkeypatch, capsys):
+        conf = TestPlay.conf.replace('fake_latency = 0.05',
+                'fake_failure_rate = 1')
+        events = TestPlay.play(tmpdir, monkeypatch, conf)
+        statuses = dict((e['task'], e['status']) for e in events
+                if e['event'] == 'task_finished')
+        assert statuses == {'first': 'finished', 'second': 'failed',
+                'third': 'failed'}
+        out, _ = capsys.readouterr()
+        assert '[second] Task failed' in out
+
+    def test_skip_unchanged_files(self, tmpdir, monkeypatch, capsys):
+        conf = TestPlay.conf.replace('actions = echo one',
+                'actions = echo one\nfiles = tool.sh -> /tmp/tool.sh')
+        events = TestPlay.play(tmpdir, monkeypatch, conf)
+        assert len([e for e in events if e['event'] == 'file_sent']) == 2
+        assert not [e for e in events if e['event'] == 'file_skipped']
+        # The files are on the machines since the first run
+        events = TestPlay.play(tmpdir, monkeypatch, conf)
+        assert not [e for e in events if e['event'] == 'file_sent']
+        assert len([e for e in events if e['event'] == 'file_skipped']) == 2
+        out, _ = capsys.readouterr()
+        assert 'Skipped 2 files already on the machines: 20 bytes' in out
+        events = TestPlay.play(tmpdir, monkeypatch, conf, ['--force-send'])
+        assert len([e for e in events if e['event'] == 'file_sent']) == 2
+        # A changed file is sent again
+        tmpdir.join('tool.sh').write('#!/bin/bash\n')
+        events = TestPlay.play(tmpdir, monkeypatch, conf)
+        assert len([e for e in events if e['event'] == 'file_sent']) == 2
+
+    def test_wait_for(self, tmpdir, monkeypatch, capsys):
+        conf = """
+[Cluster]
+machines = fake
+
+[fake]
+transport = fake
+
+[Scenario]
+tasks = sender, waiter, doomed
+
+[sender]
+target = fake
+timing = 1s
+files = tool.sh -> /flag
+
+[waiter]
+target = fake
+timing = 0
+wait_for = file /flag
+actions = echo ready
+
+[doomed]
+target = fake
+timing = 0
+wait_for = port 22
+           file /never
+wait_timeout = 1s
+actions = echo never
+"""
+        events = TestPlay.play(tmpdir, monkeypatch, conf)
+        statuses = dict((e['task'], e['status']) for e in events
+                if e['event'] == 'task_finished')
+        assert statuses == {'sender': 'finished', 'waiter': 'finished',
+                'doomed': 'failed'}
+        met = dict((e['task'], e) for e in events
+                if e['event'] == 'condition_met')
+        assert met['waiter']['polls'] > 1
+        assert 1 <= met['waiter']['waited'] < 2
+        assert met['doomed']['condition'] == 'port 22'
+        timeout = [e for e in events if e['event'] == 'condition_timeout'][0]
+        assert timeout['condition'] == 'file /never'
+        assert not tmpdir.join('moirai-logs', 'doomed').check()
+        out, _ = capsys.readouterr()
+        assert '[doomed] Gave up waiting for file /never after 1s' in out
+
+    def test_warmup(self, tmpdir, monkeypatch, capsys):
+        conf = """
+[Cluster]
+machines = fake
+
+[fake]
+transport = fake
+fake_latency = 0.2
+
+[Scenario]
+tasks = task
+{}
+
+[task]
+target = fake
+timing = 1s
+files = tool.sh -> /tmp/tool.sh
+actions = echo on time
+"""
+        def lateness(events):
+            start = [e for e in events if e['event'] == 'task_scheduled'][0]
+            action = [e for e in events if e['event'] == 'action_started'][0]
+            return action['time'] - start['time'] - 1
+        events = TestPlay.play(tmpdir, monkeypatch, conf.format(''),
+                ['--force-send'])
+        assert lateness(events) >= 0.2
+        events = TestPlay.play(tmpdir, monkeypatch,
+                conf.format('warmup = 1s'), ['--force-send'])
+        assert 0 <= lateness(events) < 0.1
+        warmed = [e for e in events if e['event'] == 'task_warmed'][0]
+        assert 0.5 < warmed['slack'] < 1
+
+    @pytest.mark.parametrize('grace', ['', 'grace = 0'])
+    def test_grace(self, tmpdir, monkeypatch, capsys, grace):
+        conf = """
+[Cluster]
+machines = fake
+
+[fake]
+transport = fake
+fake_latency = 0.5
+
+[Scenario]
+tasks = done, cut
+duration = 1s
+{}
+
+[done]
+target = fake
+artifacts = done.txt
+
+[cut]
+target = fake
+actions = sleep 30
+artifacts = cut.txt
+"""
+        start = time.monotonic()
+        events = TestPlay.play(tmpdir, monkeypatch, conf.format(grace))
+        assert time.monotonic() - start < 5
+        statuses = dict((e['task'], e['status']) for e in events
+                if e['event'] == 'task_finished')
+        assert statuses == {'done': 'finished', 'cut': 'cancelled'}
+        started = [e for e in events if e['event'] == 'grace_started'][0]
+        assert started['tasks'] == ['cut']
+        missed = [e['artifact'] for e in events
+                if e['event'] == 'artifact_missed']
+        out, _ = capsys.readouterr()
+        if grace:
+            assert missed == ['cut.txt']
+            assert 'Retrieved 0/1 artifacts of the tasks cut short' in out
+            assert '[cut] Missed cut.txt' in out
+        else:
+            assert missed == []
+            assert 'Retrieved 1/1 artifacts of the tasks cut short' in out
+
+    def test_profile(self, tmpdir, monkeypatch, capsys):
+        TestPlay.play(tmpdir, monkeypatch, TestPlay.conf, ['--profile'])
+        assert sorted(tmpdir.join('moirai-logs', 'profile').listdir()) == [
+                tmpdir.join('moirai-logs', 'profile', name) for name in
+                ['run.prof', 'scheduler.prof', 'task-first.prof',
+                    'task-second.prof', 'task-third.prof']]
+        TestPlay.play(tmpdir, monkeypatch, TestPlay.conf, ['-l', 'plain'])
+        assert not tmpdir.join('plain', 'profile').check()
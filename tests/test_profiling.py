@@ -0,0 +1,86 @@
+import io
+import os
+import pstats
+import threading
+import time
+import pytest
+
+from context import profiling
+
+
+def busy():
+    return sum(i * i for i in range(10000))
+
+
+def spin(duration=0.2):
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        pass
+
+
+def spin_task(task, number, items, run):
+    spin()
+
+
+class TestProfiler:
+    @pytest.mark.skipif(profiling.Profiler.sampling,
+            reason='cProfile is only used before Python 3.12')
+    def test_profiles(self, tmpdir, capsys):
+        directory = str(tmpdir.join('profile'))
+        profiler = profiling.Profiler(directory, 'moirai-worker')
+        profiler.start()
+        runner = profiler.runner(lambda task, number, items, run: busy())
+        worker = threading.Thread(target=runner, args=('a/b', 1, {}, None),
+                name='moirai-worker-0')
+        helper = threading.Thread(target=busy)
+        worker.start()
+        helper.start()
+        worker.join()
+        helper.join()
+        assert profiler.profile('scheduler', busy) == busy()
+        path = profiler.stop()
+        assert sorted(os.listdir(directory)) == ['run.prof', 'scheduler.prof',
+                'task-a_b.prof', 'threads.prof']
+        names = set(f[2] for f in pstats.Stats(path).stats)
+        assert 'busy' in names
+        # The worker is only in the profile of its task
+        stats = pstats.Stats(os.path.join(directory, 'threads.prof')).stats
+        assert sum(stat[1] for f, stat in stats.items()
+                if f[2] == 'busy') == 1
+        out, _ = capsys.readouterr()
+        assert 'Profiles written to' in out
+
+    def test_sampling(self, tmpdir, capsys):
+        directory = str(tmpdir.join('profile'))
+        profiler = profiling.Profiler(directory, 'moirai-worker')
+        profiler.sampling = True
+        profiler.start()
+        runner = profiler.runner(spin_task)
+        worker = threading.Thread(target=runner, args=('a', 1, {}, None),
+                name='moirai-worker-0')
+        helper = threading.Thread(target=spin)
+        worker.start()
+        helper.start()
+        profiler.profile('scheduler', spin, 0.1)
+        worker.join()
+        helper.join()
+        path = profiler.stop()
+        assert sorted(os.listdir(directory)) == ['run.prof', 'scheduler.prof',
+                'task-a.prof', 'threads.prof']
+
+        def functions(name):
+            return set(f[2] for f in pstats.Stats(os.path.join(directory,
+                name)).stats)
+        assert 'spin_task' in functions('task-a.prof')
+        assert 'spin' in functions('threads.prof')
+        # Each thread is only in its own profile
+        assert not 'spin_task' in functions('threads.prof')
+        assert not 'spin_task' in functions('scheduler.prof')
+        stats = pstats.Stats(path, stream=io.StringIO())
+        stats.sort_stats('cumulative').print_stats()
+        stats.print_callers()
+
+    def test_nothing_profiled(self, tmpdir):
+        profiler = profiling.Profiler(str(tmpdir), 'moirai-worker')
+        profiler.start()
+        assert profiler.stop() is None
@@ -0,0 +1,82 @@
+import hashlib
+import os
+import pytest
+
+from context import resume
+
+
+class TestPartial:
+    data = os.urandom(100000)
+    digest = hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def interrupted(destination, size):
+        partial = resume.Partial(destination, 'artifact',
+                TestPartial.digest)
+        partial.write(TestPartial.data[:size])
+        partial.close()
+
+    def test_complete(self, tmpdir):
+        destination = str(tmpdir.join('artifact'))
+        partial = resume.Partial(destination, 'artifact', TestPartial.digest)
+        partial.write(TestPartial.data)
+        assert partial.finish() == 100000
+        assert open(destination, 'rb').read() == TestPartial.data
+        assert tmpdir.listdir() == [tmpdir.join('artifact')]
+
+    def test_resume(self, tmpdir):
+        destination = str(tmpdir.join('artifact'))
+        TestPartial.interrupted(destination, 30000)
+        assert resume.pending(destination)
+        partial = resume.Partial(destination, 'artifact', TestPartial.digest)
+        assert partial.offset == 30000
+        partial.write(TestPartial.data[30000:])
+        assert partial.finish() == 100000
+        assert open(destination, 'rb').read() == TestPartial.data
+        assert not resume.pending(destination)
+
+    def test_extra_bytes(self, tmpdir):
+        # Bytes written after the last checkpoint are dropped
+        destination = str(tmpdir.join('artifact'))
+        TestPartial.interrupted(destination, 30000)
+        with open(destination + '.part', 'ab') as f:
+            f.write(b'garbage')
+        partial = resume.Partial(destination, 'artifact', TestPartial.digest)
+        assert partial.offset == 30000
+        assert os.path.getsize(destination + '.part') == 30000
+        partial.close()
+
+    def test_changed_artifact(self, tmpdir):
+        destination = str(tmpdir.join('artifact'))
+        TestPartial.interrupted(destination, 30000)
+        partial = resume.Partial(destination, 'artifact', 'other digest')
+        assert partial.offset == 0
+        partial.close()
+
+    def test_altered_part(self, tmpdir):
+        destination = str(tmpdir.join('artifact'))
+        TestPartial.interrupted(destination, 30000)
+        with open(destination + '.part', 'r+b') as f:
+            f.write(b'altered')
+        partial = resume.Partial(destination, 'artifact', TestPartial.digest)
+        assert partial.offset == 0
+        partial.close()
+
+    def test_mismatch(self, tmpdir):
+        destination = str(tmpdir.join('artifact'))
+        partial = resume.Partial(destination, 'artifact', TestPartial.digest)
+        partial.write(TestPartial.data[:-1] + b'!')
+        with pytest.raises(ValueError):
+            partial.finish()
+        assert tmpdir.listdir() == []
+
+    def test_sync(self, tmpdir):
+        destination = str(tmpdir.join('artifact'))
+        partial = resume.Partial(destination, 'artifact', TestPartial.digest)
+        partial.write(TestPartial.data[:10])
+        partial.flush()
+        with open(destination + '.part', 'ab') as f:
+            f.write(TestPartial.data[10:])
+        partial.sync()
+        assert partial.offset == 100000
+        assert partial.finish() == 100000
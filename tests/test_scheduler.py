@@ -0,0 +1,147 @@
+import threading
+import time
+import pytest
+
+from context import configuration
+from context import scheduler
+from context import timeline
+
+
+class FakeRun:
+    def __init__(self, tasks, limit=None):
+        self.config = configuration.Configuration()
+        self.timeline = timeline.Timeline()
+        self.stopped = threading.Event()
+        if limit is not None:
+            self.config.add_option('machine', 'max_concurrent_tasks', limit)
+        for task, timing, *after in tasks:
+            self.config.tasks[task] = {'target': 'machine', 'timing': timing,
+                    'after': after[0] if after else []}
+
+
+class Recorder:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.started = []
+        self.running = 0
+        self.max_running = 0
+
+    def __call__(self, task, number, items, run):
+        with self.lock:
+            self.started.append((task, time.monotonic()))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+
+
+class TestScheduler:
+    def test_order_and_timing(self):
+        run = FakeRun([('a', 0), ('b', 0.2), ('c', 0.1)])
+        recorder = Recorder()
+        start = time.monotonic()
+        assert scheduler.Scheduler(run, recorder, 4).play()
+        assert [t for t, _ in recorder.started] == ['a', 'c', 'b']
+        lateness = [s - start - run.config.tasks[t]['timing']
+                for t, s in recorder.started]
+        assert max(lateness) < 0.1
+
+    def test_bounded_workers(self):
+        run = FakeRun([(str(i), 0) for i in range(10)])
+        recorder = Recorder(0.05)
+        assert scheduler.Scheduler(run, recorder, 3).play()
+        assert len(recorder.started) == 10
+        assert recorder.max_running == 3
+
+    def test_machine_limit(self, capsys):
+        run = FakeRun([('a', 0), ('b', 0), ('c', 0.01)], '1')
+        recorder = Recorder(0.1)
+        sched = scheduler.Scheduler(run, recorder, 4)
+        assert sched.play()
+        assert [t for t, _ in recorder.started] == ['a', 'b', 'c']
+        assert recorder.max_running == 1
+        assert list(sched.waits) == ['b', 'c']
+        assert sched.waits['b'][1] >= 0.1
+        sched.print_waits()
+        out, _ = capsys.readouterr()
+        assert 'machine: 2 queued tasks' in out
+
+    def test_duration(self):
+        run = FakeRun([('a', 0), ('b', 5)])
+        recorder = Recorder()
+        start = time.monotonic()
+        assert not scheduler.Scheduler(run, recorder, 2).play(0.2)
+        assert time.monotonic() - start < 1
+        assert [t for t, _ in recorder.started] == ['a']
+
+    def test_duration_drops_queued_tasks(self):
+        run = FakeRun([('a', 0), ('b', 0)], '1')
+        recorder = Recorder(0.3)
+        sched = scheduler.Scheduler(run, recorder, 2)
+        assert not sched.play(0.1)
+        assert sched.wait_idle(1)
+        time.sleep(0.1)
+        assert [t for t, _ in recorder.started] == ['a']
+        assert not any(thread.is_alive() for thread in sched.threads)
+
+    def test_stop_ends_workers(self):
+        run = FakeRun([('a', 0), ('b', 0.1), ('c', 0.2)])
+        sched = scheduler.Scheduler(run, None, 4)
+
+        def stop(task, number, items, run):
+            run.stopped.set()
+            sched.wake()
+        sched.runner = stop
+        assert not sched.play()
+        assert sched.wait_idle(1)
+        for thread in sched.threads:
+            thread.join(1)
+        assert not any(thread.is_alive() for thread in sched.threads)
+
+    def test_failing_task(self, capsys):
+        def fail(task, number, items, run):
+            raise Exception('boom')
+        run = FakeRun([('a', 0), ('b', 0)])
+        assert scheduler.Scheduler(run, fail, 1).play()
+        out, _ = capsys.readouterr()
+        assert '[a] Task failed' in out
+
+    def test_after(self):
+        run = FakeRun([('a', 0), ('b', 0.1), ('c', 0, [('a', 0)]),
+            ('d', 0, [('b', 0), ('c', 0.1)])])
+        recorder = Recorder(0.05)
+        start = time.monotonic()
+        assert scheduler.Scheduler(run, recorder, 4).play()
+        started = dict((t, s - start) for t, s in recorder.started)
+        assert [t for t, _ in recorder.started] == ['a', 'c', 'b', 'd']
+        # c starts when a is done, d once c is done and 0.1s later
+        assert 0.05 <= started['c'] < 0.1
+        assert started['d'] >= started['c'] + 0.15
+        assert started['d'] < started['c'] + 0.25
+
+    def test_after_failure(self, capsys):
+        def fail(task, number, items, run):
+            if task == 'a':
+                raise Exception('boom')
+        run = FakeRun([('a', 0), ('b', 0, [('a', 0)]), ('c', 0, [('b', 0)])])
+        events = []
+        run.timeline.listeners.append(events.append)
+        sched = scheduler.Scheduler(run, fail, 2)
+        assert sched.play()
+        assert sched.finished == 3
+        assert [e['task'] for e in events if e['event'] == 'task_skipped'] \
+                == ['b', 'c']
+        out, _ = capsys.readouterr()
+        assert '[b] Skipped, a did not finish' in out
+
+    def test_warmup(self):
+        run = FakeRun([('a', 0.1), ('b', 0.3)])
+        run.config.warmup = 0.2
+        recorder = Recorder()
+        start = time.monotonic()
+        assert scheduler.Scheduler(run, recorder, 2).play()
+        started = [s - start for _, s in recorder.started]
+        assert started[0] < 0.05
+        assert 0.1 <= started[1] < 0.15
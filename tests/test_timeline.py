@@ -0,0 +1,22 @@
+import json
+import pytest
+
+from context import timeline
+
+
+class TestTimeline:
+    def test_timeline(self, tmpdir):
+        path = str(tmpdir.join('timeline.jsonl'))
+        events = []
+        t = timeline.Timeline(path)
+        t.listeners.append(events.append)
+        t.emit('file_sent', task='a', bytes=10, duration=0.5)
+        t.close()
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        assert [r['event'] for r in records] == \
+                ['run_started', 'file_sent', 'run_finished']
+        assert records[1]['bytes'] == 10
+        assert list(records[1])[:2] == ['time', 'event']
+        assert records[0]['time'] <= records[1]['time'] <= records[2]['time']
+        assert [r['event'] for r in events] == ['file_sent', 'run_finished']
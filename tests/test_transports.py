@@ -0,0 +1,439 @@
+import hashlib
+import os
+import pytest
+import threading
+import time
+
+paramiko = pytest.importorskip('paramiko')
+winrm = pytest.importorskip('winrm')
+
+from context import configuration
+from context import output
+from context import resume
+from lib.run import Run
+from lib.sshtask import SshTask
+from lib.task import Task
+from lib.winrmtask import WinrmTask
+from benchmarks.standins import SshStandin, WinrmStandin
+
+
+@pytest.fixture(scope='module')
+def standins(tmpdir_factory):
+    guest = str(tmpdir_factory.mktemp('guest'))
+    ssh = SshStandin(guest)
+    win = WinrmStandin(guest)
+    yield guest, ssh, win
+    ssh.close()
+    win.close()
+
+
+def interrupt(guest, name, destination, size):
+    """Leaves the retrieval of a new artifact of the guest unfinished."""
+    data = os.urandom(200000)
+    with open(os.path.join(guest, name), 'wb') as f:
+        f.write(data)
+    partial = resume.Partial(destination, name,
+            hashlib.sha256(data).hexdigest())
+    partial.write(data[:size])
+    partial.close()
+    return data
+
+
+def make_run(tmpdir, standins, shell='none', channels=1, share_dir=None):
+    guest, ssh, win = standins
+    config = configuration.Configuration()
+    config.add_option('linux', 'guest', 'linux')
+    config.add_option('linux', 'sftp_channels', channels)
+    config.add_option('windows', 'guest', 'windows')
+    config.add_option('windows', 'winrm_shell', shell)
+    config.forwards = {'linux': {22: ssh.port}, 'windows': {5985: win.port}}
+    return Run(config, str(tmpdir.join('logs')), share_dir=share_dir)
+
+
+class TestSshTask:
+    def test_transfers(self, tmpdir, standins):
+        source = tmpdir.join('source.bin')
+        source.write_binary(os.urandom(100000))
+        received = str(tmpdir.join('received.bin'))
+        run = make_run(tmpdir, standins)
+        try:
+            task = SshTask('task', 0, 'linux', '',
+                    [(str(source), 'ssh.bin')],
+                    [('ssh.bin', received)], run)
+            task.send_files()
+            task.recv_artifacts()
+        finally:
+            run.close()
+        assert open(received, 'rb').read() == source.read_binary()
+
+    def test_channels(self, tmpdir, standins):
+        files = []
+        for i in range(20):
+            source = tmpdir.join('file{}'.format(i))
+            source.write(str(i) * 1000)
+            files.append((str(source), 'channels{}'.format(i)))
+        received = tmpdir.mkdir('received')
+        run = make_run(tmpdir, standins, channels=4)
+        try:
+            task = SshTask('task', 0, 'linux', '', files,
+                    [(destination, str(received.join(destination)))
+                        for _, destination in files], run)
+            task.send_files()
+            task.recv_artifacts()
+            task.artifacts.append(('missing', str(received.join('missing'))))
+            with pytest.raises(IOError):
+                task.recv_artifacts()
+        finally:
+            run.close()
+        for i in range(20):
+            assert received.join('channels{}'.format(i)).read() == \
+                    str(i) * 1000
+
+    def test_bundle(self, tmpdir, standins):
+        guest = standins[0]
+        source = tmpdir.join('source.txt')
+        source.write('line\n' * 10000)
+        tool = tmpdir.join('tool.sh')
+        tool.write('#!/bin/sh\n')
+        tool.chmod(0o755)
+        received = str(tmpdir.join('received.txt'))
+        run = make_run(tmpdir, standins)
+        try:
+            task = SshTask('task', 0, 'linux', '',
+                    [(str(source), 'bundle/log.txt'),
+                        (str(tool), 'bundle/tool.sh')],
+                    [('bundle/log.txt', received)], run, bundle=True)
+            task.send_bundle()
+            task.recv_bundle()
+        finally:
+            run.close()
+        assert os.access(os.path.join(guest, 'bundle', 'tool.sh'), os.X_OK)
+        assert open(received).read() == source.read()
+
+    def test_skip_unchanged_files(self, tmpdir, standins):
+        guest = standins[0]
+        source = tmpdir.join('source.bin')
+        source.write_binary(os.urandom(1000))
+        run = make_run(tmpdir, standins)
+        try:
+            task = SshTask('task', 0, 'linux', '',
+                    [(str(source), 'dedup.bin')], [], run)
+            task.send_files()
+            assert task.pending_files() == []
+            # The guest copy changed behind our back
+            with open(os.path.join(guest, 'dedup.bin'), 'ab') as f:
+                f.write(b'!')
+            assert task.pending_files() == [(str(source), 'dedup.bin')]
+        finally:
+            run.close()
+
+    def test_resume(self, tmpdir, standins):
+        destination = str(tmpdir.join('resumed.bin'))
+        data = interrupt(standins[0], 'resume.bin', destination, 50000)
+        run = make_run(tmpdir, standins)
+        events = []
+        run.timeline.listeners.append(events.append)
+        try:
+            task = SshTask('task', 0, 'linux', '', [],
+                    [('resume.bin', destination)], run)
+            task.recv_artifacts()
+        finally:
+            run.close()
+        assert open(destination, 'rb').read() == data
+        assert [e['offset'] for e in events
+                if e['event'] == 'artifact_resumed'] == [50000]
+        assert not resume.pending(destination)
+
+    def test_collect(self, tmpdir, standins):
+        guest = standins[0]
+        with open(os.path.join(guest, 'collected.txt'), 'w') as f:
+            f.write('collected')
+        destination = str(tmpdir.join('collected.txt'))
+        run = make_run(tmpdir, standins)
+        run.config.transfers['task'] = {'artifacts': [('collected.txt',
+            destination)]}
+        try:
+            assert Task.collect_artifacts('task', 1, {'target': 'linux'},
+                    run) == 1
+            # Nothing is missing anymore
+            assert Task.collect_artifacts('task', 1, {'target': 'linux'},
+                    run) == 0
+        finally:
+            run.close()
+        assert open(destination).read() == 'collected'
+
+    def test_conditions(self, tmpdir, standins):
+        guest, ssh, win = standins
+        open(os.path.join(guest, 'ready.flag'), 'w').close()
+        run = make_run(tmpdir, standins)
+        try:
+            task = SshTask('task', 0, 'linux', '', [], [], run)
+            assert task.port_open('localhost', win.port)
+            assert task.file_exists('ready.flag')
+            assert not task.file_exists('missing.flag')
+            task.wait_ready([('port', win.port, None),
+                ('file', 'ready.flag', None)], 1)
+            with pytest.raises(Exception):
+                task.wait_ready([('file', 'missing.flag', None)], 0.3)
+        finally:
+            run.close()
+
+    def test_exec_action(self, tmpdir, standins):
+        run = make_run(tmpdir, standins)
+        try:
+            task = SshTask('task', 0, 'linux', '', [], [], run)
+            collector = output.Collector()
+            status = task.exec_action('echo out; echo err >&2; exit 3',
+                    collector)
+        finally:
+            run.close()
+        assert status == 3
+        assert collector.get('stdout') == b'out\n'
+        assert collector.get('stderr') == b'err\n'
+
+    def test_max_sessions(self, tmpdir, standins):
+        guest, _, win = standins
+        limited = SshStandin(guest, max_sessions=2)
+        run = make_run(tmpdir, (guest, limited, win))
+        try:
+            statuses = []
+
+            def action():
+                task = SshTask('task', 0, 'linux', '', [], [], run)
+                statuses.append(task.exec_action('sleep 0.5',
+                    output.Collector()))
+            threads = [threading.Thread(target=action) for i in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+            assert statuses == [0] * 5
+            connections = len(run.pool.transports['linux'])
+            assert connections >= 3
+            # Refusals that are not about the limit are not retried
+            task = SshTask('task', 0, 'linux', '', [], [], run)
+            assert not task.port_open('localhost', 1)
+            assert len(run.pool.transports['linux']) == connections
+        finally:
+            run.close()
+            limited.close()
+
+    def test_cancel_action(self, tmpdir, standins):
+        run = make_run(tmpdir, standins)
+        try:
+            task = SshTask('task', 0, 'linux', '', [], [], run)
+            thread = threading.Thread(target=task.exec_action,
+                    args=('echo $$ > shell.pid; sleep 30', output.Collector()))
+            thread.daemon = True
+            thread.start()
+            pidfile = os.path.join(standins[0], 'shell.pid')
+            for i in range(100):
+                if len(task.cancellers) == 2 and os.path.exists(pidfile) \
+                        and open(pidfile).read():
+                    break
+                time.sleep(0.05)
+            pid = int(open(pidfile).read())
+            task.cancel()
+            thread.join(5)
+            assert not thread.is_alive()
+            for i in range(100):
+                try:
+                    os.kill(pid, 0)
+                except ProcessLookupError:
+                    break
+                time.sleep(0.05)
+            else:
+                pytest.fail('The action still runs on the guest')
+        finally:
+            run.close()
+
+
+class TestWinrmTask:
+    @pytest.mark.parametrize('shell', ['none', 'task', 'machine'])
+    def test_exec_action(self, tmpdir, standins, shell):
+        run = make_run(tmpdir, standins, shell)
+        try:
+            task = WinrmTask('task', 0, 'windows', '', [], [], run)
+            collector = output.Collector()
+            status = task.exec_action('echo hello', collector)
+            task.close()
+        finally:
+            run.close()
+        assert status == 0
+        assert collector.get('stdout').strip() == b'hello'
+
+    def test_action_errors(self, tmpdir, standins):
+        run = make_run(tmpdir, standins)
+        try:
+            task = WinrmTask('task', 0, 'windows', '', [], [], run)
+            collector = output.Collector()
+            status = task.exec_action('Write-Error failed', collector)
+        finally:
+            run.close()
+        assert status == 1
+        assert collector.get('stderr') == b'failed\n'
+
+    def test_conditions(self, tmpdir, standins):
+        guest, ssh, win = standins
+        open(os.path.join(guest, "it's ready.flag"), 'w').close()
+        run = make_run(tmpdir, standins, 'task')
+        try:
+            task = WinrmTask('task', 0, 'windows', '', [], [], run)
+            assert task.port_open('localhost', win.port)
+            assert task.file_exists("C:\\it's ready.flag")
+            assert not task.file_exists('C:\\missing.flag')
+            task.close()
+        finally:
+            run.close()
+
+    def test_skip_unchanged_files(self, tmpdir, standins):
+        guest = standins[0]
+        source = tmpdir.join('source.bin')
+        source.write_binary(os.urandom(1000))
+        run = make_run(tmpdir, standins, 'task')
+        try:
+            task = WinrmTask('task', 0, 'windows', '',
+                    [(str(source), 'C:\\dedup.bin')], [], run)
+            task.send_files()
+            assert task.pending_files() == []
+            os.remove(os.path.join(guest, 'dedup.bin'))
+            assert task.pending_files() == [(str(source), 'C:\\dedup.bin')]
+            task.close()
+        finally:
+            run.close()
+
+    @pytest.mark.parametrize('method', ['push', 'pull'])
+    def test_resume(self, tmpdir, standins, method):
+        destination = str(tmpdir.join('resumed.bin'))
+        data = interrupt(standins[0], 'resume.bin', destination, 50000)
+        run = make_run(tmpdir, standins, 'task')
+        try:
+            task = WinrmTask('task', 0, 'windows', '', [], [], run)
+            function = getattr(task, method + '_artifact')
+            assert function('C:\\resume.bin', destination) == 200000
+            task.close()
+        finally:
+            run.close()
+        assert open(destination, 'rb').read() == data
+
+    @pytest.mark.parametrize('shared', [True, False])
+    def test_synced_folder(self, tmpdir, standins, shared):
+        guest = standins[0]
+        source = tmpdir.join('source.bin')
+        source.write_binary(os.urandom(10000))
+        received = str(tmpdir.join('received.bin'))
+        # The guest only sees the synced folder when it is its directory
+        run = make_run(tmpdir, standins, 'task',
+                share_dir=guest if shared else str(tmpdir))
+        events = []
+        run.timeline.listeners.append(events.append)
+        try:
+            task = WinrmTask('task', 0, 'windows', '',
+                    [(str(source), 'C:\\shared.bin')],
+                    [('C:\\shared.bin', received)], run)
+            task.send_files()
+            task.recv_artifacts()
+            task.close()
+        finally:
+            run.close()
+        assert open(received, 'rb').read() == source.read_binary()
+        methods = [e['method'] for e in events
+                if e['event'] in ('file_sent', 'artifact_received')]
+        assert methods == (['share', 'share'] if shared else ['http', 'push'])
+        assert not os.path.exists(run.synced_folder.directory)
+
+    @pytest.mark.parametrize('shell', ['none', 'task'])
+    def test_transfers(self, tmpdir, standins, shell):
+        source = tmpdir.join('source.bin')
+        source.write_binary(os.urandom(100000))
+        pushed = str(tmpdir.join('pushed.bin'))
+        pulled = str(tmpdir.join('pulled.bin'))
+        run = make_run(tmpdir, standins, shell)
+        try:
+            task = WinrmTask('task', 0, 'windows', '',
+                    [(str(source), 'C:\\winrm.bin')], [], run)
+            task.send_files()
+            assert task.push_artifact('C:\\winrm.bin', pushed) == 100000
+            task.chunk = 30000
+            assert task.pull_artifact('C:\\winrm.bin', pulled) == 100000
+            task.close()
+        finally:
+            run.close()
+        assert open(pushed, 'rb').read() == source.read_binary()
+        assert open(pulled, 'rb').read() == source.read_binary()
+
+    def test_unreachable_host(self, tmpdir, standins, monkeypatch):
+        guest = standins[0]
+        artifacts = []
+        for name in ('first.bin', 'second.bin'):
+            with open(os.path.join(guest, name), 'wb') as f:
+                f.write(os.urandom(1000))
+            artifacts.append(('C:\\' + name, str(tmpdir.join(name))))
+        run = make_run(tmpdir, standins)
+        events = []
+        run.timeline.listeners.append(events.append)
+        scripts = []
+        try:
+            task = WinrmTask('task', 0, 'windows', '', [], artifacts, run)
+            # The guest cannot reach the host, nothing listens on port 1
+            monkeypatch.setattr(run.file_server(), 'port', 1)
+            run_ps = task.run_ps
+            def record(script):
+                scripts.append(script)
+                return run_ps(script)
+            monkeypatch.setattr(task, 'run_ps', record)
+            task.recv_artifacts()
+            task.close()
+        finally:
+            run.close()
+        assert [e['method'] for e in events
+                if e['event'] == 'artifact_received'] == ['pull', 'pull']
+        # Only the first artifact tries to push
+        assert len([script for script in scripts
+            if 'WebRequest]::Create' in script]) == 1
+
+    def test_bundle(self, tmpdir, standins):
+        guest = standins[0]
+        first = tmpdir.join('first.txt')
+        first.write('first\n' * 10000)
+        second = tmpdir.join('second.txt')
+        second.write("it's the second")
+        received = tmpdir.mkdir('received')
+        run = make_run(tmpdir, standins, 'task')
+        try:
+            task = WinrmTask('task', 0, 'windows', '',
+                    [(str(first), 'C:\\first.txt'),
+                        (str(second), "C:\\it's.txt")],
+                    [('C:\\first.txt', str(received.join('1'))),
+                        ("C:\\it's.txt", str(received.join('2')))],
+                    run, bundle=True)
+            task.send_bundle()
+            # The temporary bundle is no longer served
+            assert run.file_server().shared == {}
+            task.recv_bundle()
+            task.close()
+        finally:
+            run.close()
+        assert received.join('1').read() == first.read()
+        assert received.join('2').read() == second.read()
+        assert not [f for f in os.listdir(guest) if f.endswith('.bundle')]
+
+    @pytest.mark.parametrize('bundle', [False, True])
+    def test_send_failure(self, tmpdir, standins, bundle):
+        open(os.path.join(standins[0], 'blocker'), 'w').close()
+        source = tmpdir.join('source.txt')
+        source.write('source')
+        run = make_run(tmpdir, standins, 'task')
+        try:
+            # A file of the guest is in the way of the destination
+            task = WinrmTask('task', 0, 'windows', '',
+                    [(str(source), 'C:\\blocker\\source.txt')], [], run,
+                    bundle=bundle)
+            with pytest.raises(Exception):
+                if bundle:
+                    task.send_bundle()
+                else:
+                    task.send_files()
+            task.close()
+        finally:
+            run.close()
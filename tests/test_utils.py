@@ -99,6 +99,9 @@ actions = sleep 120
                 'actions': 'wmic logicaldisk get caption > disks.txt',
                 'files': '',
                 'timing': 10,
+                'after': [],
+                'wait_for': [],
+                'wait_timeout': 300,
                 }),
         ('list_files', {
             'target': 'archlinux',
@@ -106,12 +109,35 @@ actions = sleep 120
             'actions': 'ls -lah > file_list',
             'files': '.bashrc\n.bash_history -> history',
             'timing': 20,
+            'after': [],
+            'wait_for': [],
+            'wait_timeout': 300,
             }),
         ('sleep', {
             'target': 'archlinux',
             'artifacts': '',
             'actions': 'sleep 120',
             'files': '', 'timing': 40,
+            'after': [],
+            'wait_for': [],
+            'wait_timeout': 300,
+            }),
+        ])
+    conf_transfers = OrderedDict([
+        ('check_disks', {
+            'files': [],
+            'artifacts': [('disks.txt', 'disks.txt')],
+            'bundle': False,
+            }),
+        ('list_files', {
+            'files': [('.bashrc', '.bashrc'), ('.bash_history', 'history')],
+            'artifacts': [('file_list', 'archlinux_ls')],
+            'bundle': False,
+            }),
+        ('sleep', {
+            'files': [],
+            'artifacts': [],
+            'bundle': False,
             }),
         ])
 
@@ -210,6 +236,173 @@ actions = sleep 120
         assert config.conf == TestParseConfig.conf_machines
         assert config.forwards == TestParseConfig.conf_forwards
         assert config.tasks == TestParseConfig.conf_tasks
+        assert config.transfers == TestParseConfig.conf_transfers
+        assert config.transports() == ['ssh', 'winrm']
+
+    def test_unknown_target(self, tmpdir):
+        tmpfile = TestParseConfig.write_config(tmpdir,
+                TestParseConfig.cluster_block +
+                TestParseConfig.machines_block +
+                TestParseConfig.scenario_block +
+                TestParseConfig.tasks_block.replace('target = winxp',
+                    'target = win7'))
+        parse = parser.create_parser()
+        args = parse.parse_args(['-c', tmpfile, 'create'])
+        with pytest.raises(SystemExit) as ex:
+            utils.parse_config(args, configuration.Configuration())
+        assert str(ex.value) == "1"
+
+    def test_invalid_winrm_shell(self, tmpdir):
+        tmpfile = TestParseConfig.write_config(tmpdir,
+                TestParseConfig.cluster_block +
+                TestParseConfig.machines_block +
+                '\nwinrm_shell = always\n' +
+                TestParseConfig.scenario_block +
+                TestParseConfig.tasks_block)
+        parse = parser.create_parser()
+        args = parse.parse_args(['-c', tmpfile, 'create'])
+        with pytest.raises(SystemExit) as ex:
+            utils.parse_config(args, configuration.Configuration())
+        assert str(ex.value) == "1"
+
+    def test_bundle(self, tmpdir):
+        tmpfile = TestParseConfig.write_config(tmpdir,
+                TestParseConfig.cluster_block +
+                TestParseConfig.machines_block +
+                TestParseConfig.scenario_block +
+                TestParseConfig.tasks_block + '\nbundle = yes\n')
+        parse = parser.create_parser()
+        args = parse.parse_args(['-c', tmpfile, 'create'])
+        config = utils.parse_config(args, configuration.Configuration())
+        assert config.transfers['sleep']['bundle']
+        assert not config.transfers['list_files']['bundle']
+
+    def test_invalid_bundle(self, tmpdir):
+        tmpfile = TestParseConfig.write_config(tmpdir,
+                TestParseConfig.cluster_block +
+                TestParseConfig.machines_block +
+                TestParseConfig.scenario_block +
+                TestParseConfig.tasks_block + '\nbundle = sometimes\n')
+        parse = parser.create_parser()
+        args = parse.parse_args(['-c', tmpfile, 'create'])
+        with pytest.raises(SystemExit) as ex:
+            utils.parse_config(args, configuration.Configuration())
+        assert str(ex.value) == "1"
+
+    def test_invalid_max_concurrent_tasks(self, tmpdir):
+        tmpfile = TestParseConfig.write_config(tmpdir,
+                TestParseConfig.cluster_block +
+                TestParseConfig.machines_block +
+                '\nmax_concurrent_tasks = 0\n' +
+                TestParseConfig.scenario_block +
+                TestParseConfig.tasks_block)
+        parse = parser.create_parser()
+        args = parse.parse_args(['-c', tmpfile, 'create'])
+        with pytest.raises(SystemExit) as ex:
+            utils.parse_config(args, configuration.Configuration())
+        assert str(ex.value) == "1"
+
+    def test_after(self, tmpdir):
+        tmpfile = TestParseConfig.write_config(tmpdir,
+                TestParseConfig.cluster_block +
+                TestParseConfig.machines_block +
+                TestParseConfig.scenario_block +
+                TestParseConfig.tasks_block.replace('timing = +20s',
+                    'after = check_disks +5s, list_files'))
+        parse = parser.create_parser()
+        args = parse.parse_args(['-c', tmpfile, 'create'])
+        config = utils.parse_config(args, configuration.Configuration())
+        assert config.tasks['sleep']['after'] == [('check_disks', 5),
+                ('list_files', 0)]
+        assert config.tasks['sleep']['timing'] == 0
+
+    @pytest.mark.parametrize('after', ['win7', 'sleep', 'check_disks 5s'])
+    def test_invalid_after(self, tmpdir, after):
+        tmpfile = TestParseConfig.write_config(tmpdir,
+                TestParseConfig.cluster_block +
+                TestParseConfig.machines_block +
+                TestParseConfig.scenario_block +
+                TestParseConfig.tasks_block.replace('timing = +20s',
+                    'after = ' + after))
+        parse = parser.create_parser()
+        args = parse.parse_args(['-c', tmpfile, 'create'])
+        with pytest.raises(SystemExit) as ex:
+            utils.parse_config(args, configuration.Configuration())
+        assert str(ex.value) == "1"
+
+    def test_cycle(self, tmpdir, capsys):
+        tmpfile = TestParseConfig.write_config(tmpdir,
+                TestParseConfig.cluster_block +
+                TestParseConfig.machines_block +
+                TestParseConfig.scenario_block +
+                TestParseConfig.tasks_block
+                .replace('timing = 10s', 'after = sleep')
+                .replace('timing = +20s', 'after = list_files')
+                .replace('timing = +10s', 'after = check_disks'))
+        parse = parser.create_parser()
+        args = parse.parse_args(['-c', tmpfile, 'create'])
+        with pytest.raises(SystemExit) as ex:
+            utils.parse_config(args, configuration.Configuration())
+        assert str(ex.value) == "1"
+        out, _ = capsys.readouterr()
+        assert 'check_disks -> sleep -> list_files -> check_disks' in out
+
+    def test_warmup(self, tmpdir):
+        tmpfile = TestParseConfig.write_config(tmpdir,
+                TestParseConfig.cluster_block +
+                TestParseConfig.machines_block +
+                TestParseConfig.scenario_block.replace('duration = 1m',
+                    'duration = 1m\nwarmup = 5s') +
+                TestParseConfig.tasks_block)
+        parse = parser.create_parser()
+        args = parse.parse_args(['-c', tmpfile, 'create'])
+        config = utils.parse_config(args, configuration.Configuration())
+        assert config.warmup == 5
+        assert config.grace == 30
+
+    def test_grace(self, tmpdir):
+        tmpfile = TestParseConfig.write_config(tmpdir,
+                TestParseConfig.cluster_block +
+                TestParseConfig.machines_block +
+                TestParseConfig.scenario_block.replace('duration = 1m',
+                    'duration = 1m\ngrace = 2m') +
+                TestParseConfig.tasks_block)
+        parse = parser.create_parser()
+        args = parse.parse_args(['-c', tmpfile, 'create'])
+        config = utils.parse_config(args, configuration.Configuration())
+        assert config.grace == 120
+
+    def test_wait_for(self, tmpdir):
+        tmpfile = TestParseConfig.write_config(tmpdir,
+                TestParseConfig.cluster_block +
+                TestParseConfig.machines_block +
+                TestParseConfig.scenario_block +
+                TestParseConfig.tasks_block +
+                '\nwait_for = port 445 on winxp\n  file /tmp/done\n' +
+                'wait_timeout = 30s\n')
+        parse = parser.create_parser()
+        args = parse.parse_args(['-c', tmpfile, 'create'])
+        config = utils.parse_config(args, configuration.Configuration())
+        assert config.tasks['sleep']['wait_for'] == [
+                ('port', 445, 'winxp'), ('file', '/tmp/done', None)]
+        assert config.tasks['sleep']['wait_timeout'] == 30
+
+    @pytest.mark.parametrize('condition', ['port 445 on win7',
+        'port 22 on archlinux2', 'service sshd'])
+    def test_invalid_wait_for(self, tmpdir, condition):
+        # archlinux has no fixed ip for winxp to reach it
+        tmpfile = TestParseConfig.write_config(tmpdir,
+                TestParseConfig.cluster_block +
+                TestParseConfig.machines_block +
+                TestParseConfig.scenario_block +
+                TestParseConfig.tasks_block.replace('timing = 10s',
+                    'timing = 10s\nwait_for = ' + condition)
+                .replace('archlinux2', 'archlinux'))
+        parse = parser.create_parser()
+        args = parse.parse_args(['-c', tmpfile, 'create'])
+        with pytest.raises(SystemExit) as ex:
+            utils.parse_config(args, configuration.Configuration())
+        assert str(ex.value) == "1"
 
 class TestParseWordlist:
     def test_wordlist(self):
@@ -242,6 +435,35 @@ class TestParseAssociations:
             utils.parse_associations('-> a')
         assert str(ex.value) == "Empty member"
 
+class TestParseTransfers:
+    def test_transfers(self):
+        assert utils.parse_transfers('a\nb -> c\n\n d \n') == \
+                [('a', 'a'), ('b', 'c'), ('d', 'd')]
+
+    def test_invalid_association(self):
+        with pytest.raises(Exception) as ex:
+            utils.parse_transfers('a ->')
+        assert str(ex.value) == "Empty member"
+
+class TestParseAfter:
+    def test_after(self):
+        assert utils.parse_after('a +1m, b') == [('a', 60), ('b', 0)]
+
+    def test_too_many_members(self):
+        with pytest.raises(Exception):
+            utils.parse_after('a +1m +2s')
+
+class TestParseConditions:
+    def test_conditions(self):
+        assert utils.parse_conditions('port 80\nfile C:\\out\\done.flag') \
+                == [('port', 80, None), ('file', 'C:\\out\\done.flag', None)]
+
+    @pytest.mark.parametrize('condition', ['port', 'port 0', 'port 80 at web',
+        'file', 'port http'])
+    def test_invalid(self, condition):
+        with pytest.raises(Exception):
+            utils.parse_conditions(condition)
+
 class TestParseTiming:
     def test_digit(self):
         assert utils.parse_timing('10', 0) == 10
@@ -295,3 +517,11 @@ class TestPrettyPrint:
         out, _ = capsys.readouterr()
         assert out == " │ aa\n"
 
+
+class TestFormatTransfer:
+    def test_format_transfer(self):
+        assert utils.format_transfer(2000000, 2) == \
+                '2000000 bytes in 2.00s (1.00 MB/s)'
+
+    def test_no_duration(self):
+        assert utils.format_transfer(10, 0) == '10 bytes'
@@ -0,0 +1,62 @@
+import socket
+import threading
+import pytest
+
+from context import parser
+from context import vagrant
+
+
+class OneShotServer:
+    """Answers the first connection with a fixed message."""
+    def __init__(self, answer):
+        self.answer = answer
+        self.socket = socket.socket()
+        self.socket.bind(('localhost', 0))
+        self.socket.listen(1)
+        self.port = self.socket.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        conn, _ = self.socket.accept()
+        conn.sendall(self.answer)
+        conn.close()
+        self.socket.close()
+
+
+class TestProbe:
+    def test_ssh(self):
+        server = OneShotServer(b'SSH-2.0-OpenSSH_7.2\r\n')
+        assert vagrant.probe_ssh(server.port, 1)
+
+    def test_not_ssh(self):
+        server = OneShotServer(b'')
+        assert not vagrant.probe_ssh(server.port, 1)
+
+    def test_winrm(self):
+        server = OneShotServer(b'HTTP/1.1 401 \r\n\r\n')
+        assert vagrant.probe_winrm(server.port, 1)
+
+    def test_winrm_not_listening(self):
+        server = OneShotServer(b'HTTP/1.1 404 Not Found\r\n\r\n')
+        assert not vagrant.probe_winrm(server.port, 1)
+
+
+class TestForEachMachine:
+    def test_for_each_machine(self, capsys):
+        def boot(machine):
+            if machine == 'c':
+                raise Exception('boom')
+            return machine.upper()
+        results = vagrant.for_each_machine(boot, ['a', 'b', 'c'], 2)
+        assert results == {'a': 'A', 'b': 'B', 'c': None}
+        out, _ = capsys.readouterr()
+        assert '[c] boom' in out
+
+    @pytest.mark.parametrize('command', ['up', 'spin', 'reset'])
+    def test_invalid_parallelism(self, command, capsys):
+        with pytest.raises(SystemExit):
+            parser.create_parser().parse_args([command, '-p', '0'])
+        _, err = capsys.readouterr()
+        assert 'is not at least 1' in err